@@ -8,12 +8,27 @@
 
 
 
+import atexit
+import hashlib
+import json
 import math
+import numbers
 import numpy as np
+import operator
+import os
 import pdb
+import pickle
 import random
+import signal
+import struct
 import sympy as sp
+import tempfile
+import threading
+import time
 import unittest
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from copy import deepcopy
 from IPython.display import display
 
@@ -43,6 +58,7 @@ class QH(object):
             self.t, self.x, self.y, self.z = self.representation_2_txyz(representation)
 
         self.qtype = qtype
+        self._rep_cache = None
 
     def __str__(self, quiet=False):
         """Customize the output."""
@@ -58,13 +74,13 @@ class QH(object):
             )
 
         elif self.representation == "polar":
-            rep = self.txyz_2_representation("polar")
+            rep = self.cached_representation("polar")
             string = "({A} A, {thetaX} 𝜈x, {thetaY} 𝜈y, {thetaZ} 𝜈z) {qt}".format(
                 A=rep[0], thetaX=rep[1], thetaY=rep[2], thetaZ=rep[3], qt=qtype
             )
 
         elif self.representation == "spherical":
-            rep = self.txyz_2_representation("spherical")
+            rep = self.cached_representation("spherical")
             string = "({t} t, {R} R, {theta} θ, {phi} φ) {qt}".format(
                 t=rep[0], R=rep[1], theta=rep[2], phi=rep[3], qt=qtype
             )
@@ -81,6 +97,25 @@ class QH(object):
         if spacer:
             print("")
 
+    def cached_representation(self, representation):
+        """txyz_2_representation, remembered until t, x, y or z change."""
+
+        key = (representation, self.t, self.x, self.y, self.z)
+        cache = getattr(self, "_rep_cache", None)
+
+        if cache is not None and cache[0] == key:
+            return cache[1]
+
+        rep = self.txyz_2_representation(representation)
+        self._rep_cache = (key, rep)
+
+        return rep
+
+    def clear_representation_cache(self):
+        """Forget a cached representation, for methods that change t, x, y or z."""
+
+        self._rep_cache = None
+
     def is_symbolic(self):
         """Figures out if an expression has symbolic terms."""
 
@@ -243,6 +278,7 @@ class QH(object):
         self.x = sp.simplify(self.x)
         self.y = sp.simplify(self.y)
         self.z = sp.simplify(self.z)
+        self.clear_representation_cache()
         return self
 
     def expand_q(self):
@@ -252,6 +288,7 @@ class QH(object):
         self.x = sp.expand(self.x)
         self.y = sp.expand(self.y)
         self.z = sp.expand(self.z)
+        self.clear_representation_cache()
         return self
 
     def subs(self, symbol_value_dict):
@@ -342,6 +379,11 @@ class QH(object):
         )
         return du
 
+    def lazy(self):
+        """Start a lazy expression, see QHLazy."""
+
+        return QHLazy.leaf(self)
+
     def equals(self, q1):
         """Tests if two quaternions are equal."""
 
@@ -927,7 +969,10 @@ class QH(object):
         end_qtype = "{}{}".format(self.qtype, qtype)
 
         if g_form == "exp":
-            g_factor = sp.exp(dimensionless_g)
+            if isinstance(dimensionless_g, sp.Basic):
+                g_factor = sp.exp(dimensionless_g)
+            else:
+                g_factor = math.exp(dimensionless_g)
         elif g_form == "minimal":
             g_factor = 1 + 2 * dimensionless_g + 2 * dimensionless_g ** 2
         else:
@@ -1126,7 +1171,7 @@ class QH(object):
                 return QH([math.log(self.t), 0, 0, 0], qtype=end_qtype)
             else:
                 # I don't understant this, but mathematica does the same thing.
-                return QH([math.log(-self.t), math.pi, 0, 0], qtype=end_type)
+                return QH([math.log(-self.t), math.pi, 0, 0], qtype=end_qtype)
 
             return QH([lt, 0, 0, 0])
 
@@ -1161,9 +1206,21 @@ class QH(object):
         self.x = math.trunc(self.x)
         self.y = math.trunc(self.y)
         self.z = math.trunc(self.z)
+        self.clear_representation_cache()
 
         return self
 
+    def save(self, filename, dtype="float64"):
+        """Save to the binary QHArray format, as a scalar series."""
+
+        QHStates([self]).save(filename, dtype)
+
+    @staticmethod
+    def load(filename):
+        """Load a quaternion saved with save()."""
+
+        return QHStates.load(filename).qs[0]
+
 
 # Write tests the QH class.
 
@@ -1812,10 +1869,600 @@ if __name__ == "__main__":
             print("polar conj of 1 2 0 0: ", qr)
             self.assertTrue(qr.equals(self.Q12np))
 
+        def test_cached_representation(self):
+            q = QH([1, 2, 3, 4], representation="polar")
+            rep = q.cached_representation("polar")
+            print("cached polar: ", q)
+            self.assertTrue(q.cached_representation("polar") is rep)
+            self.assertEqual(rep, q.txyz_2_representation("polar"))
+            spherical = q.cached_representation("spherical")
+            self.assertEqual(spherical, q.txyz_2_representation("spherical"))
+            q.x = 0
+            polar = q.txyz_2_representation("polar")
+            self.assertEqual(q.cached_representation("polar"), polar)
+            q.t = 1.5
+            q.trunc()
+            self.assertTrue(q._rep_cache is None)
+            polar = q.txyz_2_representation("polar")
+            self.assertEqual(q.cached_representation("polar"), polar)
+
     suite = unittest.TestLoader().loadTestsFromModule(TestQHRep())
     _results = unittest.TextTestRunner().run(suite)
 
 
+# ## Lazy expressions
+
+# Eager arithmetic builds a QH at every step, and for symbolic quaternions an ever larger sympy tree. QHLazy records the steps instead, as a graph. Before evaluation the graph is rewritten: conjugates are pushed down through sums and products, (p q)* = q* p*, until they only touch the quaternions at the leaves; products by real scalars are gathered into one factor; and the same subexpression is computed only once. Methods of QH written with conj, product, add, dif and triple_product, like rotation_and_or_boost, work on QHLazy as they are.
+
+
+
+
+class QHLazy(object):
+    """A graph of QH arithmetic, optimized then evaluated in one pass."""
+
+    OPS = ["leaf", "conj", "scale", "product", "add", "dif"]
+
+    def __init__(self, op, args=(), param=None, qtype="Q", representation=""):
+
+        if op not in self.OPS:
+            raise Exception("Oops, lazy ops are: {}".format(", ".join(self.OPS)))
+
+        if representation != "":
+            raise Exception("Oops, lazy expressions need Cartesian quaternions.")
+
+        self.op = op
+        self.args = tuple(args)
+        self.param = param
+        self.qtype = qtype
+        self.representation = representation
+
+    def __str__(self, quiet=False):
+        """The expression, with leaves shown by their qtype."""
+
+        names = {}
+
+        for node in self.nodes():
+            if node.op == "leaf":
+                names[id(node)] = node.qtype
+            elif node.op == "conj":
+                star = "*" if node.param == 0 else "*{}".format(node.param)
+                names[id(node)] = "({}){}".format(names[id(node.args[0])], star)
+            elif node.op == "scale":
+                names[id(node)] = "{} {}".format(node.param, names[id(node.args[0])])
+            else:
+                symbol = {"product": " x ", "add": " + ", "dif": " - "}[node.op]
+                names[id(node)] = "({})".format(
+                    symbol.join(names[id(arg)] for arg in node.args)
+                )
+
+        if quiet:
+            return names[id(self)]
+
+        return "{} {}".format(names[id(self)], self.qtype)
+
+    def print_state(self, label, spacer=True, quiet=True):
+        """Utility for printing a lazy expression."""
+
+        print(label)
+
+        print(self.__str__(quiet))
+
+        if spacer:
+            print("")
+
+    @staticmethod
+    def leaf(q1):
+        """A quaternion as the leaf of a graph."""
+
+        return QHLazy(
+            "leaf", param=q1, qtype=q1.qtype, representation=q1.representation
+        )
+
+    @staticmethod
+    def _wrap(q1):
+        """QH values join a graph as leaves."""
+
+        return q1 if isinstance(q1, QHLazy) else QHLazy.leaf(q1)
+
+    def check_representations(self, q1):
+        """Same as for QH."""
+
+        return QH.check_representations(self, q1)
+
+    def conj(self, conj_type=0, qtype="*"):
+        """Three types of conjugates."""
+
+        if conj_type != 0:
+            qtype += str(conj_type)
+
+        return QHLazy("conj", [self], conj_type, qtype=self.qtype + qtype)
+
+    def flip_signs(self, qtype="-"):
+        """Flip the signs of all terms."""
+
+        return self.scale(-1, qtype="-{}".format(self.qtype))
+
+    def scale(self, factor, qtype=""):
+        """Product with a real number, which commutes with everything."""
+
+        if not qtype:
+            qtype = "{}x{}".format(factor, self.qtype)
+
+        return QHLazy("scale", [self], factor, qtype=qtype)
+
+    def add(self, q1, qtype=""):
+        """Form a add given 2 quaternions."""
+
+        q1 = self._wrap(q1)
+        self.check_representations(q1)
+
+        end_qtype = "{f}+{s}".format(f=self.qtype, s=q1.qtype)
+
+        return QHLazy("add", [self, q1], qtype=qtype or end_qtype)
+
+    def dif(self, q1, qtype=""):
+        """Form a dif given 2 quaternions."""
+
+        q1 = self._wrap(q1)
+        self.check_representations(q1)
+
+        end_qtype = "{f}-{s}".format(f=self.qtype, s=q1.qtype)
+
+        return QHLazy("dif", [self, q1], qtype=qtype or end_qtype)
+
+    def product(self, q1, kind="", reverse=False, qtype=""):
+        """Form a product given 2 quaternions. Only the standard kind can be lazy,
+           reverse=True swaps the order."""
+
+        q1 = self._wrap(q1)
+        self.check_representations(q1)
+
+        if kind != "":
+            raise Exception("Oops, lazy products are only of the standard kind.")
+
+        times_symbol = "xR" if reverse else "x"
+        end_qtype = "{f}{ts}{s}".format(f=self.qtype, ts=times_symbol, s=q1.qtype)
+        pair = [q1, self] if reverse else [self, q1]
+
+        return QHLazy("product", pair, qtype=qtype or end_qtype)
+
+    triple_product = QH.triple_product
+
+    def rotation_and_or_boost(self, h, qtype="boost"):
+        """A boost or rotation or both, built by QH.rotation_and_or_boost."""
+
+        return QH.rotation_and_or_boost(self, self._wrap(h), qtype=qtype)
+
+    def nodes(self):
+        """The distinct nodes of the graph, each after its arguments."""
+
+        order, seen = [], set()
+        stack = [(self, False)]
+
+        while stack:
+            node, ready = stack.pop()
+
+            if ready:
+                order.append(node)
+                continue
+
+            if id(node) in seen:
+                continue
+
+            seen.add(id(node))
+            stack.append((node, True))
+            stack.extend((arg, False) for arg in reversed(node.args))
+
+        return order
+
+    @staticmethod
+    def _is_scalar(node):
+        """A leaf with no vector part commutes, so can be pulled out of products."""
+
+        q = node.param
+
+        return node.op == "leaf" and q.x == 0 and q.y == 0 and q.z == 0
+
+    def optimize(self):
+        """Rewrite the graph: conj pushed down to the leaves, real scalars folded
+           together and out of products, and equal subexpressions shared."""
+
+        interned, done = {}, {}
+
+        def intern(op, args=(), param=None, qtype="Q"):
+            if op == "leaf":
+                key = ("leaf", param.t, param.x, param.y, param.z)
+                qtype = param.qtype
+            else:
+                if op == "add":
+                    args = sorted(args, key=id)
+                key = (op, tuple(id(arg) for arg in args), param)
+
+            if key not in interned:
+                interned[key] = QHLazy(op, args, param, qtype=qtype)
+
+            return interned[key]
+
+        def scale(factor, node):
+            if factor == 1:
+                return node
+
+            if node.op == "scale":
+                return scale(factor * node.param, node.args[0])
+
+            if node.op == "leaf":
+                q = node.param
+                values = [factor * q.t, factor * q.x, factor * q.y, factor * q.z]
+                return intern("leaf", param=QH(values, qtype=node.qtype))
+
+            return intern("scale", [node], factor)
+
+        def product(left, right):
+            if self._is_scalar(left):
+                return scale(left.param.t, right)
+
+            if self._is_scalar(right):
+                return scale(right.param.t, left)
+
+            if left.op == "scale":
+                return scale(left.param, product(left.args[0], right))
+
+            if right.op == "scale":
+                return scale(right.param, product(left, right.args[0]))
+
+            return intern("product", [left, right])
+
+        def rewrite(node, conj):
+            if (id(node), conj) in done:
+                return done[(id(node), conj)]
+
+            if node.op == "leaf":
+                q = node.param.conj() if conj else node.param
+                q.qtype = node.qtype + ("*" if conj else "")
+                result = intern("leaf", param=q)
+
+            elif node.op == "conj" and node.param == 0:
+                result = rewrite(node.args[0], not conj)
+
+            elif node.op == "conj":
+                result = intern("conj", [rewrite(node.args[0], False)], node.param)
+
+                if conj:
+                    result = intern("conj", [result], 0)
+
+            elif node.op == "scale":
+                result = scale(node.param, rewrite(node.args[0], conj))
+
+            elif node.op == "product":
+                left, right = node.args[::-1] if conj else node.args
+                result = product(rewrite(left, conj), rewrite(right, conj))
+
+            else:
+                args = [rewrite(arg, conj) for arg in node.args]
+                result = intern(node.op, args)
+
+            done[(id(node), conj)] = result
+
+            return result
+
+        optimized = rewrite(self, False)
+        optimized.qtype = self.qtype
+
+        return optimized
+
+    def evaluate(self, symbol_value_dict=None, optimize=True):
+        """Compute the quaternion, once per distinct node. Symbols in the leaves
+           and scalars can be given values first, so a symbolic graph gives a
+           number without building the symbolic answer."""
+
+        root = self.optimize() if optimize else self
+        values = {}
+
+        def subs(value):
+            if symbol_value_dict and hasattr(value, "subs"):
+                return value.subs(symbol_value_dict)
+
+            return value
+
+        for node in root.nodes():
+            args = [values[id(arg)] for arg in node.args]
+
+            if node.op == "leaf":
+                q = node.param
+                result = QH([subs(q.t), subs(q.x), subs(q.y), subs(q.z)])
+
+            elif node.op == "conj":
+                result = args[0].conj(conj_type=node.param)
+
+            elif node.op == "scale":
+                factor = subs(node.param)
+                q = args[0]
+                result = QH([factor * q.t, factor * q.x, factor * q.y, factor * q.z])
+
+            else:
+                result = getattr(args[0], node.op)(args[1])
+
+            result.qtype = node.qtype
+            values[id(node)] = result
+
+        result = values[id(root)]
+        result.qtype = self.qtype
+
+        return result
+
+
+if __name__ == "__main__":
+
+    class TestQHLazy(unittest.TestCase):
+        b = QH([1, 2, 3, 4], qtype="b")
+        h = QH([3, 1, -2, 1], qtype="h")
+
+        def test_rotation_and_or_boost(self):
+            eager = self.b.rotation_and_or_boost(self.h)
+            lazy = self.b.lazy().rotation_and_or_boost(self.h)
+            print("lazy boost: ", lazy.optimize())
+            self.assertTrue(lazy.evaluate().equals(eager))
+            self.assertEqual(lazy.evaluate().qtype, eager.qtype)
+            self.assertTrue(lazy.evaluate(optimize=False).equals(eager))
+            self.assertTrue(len(lazy.optimize().nodes()) < len(lazy.nodes()))
+            ops = [node.op for node in lazy.optimize().nodes()]
+            self.assertEqual(ops.count("conj"), 0)
+            self.assertEqual(ops.count("scale"), 1)
+
+        def test_symbolic(self):
+            t, x, y, z = sp.symbols("t x y z")
+            h_s = QH([sp.cosh(t), sp.sinh(t), 0, 0])
+            b_s = QH([t, x, y, z])
+            eager = b_s.rotation_and_or_boost(h_s)
+            lazy = b_s.lazy().rotation_and_or_boost(h_s)
+            self.assertTrue(lazy.evaluate().dif(eager).expand_q().equals(QH()))
+            values = {t: 0.5, x: 1, y: 2, z: 3}
+            q = lazy.evaluate(values)
+            print("lazy boost at values: ", q)
+            q_eager = eager.subs(values)
+            self.assertTrue(
+                np.allclose(
+                    [float(v) for v in [q.t, q.x, q.y, q.z]],
+                    [float(v) for v in [q_eager.t, q_eager.x, q_eager.y, q_eager.z]],
+                )
+            )
+
+        def test_conj_pushdown(self):
+            lazy = self.b.lazy().product(self.h).conj().conj(1).conj()
+            expected = self.b.product(self.h).conj().conj(1).conj()
+            optimized = lazy.optimize()
+            print("conj pushed down: ", optimized)
+            self.assertTrue(optimized.evaluate().equals(expected))
+            ops = [node.op for node in optimized.nodes()]
+            self.assertEqual(ops, ["leaf", "leaf", "product", "conj", "conj"])
+            twice = self.b.lazy().product(self.h).conj().conj()
+            self.assertTrue(twice.evaluate().equals(self.b.product(self.h)))
+
+        def test_scalar_folding(self):
+            two, three = QH([2, 0, 0, 0]), QH([3, 0, 0, 0])
+            lazy = self.b.lazy().product(two).flip_signs().product(three)
+            optimized = lazy.optimize()
+            self.assertEqual([node.op for node in optimized.nodes()], ["leaf"])
+            self.assertTrue(optimized.evaluate().equals(QH([-6, -12, -18, -24])))
+            lazy = two.lazy().product(self.b.lazy().product(self.h)).scale(0.5)
+            self.assertTrue(lazy.evaluate().equals(self.b.product(self.h)))
+
+        def test_shared_subexpressions(self):
+            bh_1 = self.b.lazy().product(self.h)
+            bh_2 = QH([1, 2, 3, 4]).lazy().product(self.h)
+            lazy = bh_1.add(bh_2).dif(bh_2.add(bh_1))
+            ops = [node.op for node in lazy.optimize().nodes()]
+            self.assertEqual(ops.count("product"), 1)
+            self.assertEqual(ops.count("add"), 1)
+            self.assertTrue(lazy.evaluate().equals(QH([0, 0, 0, 0])))
+            with self.assertRaises(Exception):
+                self.b.lazy().product(self.h, kind="even")
+
+    suite = unittest.TestLoader().loadTestsFromModule(TestQHLazy())
+    _results = unittest.TextTestRunner().run(suite)
+
+
+# ## Kernels for arrays of quaternions
+
+# Python method calls and building QH objects dominate the cost of numerical work one quaternion at a time. QHKernels has the quaternion primitives as functions over (..., 4) numpy arrays, broadcasting like numpy. The backend is picked once, at import, from the QH_BACKEND environment variable: "numba" compiles the product into a generalized ufunc if numba is installed, otherwise, or with "numpy", plain numpy is used.
+
+
+
+
+class QHKernels(object):
+    """Quaternion product, add, dif, conj and conj_q over (..., 4) arrays."""
+
+    BACKENDS = ["numba", "numpy"]
+
+    # The signs of conj types 0, 1 and 2, and of flip_signs.
+    CONJ_SIGNS = np.array(
+        [[1, -1, -1, -1], [-1, 1, -1, -1], [-1, -1, 1, -1], [-1, -1, -1, -1]],
+        dtype=np.float64,
+    )
+
+    # All 16 ways to combine them, indexed by a bitmask: 1 for conj, 2 for conj 1,
+    # 4 for conj 2 and 8 for a sign flip. Mask 11 is conj_q(QH([1, 1, 0, 1])).
+    _BITS = (np.arange(16)[:, np.newaxis] >> np.arange(4)) & 1
+    CONJ_Q_SIGNS = np.prod(np.where(_BITS[:, :, np.newaxis], CONJ_SIGNS, 1), axis=1)
+
+    def __init__(self, backend=None):
+
+        backend = backend or os.environ.get("QH_BACKEND", "numba")
+
+        if backend not in self.BACKENDS:
+            print("Oops, only know of these backends: {}".format(self.BACKENDS))
+
+        self.backend = "numpy"
+        self._product = self._numpy_product
+
+        if backend == "numba":
+            try:
+                import numba
+
+                self._product = self._numba_product(numba)
+                self.backend = "numba"
+
+            except ImportError:
+                pass
+
+    @staticmethod
+    def _numpy_product(a, b):
+        """The Hamilton product, broadcasting like numpy."""
+
+        at, ax, ay, az = a[..., 0], a[..., 1], a[..., 2], a[..., 3]
+        bt, bx, by, bz = b[..., 0], b[..., 1], b[..., 2], b[..., 3]
+
+        return np.stack(
+            [
+                at * bt - ax * bx - ay * by - az * bz,
+                at * bx + ax * bt + ay * bz - az * by,
+                at * by + ay * bt + az * bx - ax * bz,
+                at * bz + az * bt + ax * by - ay * bx,
+            ],
+            axis=-1,
+        )
+
+    @staticmethod
+    def _numba_product(numba):
+        """The Hamilton product compiled into a generalized ufunc."""
+
+        @numba.guvectorize(["void(float64[:], float64[:], float64[:])"], "(n),(n)->(n)")
+        def product(a, b, out):
+            out[0] = a[0] * b[0] - a[1] * b[1] - a[2] * b[2] - a[3] * b[3]
+            out[1] = a[0] * b[1] + a[1] * b[0] + a[2] * b[3] - a[3] * b[2]
+            out[2] = a[0] * b[2] + a[2] * b[0] + a[3] * b[1] - a[1] * b[3]
+            out[3] = a[0] * b[3] + a[3] * b[0] + a[1] * b[2] - a[2] * b[1]
+
+        return product
+
+    def product(self, a, b):
+        """Quaternion products of two arrays."""
+
+        return self._product(
+            np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+        )
+
+    @staticmethod
+    def add(a, b):
+        """Sums of two arrays."""
+
+        return np.add(a, b, dtype=np.float64)
+
+    @staticmethod
+    def dif(a, b):
+        """Differences of two arrays."""
+
+        return np.subtract(a, b, dtype=np.float64)
+
+    def conj(self, a, conj_type=0):
+        """Conjugates of type 0, 1 or 2."""
+
+        return np.asarray(a, dtype=np.float64) * self.CONJ_SIGNS[conj_type]
+
+    @staticmethod
+    def conj_q_mask(q1):
+        """The bitmask of a QH or list with 0's or 1's for conj types 0, 1, 2 and a
+           sign flip, as used by QH.conj_q."""
+
+        if isinstance(q1, QH):
+            q1 = [q1.t, q1.x, q1.y, q1.z]
+
+        return sum(1 << bit for bit, flag in enumerate(q1) if flag)
+
+    def conj_q(self, a, q1=None, masks=None):
+        """Like QH.conj_q, q1 has 0's or 1's for conj types 0, 1, 2 and a sign flip.
+           Alternatively, masks has a bitmask for each quaternion of a (..., 4) array.
+           Either way it is one multiply by a row of the sign table."""
+
+        if masks is None:
+            signs = self.CONJ_Q_SIGNS[self.conj_q_mask(q1)]
+        else:
+            signs = self.CONJ_Q_SIGNS[np.asarray(masks)]
+
+        return np.asarray(a, dtype=np.float64) * signs
+
+    def conj_q_all(self, a):
+        """All 16 conj_q's at once, an (..., 16, 4) array ordered by bitmask."""
+
+        return np.asarray(a, dtype=np.float64)[..., np.newaxis, :] * self.CONJ_Q_SIGNS
+
+
+qh_kernels = QHKernels()
+
+
+
+
+
+if __name__ == "__main__":
+
+    class TestQHKernels(unittest.TestCase):
+        """Test the array kernels against QH."""
+
+        q1 = QH([1, 2, 3, 4])
+        q2 = QH([0.5, -1, 0, 2.5])
+        a1, a2 = np.array([1.0, 2, 3, 4]), np.array([0.5, -1, 0, 2.5])
+
+        def test_1000_product(self):
+            for backend in QHKernels.BACKENDS:
+                kernels = QHKernels(backend)
+                print("backend {} runs as {}".format(backend, kernels.backend))
+                q12 = self.q1.product(self.q2)
+                a12 = kernels.product(self.a1, self.a2)
+                self.assertTrue(np.allclose(a12, [q12.t, q12.x, q12.y, q12.z]))
+                many = kernels.product(np.tile(self.a1, (3, 2, 1)), self.a2)
+                self.assertEqual(many.shape, (3, 2, 4))
+                self.assertTrue(np.allclose(many[2, 1], a12))
+
+        def test_1010_add_dif(self):
+            q_sum, q_dif = self.q1.add(self.q2), self.q1.dif(self.q2)
+            a_sum = qh_kernels.add(self.a1, self.a2)
+            a_dif = qh_kernels.dif(self.a1, self.a2)
+            self.assertTrue(np.allclose(a_sum, [q_sum.t, q_sum.x, q_sum.y, q_sum.z]))
+            self.assertTrue(np.allclose(a_dif, [q_dif.t, q_dif.x, q_dif.y, q_dif.z]))
+
+        def test_1020_conj(self):
+            for conj_type in [0, 1, 2]:
+                q_conj = self.q1.conj(conj_type)
+                a_conj = qh_kernels.conj(self.a1, conj_type)
+                self.assertTrue(
+                    np.allclose(a_conj, [q_conj.t, q_conj.x, q_conj.y, q_conj.z])
+                )
+
+        def test_1030_conj_q(self):
+            flags = QH([1, 0, 1, 1])
+            q_conj = self.q1.conj_q(flags)
+            a_conj = qh_kernels.conj_q(self.a1, [1, 0, 1, 1])
+            print("conj_q: ", a_conj)
+            self.assertTrue(
+                np.allclose(a_conj, [q_conj.t, q_conj.x, q_conj.y, q_conj.z])
+            )
+            self.assertTrue(np.allclose(qh_kernels.conj_q(self.a1, [0] * 4), self.a1))
+
+        def test_1040_conj_q_all(self):
+            batch = np.array([self.a1, self.a2, -self.a1])
+            every = qh_kernels.conj_q_all(batch)
+            print("conj_q all 16: ", every.shape)
+            self.assertEqual(every.shape, (3, 16, 4))
+            for mask in range(16):
+                flags = [(mask >> bit) & 1 for bit in range(4)]
+                self.assertEqual(QHKernels.conj_q_mask(QH(flags)), mask)
+                q_conj = self.q2.conj_q(QH(flags))
+                q_conj = [q_conj.t, q_conj.x, q_conj.y, q_conj.z]
+                self.assertTrue(np.allclose(every[1, mask], q_conj))
+                self.assertTrue(
+                    np.allclose(qh_kernels.conj_q(batch, flags), every[:, mask])
+                )
+            masks = np.array([3, 15, 0])
+            self.assertTrue(
+                np.allclose(
+                    qh_kernels.conj_q(batch, masks=masks), every[np.arange(3), masks]
+                )
+            )
+
+    suite = unittest.TestLoader().loadTestsFromModule(TestQHKernels())
+    _results = unittest.TextTestRunner().run(suite)
+
+
 # ## QHStates - n quaternions that are a semi-group with inverses
 
 # Any quaternion can be viewed as the sum of n other quaternions. This is common to see in quantum mechanics, whose needs are driving the development of this class and its methods.
@@ -1828,6 +2475,12 @@ class QHStates(QH):
 
     QS_TYPES = ["scalar", "bra", "ket", "op", "operator"]
 
+    # Element-wise methods can shard the states over a process pool.
+    # workers=0 keeps things serial, series smaller than min_dim always are,
+    # and chunksize=0 picks about four chunks per worker.
+    PARALLEL = {"workers": 0, "min_dim": 64, "chunksize": 0}
+    _executors = {}
+
     def __init__(self, qs=None, qs_type="ket", rows=0, columns=0):
 
         self.qs = qs
@@ -1913,46 +2566,159 @@ class QHStates(QH):
 
         return new_q
 
-    def bra(self):
-        """Quickly set the qs_type to bra by calling set_qs_type()."""
+    @staticmethod
+    def set_parallel(workers=None, min_dim=None, chunksize=None):
+        """Set the defaults used by element-wise methods, workers=True uses all the cores."""
 
-        if self.qs_type == "bra":
-            return self
+        if workers is not None:
+            QHStates.PARALLEL["workers"] = workers
 
-        bra = deepcopy(self).conj()
-        bra.rows = 1
-        bra.columns = self.dim
+        if min_dim is not None:
+            QHStates.PARALLEL["min_dim"] = min_dim
 
-        bra.qs_type = "bra" if self.dim > 1 else "scalar"
+        if chunksize is not None:
+            QHStates.PARALLEL["chunksize"] = chunksize
 
-        return bra
+        return QHStates.PARALLEL
 
-    def ket(self):
-        """Quickly set the qs_type to ket by calling set_qs_type()."""
+    @staticmethod
+    def _executor(workers):
+        """One process pool per number of workers, reused between calls and shut
+           down at exit."""
 
-        if self.qs_type == "ket":
-            return self
+        if not QHStates._executors:
+            atexit.register(QHStates.shutdown)
 
-        ket = deepcopy(self).conj()
-        ket.rows = self.dim
-        ket.columns = 1
+        if workers not in QHStates._executors:
+            QHStates._executors[workers] = ProcessPoolExecutor(max_workers=workers)
 
-        ket.qs_type = "ket" if self.dim > 1 else "scalar"
+        return QHStates._executors[workers]
 
-        return ket
+    @staticmethod
+    def shutdown():
+        """Shut down the cached process pools and their worker processes."""
 
-    def op(self, rows, columns):
-        """Quickly set the qs_type to op by calling set_qs_type()."""
+        for executor in QHStates._executors.values():
+            executor.shutdown(cancel_futures=True)
 
-        if rows * columns != self.dim:
-            print(
-                "Oops, rows * columns != dim: {} * {}, {}".formaat(
-                    rows, columns, self.dim
-                )
-            )
-            return None
+        QHStates._executors.clear()
+        atexit.unregister(QHStates.shutdown)
 
-        op_q = deepcopy(self)
+    @staticmethod
+    def _parallel_map(function, *iterables, workers=2):
+        """executor.map over the process pool, run serially if the pool can't be
+           used, as when classes defined in a notebook can't be pickled. Errors
+           raised by the function itself are not caught."""
+
+        iterables = [list(iterable) for iterable in iterables]
+
+        try:
+            # Pickling errors inside the pool can hang its shutdown, so check first.
+            pickle.dumps([function] + [iterable[:1] for iterable in iterables])
+
+        except (pickle.PicklingError, AttributeError, TypeError) as error:
+            print("Oops, can't pickle for the process pool, running serially: ", error)
+            return list(map(function, *iterables))
+
+        # A pool forked before a class was defined can't find it, so try a new one.
+        for _ in range(2):
+            try:
+                return list(QHStates._executor(workers).map(function, *iterables))
+
+            except BrokenProcessPool as error:
+                broken = error
+                executor = QHStates._executors.pop(workers)
+                executor.shutdown(wait=False, cancel_futures=True)
+
+        print("Oops, the process pool can't be used, running serially: ", broken)
+
+        return list(map(function, *iterables))
+
+    @staticmethod
+    def _element_wise_chunk(method, chunk, args, kwargs):
+        """Calls the QH method on the first quaternion of each tuple in a chunk."""
+
+        return [getattr(q, method)(*qs, *args, **kwargs) for q, *qs in chunk]
+
+    def _element_wise(self, method, *args, others=None, workers=None, **kwargs):
+        """Calls a QH method state by state, zipping in the states of others if given.
+        Large series are chunked over a process pool and reassembled in order."""
+
+        series = [self.qs] + [other.qs for other in others or []]
+        chunk = list(zip(*series))
+
+        if workers is None:
+            workers = QHStates.PARALLEL["workers"]
+
+        if workers is True:
+            workers = os.cpu_count()
+
+        if workers and workers > 1 and len(chunk) >= QHStates.PARALLEL["min_dim"]:
+            chunksize = QHStates.PARALLEL["chunksize"] or math.ceil(
+                len(chunk) / (4 * workers)
+            )
+            chunks = [chunk[i : i + chunksize] for i in range(0, len(chunk), chunksize)]
+            n_chunks = len(chunks)
+
+            new_states = []
+
+            for states in QHStates._parallel_map(
+                QHStates._element_wise_chunk,
+                [method] * n_chunks,
+                chunks,
+                [args] * n_chunks,
+                [kwargs] * n_chunks,
+                workers=workers,
+            ):
+                new_states.extend(states)
+
+        else:
+            new_states = QHStates._element_wise_chunk(method, chunk, args, kwargs)
+
+        return QHStates(
+            new_states, qs_type=self.qs_type, rows=self.rows, columns=self.columns
+        )
+
+    def bra(self):
+        """Quickly set the qs_type to bra by calling set_qs_type()."""
+
+        if self.qs_type == "bra":
+            return self
+
+        bra = deepcopy(self).conj()
+        bra.rows = 1
+        bra.columns = self.dim
+
+        bra.qs_type = "bra" if self.dim > 1 else "scalar"
+
+        return bra
+
+    def ket(self):
+        """Quickly set the qs_type to ket by calling set_qs_type()."""
+
+        if self.qs_type == "ket":
+            return self
+
+        ket = deepcopy(self).conj()
+        ket.rows = self.dim
+        ket.columns = 1
+
+        ket.qs_type = "ket" if self.dim > 1 else "scalar"
+
+        return ket
+
+    def op(self, rows, columns):
+        """Quickly set the qs_type to op by calling set_qs_type()."""
+
+        if rows * columns != self.dim:
+            print(
+                "Oops, rows * columns != dim: {} * {}, {}".formaat(
+                    rows, columns, self.dim
+                )
+            )
+            return None
+
+        op_q = deepcopy(self)
 
         op_q.rows = rows
         op_q.columns = columns
@@ -1999,37 +2765,26 @@ class QHStates(QH):
         if self.dim != q1.dim:
             return False
 
-        result = True
+        for n in range(self.dim):
+            if not self._q_at(n).equals(q1._q_at(n)):
+                return False
 
-        for selfq, q1q in zip(self.qs, q1.qs):
-            if not selfq.equals(q1q):
-                result = False
-
-        return result
+        return True
 
-    def conj(self, conj_type=0):
-        """Take the conjgates of states, default is zero, but also can do 1 or 2."""
+    def _q_at(self, n):
+        """The n-th quaternion of the series, also for views that never make a list."""
 
-        new_states = []
+        return self.qs[n]
 
-        for ket in self.qs:
-            new_states.append(ket.conj(conj_type))
+    def conj(self, conj_type=0, workers=None):
+        """Take the conjgates of states, default is zero, but also can do 1 or 2."""
 
-        return QHStates(
-            new_states, qs_type=self.qs_type, rows=self.rows, columns=self.columns
-        )
+        return self._element_wise("conj", conj_type, workers=workers)
 
-    def conj_q(self, q1):
+    def conj_q(self, q1, workers=None):
         """Does multicate conjugate operators."""
 
-        new_states = []
-
-        for ket in self.qs:
-            new_states.append(ket.conj_q(q1))
-
-        return QHStates(
-            new_states, qs_type=self.qs_type, rows=self.rows, columns=self.columns
-        )
+        return self._element_wise("conj_q", q1, workers=workers)
 
     def display_q(self, label):
         """Try to display algebra in a pretty way."""
@@ -2042,18 +2797,118 @@ class QHStates(QH):
             ket.display_q()
             print("")
 
-    def simple_q(self):
+    def simple_q(self, workers=None):
         """Simplify the states."""
 
-        new_states = []
+        return self._element_wise("simple_q", workers=workers)
 
-        for ket in self.qs:
-            new_states.append(ket.simple_q())
+    @staticmethod
+    def _call_with_timeout(function, expr, timeout=None):
+        """function(expr), given up on after timeout seconds.
+           Returns the result, or None, and whether it finished."""
 
-        return QHStates(
+        class _Timeout(BaseException):
+            pass
+
+        armed = [False]
+
+        def alarm(signum, frame):
+            if armed[0]:
+                raise _Timeout()
+
+        # Alarms only work on the main thread, as in a pool worker.
+        use_alarm = (
+            bool(timeout)
+            and hasattr(signal, "setitimer")
+            and threading.current_thread() is threading.main_thread()
+        )
+
+        if use_alarm:
+            previous = signal.signal(signal.SIGALRM, alarm)
+
+        try:
+            if use_alarm:
+                armed[0] = True
+                signal.setitimer(signal.ITIMER_REAL, timeout)
+
+            result, finished = function(expr), True
+
+        except _Timeout:
+            result, finished = None, False
+
+        finally:
+            armed[0] = False
+
+            if use_alarm:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, previous)
+
+        return result, finished
+
+    @staticmethod
+    def _simple_component(expr, timeout=None, fallback="cancel"):
+        """Simplify one term, using a cheaper fallback if sp.simplify takes longer than timeout seconds.
+           The fallback gets the same timeout, after which the term is kept as it is.
+           Returns the term and whether sp.simplify finished."""
+
+        simple, finished = QHStates._call_with_timeout(sp.simplify, expr, timeout)
+
+        if not finished:
+            fallbacks = {"expand": sp.expand, "cancel": sp.cancel, "none": sp.sympify}
+            simple, done = QHStates._call_with_timeout(
+                fallbacks[fallback], expr, timeout
+            )
+
+            if not done:
+                simple = sp.sympify(expr)
+
+        return simple, finished
+
+    def simple_q_timed(self, timeout=10, fallback="cancel", workers=None):
+        """Simplify each t, x, y, z of every state as a separate task with its own timeout.
+           Runaway terms get the fallback: expand, cancel, or none.
+           Returns the states and a [t, x, y, z] list of which terms were fully simplified."""
+
+        terms = [term for q in self.qs for term in [q.t, q.x, q.y, q.z]]
+        n_terms = len(terms)
+
+        if workers is None:
+            workers = QHStates.PARALLEL["workers"]
+
+        if workers is True:
+            workers = os.cpu_count()
+
+        if workers and workers > 1:
+            results = QHStates._parallel_map(
+                QHStates._simple_component,
+                terms,
+                [timeout] * n_terms,
+                [fallback] * n_terms,
+                workers=workers,
+            )
+
+        else:
+            results = [
+                QHStates._simple_component(term, timeout, fallback) for term in terms
+            ]
+
+        new_states, simplified = [], []
+
+        for n, q in enumerate(self.qs):
+            state_results = results[4 * n : 4 * n + 4]
+
+            new_q = QH(qtype=q.qtype, representation=q.representation)
+            new_q.t, new_q.x, new_q.y, new_q.z = [term for term, _ in state_results]
+
+            new_states.append(new_q)
+            simplified.append([finished for _, finished in state_results])
+
+        simple_states = QHStates(
             new_states, qs_type=self.qs_type, rows=self.rows, columns=self.columns
         )
 
+        return simple_states, simplified
+
     def subs(self, symbol_value_dict, qtype="scalar"):
         """Substitutes values into ."""
 
@@ -2154,17 +3009,35 @@ class QHStates(QH):
             columns=self.columns,
         )
 
-    def orthonormalize(self):
-        """Given a quaternion series, resturn a normalized orthoganl basis."""
+    def orthonormalize(self, householder=False):
+        """Given a quaternion series, return a normalized orthogonal basis.
+           For an operator, the columns are taken as kets and go through a QR.
+           For a bra or ket, Gram-Schmidt makes each state orthogonal to all
+           the earlier ones as vectors in R^4, the scalar of p* q being 0.
+           States that depend on earlier ones come out as zero."""
 
-        last_q = self.qs.pop(0).normalize(math.sqrt(1 / self.dim))
-        orthonormal_qs = [last_q]
+        if self.qs_type == "op" and self.columns > 1:
+            return QHArray(self).orthonormalize(householder).states()
+
+        orthogonal_qs = []
 
         for q in self.qs:
-            qp = q.Euclidean_product(last_q)
-            orthonormal_q = q.dif(qp).normalize(math.sqrt(1 / self.dim))
-            orthonormal_qs.append(orthonormal_q)
-            last_q = orthonormal_q
+            # Keep the qtype short, nesting the earlier states' would double it.
+            gs_qtype = "{}_GS".format(q.qtype)
+
+            for e in orthogonal_qs:
+                e_norm_squared = e.norm_squared().t
+
+                if e_norm_squared == 0:
+                    continue
+
+                overlap = e.Euclidean_product(q).t
+                q = q.dif(e.product(QH([overlap / e_norm_squared, 0, 0, 0])))
+                q.qtype = gs_qtype
+
+            orthogonal_qs.append(q)
+
+        orthonormal_qs = [q.normalize(math.sqrt(1 / self.dim)) for q in orthogonal_qs]
 
         return QHStates(
             orthonormal_qs, qs_type=self.qs_type, rows=self.rows, columns=self.columns
@@ -2221,16 +3094,34 @@ class QHStates(QH):
             new_states, qs_type=self.qs_type, rows=self.rows, columns=self.columns
         )
 
-    def summation(self):
-        """Add them all up, return one quaternion."""
+    def summation(self, method="pairwise"):
+        """Add them all up, return one quaternion. Symbolic terms make one sympy Add,
+           integers are added exactly, floats use pairwise or kahan summation."""
 
-        result = None
+        return QHStates._sum_qs(self.qs, method)
 
-        for q in self.qs:
-            if result == None:
-                result = q
-            else:
-                result = result.add(q)
+    @staticmethod
+    def _sum_qs(qs, method="pairwise"):
+        """Sum a list of quaternions without a chain of QH.add calls."""
+
+        if not qs:
+            return None
+
+        for q in qs[1:]:
+            qs[0].check_representations(q)
+
+        terms = [[q.t, q.x, q.y, q.z] for q in qs]
+        integers = (int, np.integer, sp.Integer)
+
+        if any(q.is_symbolic() for q in qs):
+            total = [sp.Add(*column) for column in zip(*terms)]
+        elif all(isinstance(term, integers) for row in terms for term in row):
+            total = [sum(column) for column in zip(*terms)]
+        else:
+            total = [float(v) for v in QHArray.sum_terms(np.array(terms), method)]
+
+        result = QH(total, qtype="+".join(q.qtype for q in qs))
+        result.representation = qs[0].representation
 
         return result
 
@@ -2247,9 +3138,8 @@ class QHStates(QH):
         )
 
     def diagonal(self, dim):
-        """Make a state dim*dim with q or qs along the 'diagonal'. Always returns an operator."""
-
-        diagonal = []
+        """Make a state dim*dim with q or qs along the 'diagonal'. Always returns an operator.
+           Only the diagonal is stored, the zeroes are made if qs is asked for."""
 
         if len(self.qs) == 1:
             q_values = [self.qs[0]] * dim
@@ -2262,14 +3152,7 @@ class QHStates(QH):
             print("Oops, need the length to be equal to the dimensions.")
             return None
 
-        for i in range(dim):
-            for j in range(dim):
-                if i == j:
-                    diagonal.append(q_values.pop(0))
-                else:
-                    diagonal.append(QH().q_0())
-
-        return QHStates(diagonal, qs_type="op", rows=dim, columns=dim)
+        return QHStatesDiagonal(q_values)
 
     def trace(self):
         """Return the trace as a scalar quaternion series."""
@@ -2278,13 +3161,9 @@ class QHStates(QH):
             print("Oops, not a square quaternion series.")
             return None
 
-        else:
-            trace = self.qs[0]
-
-        for i in range(1, self.rows):
-            trace = trace.add(self.qs[i * (self.rows + 1)])
+        diagonal = [self._q_at(i * (self.rows + 1)) for i in range(self.rows)]
 
-        return QHStates([trace])
+        return QHStates([QHStates._sum_qs(diagonal)])
 
     @staticmethod
     def identity(dim, operator=False, additive=False, non_zeroes=None, qs_type="ket"):
@@ -2326,8 +3205,9 @@ class QHStates(QH):
     def product(self, q1, kind="", reverse=False):
         """Forms the quaternion product for each state."""
 
-        self_copy = deepcopy(self)
-        q1_copy = deepcopy(q1)
+        # Nothing here changes the states, so no copies are needed.
+        self_copy = self
+        q1_copy = q1
 
         # Diagonalize if need be.
         if ((self.rows == q1.rows) and (self.columns == q1.columns)) or (
@@ -2359,6 +3239,12 @@ class QHStates(QH):
             )
             return None
 
+        # A diagonal operator on either side only needs its diagonal.
+        if isinstance(qs_left, QHStatesDiagonal) or isinstance(
+            qs_right, QHStatesDiagonal
+        ):
+            return QHStatesDiagonal.sparse_product(qs_left, qs_right, kind, reverse)
+
         # Operator products need to be transposed.
         operator_flag = False
         if qs_left in ["op", "operator"] and qs_right in ["op", "operator"]:
@@ -2393,8 +3279,8 @@ class QHStates(QH):
                     result[outer_row][outer_column] = result[outer_row][
                         outer_column
                     ].add(
-                        qs_left.qs[left_index].product(
-                            qs_right.qs[right_index], kind=kind, reverse=reverse
+                        qs_left._q_at(left_index).product(
+                            qs_right._q_at(right_index), kind=kind, reverse=reverse
                         )
                     )
 
@@ -2566,31 +3452,19 @@ class QHStates(QH):
             new_states, qs_type=self.qs_type, rows=self.rows, columns=self.columns
         )
 
-    def rotate(self, ket):
+    def rotate(self, ket, workers=None):
         """Rotate one state by another."""
 
-        new_states = []
-
-        for bra, k in zip(self.qs, ket.qs):
-            new_states.append(bra.rotate(k))
-
-        return QHStates(
-            new_states, qs_type=self.qs_type, rows=self.rows, columns=self.columns
-        )
+        return self._element_wise("rotate", others=[ket], workers=workers)
 
-    def rotation_and_or_boost(self, ket):
+    def rotation_and_or_boost(self, ket, workers=None):
         """Do state-by-state rotations or boosts."""
 
-        new_states = []
-
-        for bra, k in zip(self.qs, ket.qs):
-            new_states.append(bra.rotation_and_or_boost(k))
-
-        return QHStates(
-            new_states, qs_type=self.qs_type, rows=self.rows, columns=self.columns
+        return self._element_wise(
+            "rotation_and_or_boost", others=[ket], workers=workers
         )
 
-    def Lorentz_next_rotation(self, q1):
+    def Lorentz_next_rotation(self, q1, workers=None):
         """Does multiple rotations of a QHState given another QHState of equal dimensions."""
 
         if self.dim != q1.dim:
@@ -2599,16 +3473,9 @@ class QHStates(QH):
             )
             return null
 
-        new_states = []
-
-        for ket, q in zip(self.qs, q1.qs):
-            new_states.append(ket.Lorentz_next_rotation(q))
-
-        return QHStates(
-            new_states, qs_type=self.qs_type, rows=self.rows, columns=self.columns
-        )
+        return self._element_wise("Lorentz_next_rotation", others=[q1], workers=workers)
 
-    def Lorentz_next_boost(self, q1):
+    def Lorentz_next_boost(self, q1, workers=None):
         """Does multiple boosts of a QHState given another QHState of equal dimensions."""
 
         if self.dim != q1.dim:
@@ -2617,30 +3484,17 @@ class QHStates(QH):
             )
             return null
 
-        new_states = []
-
-        for ket, q in zip(self.qs, q1.qs):
-            new_states.append(ket.Lorentz_next_boost(q))
-
-        return QHStates(
-            new_states, qs_type=self.qs_type, rows=self.rows, columns=self.columns
-        )
+        return self._element_wise("Lorentz_next_boost", others=[q1], workers=workers)
 
-    def g_shift(self, g_factor, g_form="exp"):
+    def g_shift(self, g_factor, g_form="exp", workers=None):
         """Do the g_shift to each state."""
 
-        new_states = []
-
-        for bra in self.qs:
-            new_states.append(bra.g_shift(g_factor, g_form))
-
-        return QHStates(
-            new_states, qs_type=self.qs_type, rows=self.rows, columns=self.columns
-        )
+        return self._element_wise("g_shift", g_factor, g_form, workers=workers)
 
     @staticmethod
-    def bracket(bra, op, ket):
-        """Forms <bra|op|ket>. Note: if fed 2 kets, will take a conjugate."""
+    def bracket(bra, op, ket, fused=False):
+        """Forms <bra|op|ket>. Note: if fed 2 kets, will take a conjugate.
+           With fused=True, numerical series are contracted in one pass by QHArray."""
 
         flip = 0
 
@@ -2655,6 +3509,9 @@ class QHStates(QH):
         if flip == 1:
             print("fed 2 bras or kets, took a conjugate. Double check.")
 
+        if fused:
+            return QHArray.bracket(bra, op, ket).states()
+
         b = bra.product(op).product(ket)
 
         return b
@@ -2700,17 +3557,10 @@ class QHStates(QH):
             new_states, qs_type=self.qs_type, rows=self.rows, columns=self.columns
         )
 
-    def square(self):
+    def square(self, workers=None):
         """The square of each state."""
 
-        new_states = []
-
-        for bra in self.qs:
-            new_states.append(bra.square())
-
-        return QHStates(
-            new_states, qs_type=self.qs_type, rows=self.rows, columns=self.columns
-        )
+        return self._element_wise("square", workers=workers)
 
     def norm_squared(self):
         """Take the inner product, returning a scalar series."""
@@ -2742,26 +3592,20 @@ class QHStates(QH):
         if m * n != self.dim:
             return None
 
-        matrix = [[0 for x in range(m)] for y in range(n)]
-        qs_t = []
+        # A view, nothing gets copied.
+        return QHStatesView(self, m, n)
 
-        for mi in range(m):
-            for ni in range(n):
-                matrix[ni][mi] = self.qs[mi * n + ni]
-
-        qs_t = []
+    def Hermitian_conj(self, m=None, n=None, conj_type=0):
+        """Returns the Hermitian conjugate, as a view that conjugates states when read."""
 
-        for t in matrix:
-            for q in t:
-                qs_t.append(q)
+        q_t = self.transpose(m, n)
 
-        # Switch rows and columns.
-        return QHStates(qs_t, rows=self.columns, columns=self.rows)
+        if q_t is None:
+            return None
 
-    def Hermitian_conj(self, m=None, n=None, conj_type=0):
-        """Returns the Hermitian conjugate."""
+        q_t.conj_type = conj_type
 
-        return self.transpose(m, n).conj(conj_type)
+        return q_t
 
     def dagger(self, m=None, n=None, conj_type=0):
         """Just calls Hermitian_conj()"""
@@ -2780,6 +3624,39 @@ class QHStates(QH):
 
         return self.equals(hc)
 
+    def eigh(self):
+        """Eigenvalues and eigenkets of a numerical Hermitian operator.
+           Returns a list of eigenvalues, smallest first, and a list of kets."""
+
+        eigen = QHArray(self).eigh()
+
+        if eigen is None:
+            return None
+
+        values, kets = eigen
+        eigenkets = [kets[:, i].states() for i in range(kets.columns)]
+
+        return [float(value) for value in values], eigenkets
+
+    def expm(self, t=1.0):
+        """The operator exponential exp(t op) of a numerical operator, as opposed to
+           exp() which works state by state."""
+
+        return QHArray(self).expm(t).states()
+
+    def expm_multiply(self, ket, t=1.0):
+        """exp(t op)|ket> without forming exp(t op), for time steps at large n."""
+
+        return QHArray.expm_multiply(self, QHArray(ket), t).states()
+
+    def power(self, n, cache=False):
+        """Raise a numerical operator to a whole number power by repeated squaring,
+           optionally caching the powers of this operator for later calls."""
+
+        result = QHArray(self).power(n, cache)
+
+        return None if result is None else result.states()
+
     @staticmethod
     def sigma(kind, theta=None, phi=None):
         """Returns a sigma when given a type like, x, y, z, xy, xz, yz, xyz, with optional angles theta and phi."""
@@ -2821,95 +3698,265 @@ class QHStates(QH):
 
         return sigma[kind].normalize()
 
-    def sin(self):
+    def sin(self, workers=None):
         """sine of states."""
 
-        new_states = []
-
-        for ket in self.qs:
-            new_states.append(ket.sin(qtype=""))
-
-        return QHStates(
-            new_states, qs_type=self.qs_type, rows=self.rows, columns=self.columns
-        )
+        return self._element_wise("sin", qtype="", workers=workers)
 
-    def cos(self):
+    def cos(self, workers=None):
         """cosine of states."""
 
-        new_states = []
+        return self._element_wise("cos", qtype="", workers=workers)
 
-        for ket in self.qs:
-            new_states.append(ket.cos(qtype=""))
+    def tan(self, workers=None):
+        """tan of states."""
 
-        return QHStates(
-            new_states, qs_type=self.qs_type, rows=self.rows, columns=self.columns
-        )
+        return self._element_wise("tan", qtype="", workers=workers)
 
-    def tan(self):
-        """tan of states."""
+    def sinh(self, workers=None):
+        """sinh of states."""
 
-        new_states = []
+        return self._element_wise("sinh", qtype="", workers=workers)
 
-        for ket in self.qs:
-            new_states.append(ket.tan(qtype=""))
+    def cosh(self, workers=None):
+        """cosh of states."""
 
-        return QHStates(
-            new_states, qs_type=self.qs_type, rows=self.rows, columns=self.columns
-        )
+        return self._element_wise("cosh", qtype="", workers=workers)
 
-    def sinh(self):
-        """sinh of states."""
+    def tanh(self, workers=None):
+        """tanh of states."""
 
-        new_states = []
+        return self._element_wise("tanh", qtype="", workers=workers)
 
-        for ket in self.qs:
-            new_states.append(ket.sinh(qtype=""))
+    def exp(self, workers=None):
+        """exponential of states."""
 
-        return QHStates(
-            new_states, qs_type=self.qs_type, rows=self.rows, columns=self.columns
-        )
+        return self._element_wise("exp", qtype="", workers=workers)
 
-    def cosh(self):
-        """cosh of states."""
+    def save(self, filename, dtype="float64"):
+        """Save the states in the binary QHArray format. Symbolic quaternions are stored
+           as nan in the array and as sp.srepr strings in a filename.srepr sidecar."""
 
-        new_states = []
+        values, symbolic = [], {}
 
-        for ket in self.qs:
-            new_states.append(ket.cosh(qtype=""))
+        for n, q in enumerate(self.qs):
+            if q.is_symbolic():
+                symbolic[n] = [sp.srepr(sp.sympify(v)) for v in [q.t, q.x, q.y, q.z]]
+                values.append([np.nan] * 4)
+            else:
+                values.append([q.t, q.x, q.y, q.z])
 
-        return QHStates(
-            new_states, qs_type=self.qs_type, rows=self.rows, columns=self.columns
+        representation = self.qs[0].representation if self.qs else ""
+
+        qharray = QHArray(
+            np.array(values, dtype=dtype),
+            qs_type=self.qs_type,
+            rows=self.rows,
+            columns=self.columns,
+            dtype=dtype,
         )
+        qharray.representation = representation
+        qharray.save(filename, symbolic=len(symbolic))
 
-    def tanh(self):
-        """tanh of states."""
+        if symbolic:
+            with open(filename + ".srepr", "w") as sidecar:
+                json.dump(symbolic, sidecar)
 
-        new_states = []
+    @staticmethod
+    def load(filename):
+        """Load states saved with save(), putting back any symbolic quaternions."""
 
-        for ket in self.qs:
-            new_states.append(ket.tanh(qtype=""))
+        states = QHArray.load(filename, mmap=False).states()
 
-        return QHStates(
-            new_states, qs_type=self.qs_type, rows=self.rows, columns=self.columns
-        )
+        if QHArray.read_header(filename)["symbolic"]:
+            with open(filename + ".srepr") as sidecar:
+                symbolic = json.load(sidecar)
 
-    def exp(self):
-        """exponential of states."""
+            for n, values in symbolic.items():
+                q = states.qs[int(n)]
+                q.t, q.x, q.y, q.z = [sp.sympify(v) for v in values]
 
-        new_states = []
+        return states
 
-        for ket in self.qs:
-            new_states.append(ket.exp(qtype=""))
 
-        return QHStates(
-            new_states, qs_type=self.qs_type, rows=self.rows, columns=self.columns
-        )
 
 
+# Transposes and Hermitian conjugates of big series need not copy anything. A QHStatesView records how to read the states of another series and only makes a list of them when qs is asked for.
 
 
 
-if __name__ == "__main__":
+
+class QHStatesView(QHStates):
+    """The transpose of a quaternion series, possibly conjugated, without a copy."""
+
+    def __init__(self, base, m, n, conj_type=None):
+
+        self.base = base
+        self.m, self.n = m, n
+        self.conj_type = conj_type
+        self._qs = None
+
+        self.qtype = ""
+        self.d, self.dim, self.dimensions = base.dim, base.dim, base.dim
+
+        # Switch rows and columns.
+        self.rows, self.columns = base.columns, base.rows
+        self.qs_type = "scalar" if self.dim == 1 else "ket"
+
+    @property
+    def qs(self):
+        """Make the list of states only when needed."""
+
+        if self._qs is None:
+            self._qs = [self._q_at(i) for i in range(self.dim)]
+
+        return self._qs
+
+    @qs.setter
+    def qs(self, qs):
+        self._qs = qs
+
+    def _q_at(self, i):
+        """Read the i-th state through the transpose and conjugate."""
+
+        if self._qs is not None:
+            return self._qs[i]
+
+        ni, mi = divmod(i, self.m)
+        q = self.base._q_at(mi * self.n + ni)
+
+        if self.conj_type is not None:
+            q = q.conj(self.conj_type)
+
+        return q
+
+    def materialize(self):
+        """Returns a plain QHStates with copies of the states."""
+
+        return QHStates(
+            list(self.qs), qs_type=self.qs_type, rows=self.rows, columns=self.columns
+        )
+
+
+
+
+# Diagonal operators like the identity are mostly zeroes. QHStatesDiagonal only stores the quaternions on the diagonal, and products with it skip the zeroes.
+
+
+
+
+class QHStatesDiagonal(QHStates):
+    """A square operator with quaternions only along the diagonal."""
+
+    def __init__(self, qs):
+
+        self.diagonal_qs = list(qs)
+        self._qs = None
+
+        n = len(self.diagonal_qs)
+
+        self.qtype = ""
+        self.rows, self.columns = n, n
+        self.d, self.dim, self.dimensions = n * n, n * n, n * n
+        self.qs_type = "scalar" if n == 1 else "op"
+
+    @property
+    def qs(self):
+        """Make the full list of states, zeroes and all, only when needed."""
+
+        if self._qs is None:
+            self._qs = [self._q_at(i) for i in range(self.dim)]
+
+        return self._qs
+
+    @qs.setter
+    def qs(self, qs):
+        self._qs = qs
+
+    def _q_at(self, i):
+        """The i-th state, a zero unless it is on the diagonal."""
+
+        if self._qs is not None:
+            return self._qs[i]
+
+        column, row = divmod(i, self.rows)
+
+        if row == column:
+            return self.diagonal_qs[row]
+
+        return QH().q_0()
+
+    @staticmethod
+    def sparse_product(qs_left, qs_right, kind="", reverse=False):
+        """The product of series with a diagonal operator on the left, right, or both.
+           Only the non-zero terms are multiplied."""
+
+        left_diagonal = isinstance(qs_left, QHStatesDiagonal)
+        right_diagonal = isinstance(qs_right, QHStatesDiagonal)
+
+        if left_diagonal and right_diagonal:
+            return QHStatesDiagonal(
+                [
+                    left.product(right, kind=kind, reverse=reverse)
+                    for left, right in zip(qs_left.diagonal_qs, qs_right.diagonal_qs)
+                ]
+            )
+
+        rows, columns = qs_left.rows, qs_right.columns
+
+        new_qs = []
+
+        # Same order of states as the dense product.
+        for row in range(rows):
+            for column in range(columns):
+                if left_diagonal:
+                    left = qs_left.diagonal_qs[row]
+                    right = qs_right._q_at(row + column * qs_right.rows)
+                else:
+                    left = qs_left._q_at(row + column * rows)
+                    right = qs_right.diagonal_qs[column]
+
+                new_qs.append(left.product(right, kind=kind, reverse=reverse))
+
+        return QHStates(new_qs, rows=rows, columns=columns)
+
+    def add(self, ket):
+        """Add two states, staying diagonal if both are."""
+
+        if isinstance(ket, QHStatesDiagonal) and self.rows == ket.rows:
+            return QHStatesDiagonal(
+                [q.add(k) for q, k in zip(self.diagonal_qs, ket.diagonal_qs)]
+            )
+
+        return super().add(ket)
+
+    def dif(self, ket):
+        """Take the difference of two states, staying diagonal if both are."""
+
+        if isinstance(ket, QHStatesDiagonal) and self.rows == ket.rows:
+            return QHStatesDiagonal(
+                [q.dif(k) for q, k in zip(self.diagonal_qs, ket.diagonal_qs)]
+            )
+
+        return super().dif(ket)
+
+    def inverse(self, additive=False):
+        """Inverse each quaternion on the diagonal."""
+
+        return QHStatesDiagonal(
+            [q.inverse(additive=additive) for q in self.diagonal_qs]
+        )
+
+    def trace(self):
+        """Return the trace as a scalar quaternion series."""
+
+        return QHStates([QHStates._sum_qs(self.diagonal_qs)])
+
+
+
+
+
+if __name__ == "__main__":
 
     class TestQHStates(unittest.TestCase):
         """Test states."""
@@ -3131,6 +4178,12 @@ if __name__ == "__main__":
             print("sum: ", q_01_sum)
             self.assertTrue(type(q_01_sum) is QH)
             self.assertTrue(q_01_sum.t == 1)
+            t, x = sp.symbols("t x")
+            q_sym = QHStates([QH([t, x, 0, 1])] * 50).summation()
+            print("symbolic sum: ", q_sym)
+            self.assertEqual(q_sym.t, 50 * t)
+            self.assertEqual(q_sym.z, 50)
+            self.assertTrue(isinstance(q_sym.z, sp.Integer))
 
         def test_1100_add(self):
             q_0110_add = self.q_0_q_1.add(self.q_1_q_0)
@@ -3150,6 +4203,35 @@ if __name__ == "__main__":
             self.assertTrue(Op4iDiag2.qs[0].equals(self.q_i4))
             self.assertTrue(Op4iDiag2.qs[1].equals(QH().q_0()))
 
+        def test_1121_diagonal_products(self):
+            diagonal = self.k.diagonal(3)
+            self.assertTrue(type(diagonal) is QHStatesDiagonal)
+            self.assertEqual(diagonal.qs_type, "op")
+            dense = QHStates(list(diagonal.qs), "op")
+            op_9 = self.vv9.op(3, 3)
+            self.assertTrue(diagonal.product(op_9).equals(dense.product(op_9)))
+            self.assertTrue(op_9.product(diagonal).equals(op_9.product(dense)))
+            self.assertTrue(diagonal.product(self.k).equals(dense.product(self.k)))
+            self.assertTrue(self.b.product(diagonal).equals(self.b.product(dense)))
+            dd = diagonal.product(diagonal)
+            print("diagonal squared: ", dd)
+            self.assertTrue(type(dd) is QHStatesDiagonal)
+            self.assertTrue(dd.equals(dense.product(dense)))
+            scaled = QHStates([self.q_i4]).product(self.q_1234)
+            print("scalar times ket: ", scaled)
+            self.assertTrue(scaled.qs[3].equals(QH([-4, 16, 0, 0])))
+
+        def test_1122_diagonal_add_inverse(self):
+            diagonal = self.k.diagonal(3)
+            doubled = QHStates([self.q_2]).diagonal(3).product(diagonal)
+            self.assertTrue(diagonal.add(diagonal).equals(doubled))
+            self.assertTrue(type(diagonal.dif(diagonal)) is QHStatesDiagonal)
+            inverse = diagonal.inverse()
+            print("diagonal inverse: ", inverse)
+            identity = QHStates().identity(3, operator=True)
+            self.assertTrue(inverse.product(diagonal).equals(identity))
+            self.assertTrue(diagonal.trace().equals(QHStates([QH([15, 0, 0, 0])])))
+
         def test_1125_trace(self):
             trace = self.v1123.op(2, 2).trace()
             print("trace: ", trace)
@@ -3412,6 +4494,12 @@ if __name__ == "__main__":
             self.assertTrue(opt.qs[3].t == 4)
             optt = self.q_1234.transpose().transpose()
             self.assertTrue(optt.equals(self.q_1234))
+            self.assertTrue(type(opt) is QHStatesView)
+            self.assertTrue(self.q_1234.transpose()._qs is None)
+            opt6 = self.q_6_op_32.transpose(3, 2)
+            self.assertTrue(opt6.qs[1].equals(self.q_0))
+            self.assertTrue(opt6.qs[4].equals(self.q_1))
+            self.assertTrue(opt6.qs[2].equals(self.q_i))
 
         def test_1330_Hermitian_conj(self):
             q_hc = self.q_1234.Hermitian_conj()
@@ -3429,14 +4517,3815 @@ if __name__ == "__main__":
             self.assertTrue(self.sigma_y.is_Hermitian())
             self.assertFalse(self.q_1234.is_Hermitian())
 
+        def test_1345_dagger_product(self):
+            op_1234 = self.q_1234.op(2, 2)
+            q_d = op_1234.dagger()
+            product = op_1234.product(q_d)
+            self.assertTrue(q_d._qs is None)
+            self.assertTrue(product.equals(op_1234.product(q_d.materialize())))
+            self.assertTrue(q_d.dagger().equals(self.q_1234))
+
+        def test_1347_orthonormalize(self):
+            ortho = self.q_1234.orthonormalize()
+            print("orthonormalize: ", ortho)
+            self.assertEqual(self.q_1234.dim, 4)
+            self.assertEqual(ortho.dim, 4)
+            self.assertTrue(ortho.qs[0].equals(self.q_1234.qs[0].normalize(0.5)))
+
+            ket = QHStates([QH([1, 2, 3, 4]), QH([2, 0, 1, 1]), QH([0, 1, -1, 3])])
+            ortho = ket.orthonormalize()
+            first = QH([1, 2, 3, 4]).normalize(math.sqrt(1 / 3))
+            self.assertTrue(ortho.qs[0].equals(first))
+            for n, p in enumerate(ortho.qs):
+                self.assertAlmostEqual(p.norm_squared().t, 1 / 3)
+                for q in ortho.qs[n + 1 :]:
+                    self.assertAlmostEqual(p.Euclidean_product(q).t, 0)
+            self.assertTrue(ket.qs[1].equals(QH([2, 0, 1, 1])))
+
+            rng = np.random.default_rng(33)
+            long_ket = QHStates([QH(list(q)) for q in rng.normal(size=(40, 4))])
+            long_ortho = long_ket.orthonormalize()
+            self.assertTrue(len(long_ortho.qs[-1].qtype) < 20)
+            self.assertAlmostEqual(
+                long_ortho.qs[1].Euclidean_product(long_ortho.qs[3]).t, 0
+            )
+
         def test_1350_is_square(self):
             self.assertFalse(self.Op.is_square())
             self.assertTrue(self.Op_scalar.is_square())
 
+        def test_1360_parallel(self):
+            states = QHStates([self.q1234, self.qsmall, self.q4321] * 30)
+            hs = QHStates([self.qsmall, self.q2222, self.q1234] * 30)
+            self.assertTrue(states.exp(workers=2).equals(states.exp()))
+            self.assertTrue(states.conj(1, workers=2).equals(states.conj(1)))
+            boosts = states.rotation_and_or_boost(hs, workers=2)
+            print("parallel boosts: ", boosts.qs[0])
+            self.assertTrue(boosts.equals(states.rotation_and_or_boost(hs)))
+            self.assertTrue(boosts.qs[3].equals(boosts.qs[0]))
+            small = self.q2_states.g_shift(0.003, workers=2)
+            self.assertTrue(small.equals(self.q2_states.g_shift(0.003)))
+            self.assertTrue(QHStates._executors)
+            QHStates.shutdown()
+            self.assertEqual(QHStates._executors, {})
+
+            # A lambda can't be pickled for the pool, so it runs serially.
+            doubled = QHStates._parallel_map(lambda n: 2 * n, [1, 2, 3], workers=2)
+            self.assertEqual(doubled, [2, 4, 6])
+            self.assertEqual(QHStates._executors, {})
+
+            # Errors from the method itself are not run again serially.
+            with self.assertRaises(ValueError):
+                QHStates._parallel_map(math.sqrt, [4, -1], workers=2)
+            self.assertTrue(QHStates._executors)
+            QHStates.shutdown()
+
+        def test_1365_simple_q_timed(self):
+            t, x = sp.symbols("t x")
+            messy = (x ** 2 - 1) / (x - 1) + sp.sin(t) ** 2 + sp.cos(t) ** 2
+            states = QHStates([QH([messy, 2 * x, 0, sp.cosh(t) ** 2 - sp.sinh(t) ** 2])])
+            simple, simplified = states.simple_q_timed(timeout=60, workers=2)
+            print("simple_q_timed: ", simple)
+            self.assertEqual(simplified, [[True, True, True, True]])
+            self.assertEqual(simple.qs[0].t, x + 2)
+            self.assertEqual(simple.qs[0].z, 1)
+
+            # A runaway sp.simplify, and then a runaway fallback too.
+            def slow(expr):
+                time.sleep(5)
+
+            timed = lambda: states.simple_q_timed(0.2, "expand", workers=1)
+            simplify, expand = sp.simplify, sp.expand
+            try:
+                sp.simplify = slow
+                cheap, simplified = timed()
+                print("simple_q_timed, expanded: ", cheap)
+                self.assertFalse(simplified[0][0])
+                self.assertEqual(cheap.qs[0].t, expand(messy))
+                sp.expand = slow
+                kept, simplified = timed()
+            finally:
+                sp.simplify, sp.expand = simplify, expand
+            self.assertFalse(simplified[0][0])
+            self.assertEqual(kept.qs[0].t, messy)
+
     suite = unittest.TestLoader().loadTestsFromModule(TestQHStates())
     _results = unittest.TextTestRunner().run(suite)
 
 
+# ## QHArray - numerical quaternion series in a numpy array
+
+# QHStates keeps a list of QH objects, great for symbolic work but costly for big numerical series. QHArray holds the states as one (rows, columns, 4) numpy array. Given a filename, the array is memory-mapped to disk so operators too large for RAM can be streamed through memory in blocks.
+
+
+
+
+class QHArray(object):
+    """Many numerical quaternions held in a (rows, columns, 4) numpy array."""
+
+    QS_TYPES = QHStates.QS_TYPES
+
+    # Edge length of the tiles streamed through memory by block-wise methods.
+    BLOCK = 1024
+    _tensors = {}
+
+    # Operator powers kept around by power(cache=True), oldest used first out.
+    POWER_CACHE_SIZE = 32
+    _powers = OrderedDict()
+
+    def __init__(
+        self,
+        values=None,
+        qs_type="",
+        rows=0,
+        columns=0,
+        filename=None,
+        mode="r+",
+        dtype=None,
+    ):
+
+        if values is None and filename is not None and not rows:
+            # Open an existing array on disk, only reading the tiles asked for.
+            a = np.load(filename, mmap_mode=mode)
+
+        else:
+            if values is None:
+                a = np.zeros((rows, columns, 4), dtype=dtype or np.float64)
+
+            elif isinstance(values, QHStates):
+                a = QHArray._states_2_array(values)
+
+            elif isinstance(values, np.ndarray):
+                # Float arrays keep their dtype, so float32 and memmaps pass through.
+                if dtype is None:
+                    floating = np.issubdtype(values.dtype, np.floating)
+                    dtype = values.dtype if floating else np.float64
+
+                a = values if values.dtype == dtype else values.astype(dtype)
+
+            else:
+                a = np.array(
+                    [[q.t, q.x, q.y, q.z] for q in values], dtype=dtype or np.float64
+                )
+
+            if a.ndim == 2:
+                if not (rows and columns):
+                    rows, columns = (1, len(a)) if qs_type == "bra" else (len(a), 1)
+
+                # Series are listed column by column, as QHStates.product expects.
+                a = a.reshape(columns, rows, 4).transpose(1, 0, 2)
+
+            if filename is not None:
+                disk = np.lib.format.open_memmap(
+                    filename, mode="w+", dtype=a.dtype, shape=a.shape
+                )
+                disk[...] = a
+                a = disk
+
+        self.a = a
+        self.rows, self.columns = a.shape[0], a.shape[1]
+        self.d, self.dim, self.dimensions = (self.rows * self.columns,) * 3
+        self.filename = filename
+        self.representation = ""
+        self.qs_type = qs_type if qs_type else self._guess_qs_type()
+
+        if self.qs_type not in self.QS_TYPES:
+            print(
+                "Oops, only know of these quaternion series types: {}".format(
+                    self.QS_TYPES
+                )
+            )
+
+    def _guess_qs_type(self):
+        """Figure out a qs_type from the shape."""
+
+        if self.dim == 1:
+            return "scalar"
+        elif self.rows == 1:
+            return "bra"
+        elif self.columns == 1:
+            return "ket"
+        else:
+            return "op"
+
+    @staticmethod
+    def _states_2_array(states):
+        """Put the column-by-column list of a QHStates into a (rows, columns, 4) array."""
+
+        a = np.array([[q.t, q.x, q.y, q.z] for q in states.qs], dtype=np.float64)
+
+        return a.reshape(states.columns, states.rows, 4).transpose(1, 0, 2)
+
+    def states(self):
+        """Returns a QHStates with the same quaternions, loading them all into memory."""
+
+        flat = np.asarray(self.a).transpose(1, 0, 2).reshape(-1, 4)
+        qs = []
+
+        for q in flat:
+            qs.append(QH([float(v) for v in q]))
+            qs[-1].representation = self.representation
+
+        return QHStates(qs, qs_type=self.qs_type, rows=self.rows, columns=self.columns)
+
+    def __str__(self, quiet=False):
+        """Print out all the states."""
+
+        return self.states().__str__(quiet)
+
+    def print_state(self, label, spacer=True, quiet=True):
+        """Utility for printing states as a quaternion series."""
+
+        self.states().print_state(label, spacer, quiet)
+
+    def __getitem__(self, key):
+        """Lazy slicing over rows and columns. Memory-mapped arrays stay on disk."""
+
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+
+        # Keep two axes around, so a row or column is still a bra or ket.
+        key = [
+            self._index_slice(k, length) if isinstance(k, numbers.Integral) else k
+            for k, length in zip(key, [self.rows, self.columns])
+        ]
+
+        sliced = QHArray(self.a[key[0], key[1]], dtype=self.a.dtype)
+        sliced.representation = self.representation
+
+        return sliced
+
+    @staticmethod
+    def _index_slice(k, length):
+        """An integer index, numpy ones or negative ones too, as a slice of 1."""
+
+        k = operator.index(k)
+
+        if not -length <= k < length:
+            raise IndexError("Oops, index {} is out of range for {}.".format(k, length))
+
+        k %= length
+
+        return slice(k, k + 1)
+
+    def flush(self):
+        """Write any changes of a memory-mapped array to disk."""
+
+        if hasattr(self.a, "flush"):
+            self.a.flush()
+
+    def _new_like(self, rows, columns, qs_type="", filename=None):
+        """An empty array for results, in memory or on disk."""
+
+        return QHArray(
+            rows=rows,
+            columns=columns,
+            qs_type=qs_type,
+            filename=filename,
+            dtype=self.a.dtype,
+        )
+
+    def _blocks(self, n, block=None):
+        """Slices of length block covering range(n)."""
+
+        block = block or self.BLOCK
+
+        return [slice(i, min(i + block, n)) for i in range(0, n, block)]
+
+    @staticmethod
+    def _products(a, b, kind="", reverse=False):
+        """Quaternion products of (..., 4) arrays, broadcasting like numpy."""
+
+        if kind == "" and not reverse:
+            return qh_kernels.product(a, b)
+
+        at, ax, ay, az = a[..., 0], a[..., 1], a[..., 2], a[..., 3]
+        bt, bx, by, bz = b[..., 0], b[..., 1], b[..., 2], b[..., 3]
+
+        return QHArray._combine(
+            at * bt - (ax * bx + ay * by + az * bz),
+            at * bx + ax * bt,
+            at * by + ay * bt,
+            at * bz + az * bt,
+            ay * bz - az * by,
+            az * bx - ax * bz,
+            ax * by - ay * bx,
+            kind,
+            reverse,
+        )
+
+    @staticmethod
+    def _matmul(a, b, kind="", reverse=False):
+        """Quaternion matrix product of (m, k, 4) and (k, n, 4) arrays."""
+
+        at, ax, ay, az = a[..., 0], a[..., 1], a[..., 2], a[..., 3]
+        bt, bx, by, bz = b[..., 0], b[..., 1], b[..., 2], b[..., 3]
+
+        return QHArray._combine(
+            at @ bt - (ax @ bx + ay @ by + az @ bz),
+            at @ bx + ax @ bt,
+            at @ by + ay @ bt,
+            at @ bz + az @ bt,
+            ay @ bz - az @ by,
+            az @ bx - ax @ bz,
+            ax @ by - ay @ bx,
+            kind,
+            reverse,
+        )
+
+    @staticmethod
+    def _combine(t, x, y, z, odd_x, odd_y, odd_z, kind="", reverse=False):
+        """Stack the even and odd parts of a product depending on the kind."""
+
+        if reverse:
+            odd_x, odd_y, odd_z = -odd_x, -odd_y, -odd_z
+
+        zero = np.zeros_like(t)
+
+        if kind == "":
+            parts = [t, x + odd_x, y + odd_y, z + odd_z]
+        elif kind.lower() == "even":
+            parts = [t, x, y, z]
+        elif kind.lower() == "odd":
+            parts = [zero, odd_x, odd_y, odd_z]
+        elif kind.lower() == "even_minus_odd":
+            parts = [t, x - odd_x, y - odd_y, z - odd_z]
+        else:
+            raise Exception(
+                "Four 'kind' values are known: '', 'even', 'odd', and 'even_minus_odd'."
+            )
+
+        return np.stack(parts, axis=-1)
+
+    REPRESENTATIONS = ["", "polar", "spherical"]
+
+    @staticmethod
+    def txyz_2_polar(a):
+        """(amplitude, thetaX, thetaY, thetaZ) for (..., 4) arrays, as QH does it."""
+
+        a = np.asarray(a, dtype=np.float64)
+        abs_v = np.sqrt(np.sum(a[..., 1:] ** 2, axis=-1))
+        theta = np.arctan2(abs_v, a[..., 0])
+        scale = np.divide(theta, abs_v, out=np.zeros_like(theta), where=abs_v != 0)
+
+        return np.concatenate(
+            [
+                np.sqrt(np.sum(a ** 2, axis=-1))[..., np.newaxis],
+                a[..., 1:] * scale[..., np.newaxis],
+            ],
+            axis=-1,
+        )
+
+    @staticmethod
+    def polar_2_txyz(a):
+        """Cartesian txyz from (amplitude, thetaX, thetaY, thetaZ) arrays."""
+
+        a = np.asarray(a, dtype=np.float64)
+        amplitude = a[..., 0]
+        theta = np.sqrt(np.sum(a[..., 1:] ** 2, axis=-1))
+        sin_over_theta = np.divide(
+            np.sin(theta), theta, out=np.zeros_like(theta), where=theta != 0
+        )
+
+        return np.concatenate(
+            [
+                (amplitude * np.cos(theta))[..., np.newaxis],
+                a[..., 1:] * (amplitude * sin_over_theta)[..., np.newaxis],
+            ],
+            axis=-1,
+        )
+
+    @staticmethod
+    def txyz_2_spherical(a):
+        """(t, R, theta, phi) for (..., 4) arrays, as QH does it."""
+
+        a = np.asarray(a, dtype=np.float64)
+        R = np.sqrt(np.sum(a[..., 1:] ** 2, axis=-1))
+        cos_theta = np.divide(a[..., 3], R, out=np.ones_like(R), where=R != 0)
+
+        return np.stack(
+            [
+                a[..., 0],
+                R,
+                np.arccos(np.clip(cos_theta, -1, 1)),
+                np.arctan2(a[..., 2], a[..., 1]),
+            ],
+            axis=-1,
+        )
+
+    @staticmethod
+    def spherical_2_txyz(a):
+        """Cartesian txyz from (t, R, theta, phi) arrays."""
+
+        a = np.asarray(a, dtype=np.float64)
+        t, R, theta, phi = a[..., 0], a[..., 1], a[..., 2], a[..., 3]
+
+        return np.stack(
+            [
+                t,
+                R * np.sin(theta) * np.cos(phi),
+                R * np.sin(theta) * np.sin(phi),
+                R * np.cos(theta),
+            ],
+            axis=-1,
+        )
+
+    def representation_2_txyz(self):
+        """The same states in Cartesian txyz."""
+
+        if self.representation == "":
+            return self
+
+        to_txyz = {"polar": self.polar_2_txyz, "spherical": self.spherical_2_txyz}
+
+        return QHArray(to_txyz[self.representation](self.a), qs_type=self.qs_type)
+
+    def txyz_2_representation(self, representation):
+        """The same states in another representation, converted all at once."""
+
+        if representation not in self.REPRESENTATIONS:
+            print("Oops, don't know representation: ", representation)
+            return None
+
+        txyz = self.representation_2_txyz()
+
+        if representation == "":
+            return txyz
+
+        from_txyz = {"polar": self.txyz_2_polar, "spherical": self.txyz_2_spherical}
+        result = QHArray(from_txyz[representation](txyz.a), qs_type=self.qs_type)
+        result.representation = representation
+
+        return result
+
+    @staticmethod
+    def _unit_axes(v, norm):
+        """Unit vectors along v, zero where the norm is zero."""
+
+        norm = norm[..., np.newaxis]
+
+        return np.divide(v, norm, out=np.zeros_like(v), where=norm > 0)
+
+    @staticmethod
+    def polar_product(a, b):
+        """Quaternion products of two polar (..., 4) arrays, composed in polar
+           form: the amplitudes multiply. When the angle vectors are parallel
+           (or one is zero) the logarithms add, so the angles are not wrapped:
+           (1, 2)(1, 2.5) is (1, 4.5). Otherwise the angle and axis come from the
+           closed-form composition of exp(alpha u) exp(beta w), with the angle
+           on the principal branch [0, pi]."""
+
+        a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+        amplitude = a[..., 0] * b[..., 0]
+        va, vb = np.broadcast_arrays(a[..., 1:], b[..., 1:])
+        alpha, beta = np.linalg.norm(va, axis=-1), np.linalg.norm(vb, axis=-1)
+        u, w = QHArray._unit_axes(va, alpha), QHArray._unit_axes(vb, beta)
+        uw_cross = np.cross(u, w)
+        parallel = np.linalg.norm(uw_cross, axis=-1) <= 1e-12
+
+        sin_a, cos_a = np.sin(alpha), np.cos(alpha)
+        sin_b, cos_b = np.sin(beta), np.cos(beta)
+        cos_gamma = cos_a * cos_b - sin_a * sin_b * np.sum(u * w, axis=-1)
+        axis = (
+            (sin_a * cos_b)[..., np.newaxis] * u
+            + (cos_a * sin_b)[..., np.newaxis] * w
+            + (sin_a * sin_b)[..., np.newaxis] * uw_cross
+        )
+        sin_gamma = np.linalg.norm(axis, axis=-1)
+        gamma = np.arctan2(sin_gamma, cos_gamma)
+        composed = QHArray._unit_axes(axis, sin_gamma) * gamma[..., np.newaxis]
+
+        angles = np.where(parallel[..., np.newaxis], va + vb, composed)
+
+        return np.concatenate([amplitude[..., np.newaxis], angles], axis=-1)
+
+    @staticmethod
+    def polar_conj(a):
+        """The conjugate of polar arrays: same amplitude, opposite angle vector."""
+
+        return np.asarray(a, dtype=np.float64) * np.array([1, -1, -1, -1])
+
+    def equals(self, q1):
+        """Test if two arrays are equal."""
+
+        if (self.rows, self.columns) != (q1.rows, q1.columns):
+            return False
+
+        return all(
+            np.allclose(self.a[rows], q1.a[rows]) for rows in self._blocks(self.rows)
+        )
+
+    def conj(self, conj_type=0):
+        """Take the conjugates of states, default is zero, but also can do 1 or 2."""
+
+        if self.representation == "polar" and conj_type == 0:
+            result = QHArray(
+                self.polar_conj(self.a), qs_type=self.qs_type, dtype=self.a.dtype
+            )
+            result.representation = "polar"
+            return result
+
+        if self.representation:
+            return (
+                self.representation_2_txyz()
+                .conj(conj_type)
+                .txyz_2_representation(self.representation)
+            )
+
+        signs = {0: [1, -1, -1, -1], 1: [-1, 1, -1, -1], 2: [-1, -1, 1, -1]}
+
+        return QHArray(
+            self.a * np.array(signs[conj_type], dtype=self.a.dtype),
+            qs_type=self.qs_type,
+            dtype=self.a.dtype,
+        )
+
+    def add(self, q1, block=None, filename=None):
+        """Add two arrays, block by block."""
+
+        return self._element_wise(q1, np.add, block, filename)
+
+    def dif(self, q1, block=None, filename=None):
+        """Take the difference of two arrays, block by block."""
+
+        return self._element_wise(q1, np.subtract, block, filename)
+
+    def _element_wise(self, q1, ufunc, block=None, filename=None):
+        """Stream rows of both arrays through ufunc."""
+
+        if (self.rows != q1.rows) or (self.columns != q1.columns):
+            print("Oops, can only add if rows and columns are the same.")
+            print(
+                "rows are: {}/{}, columns are: {}/{}".format(
+                    self.rows, q1.rows, self.columns, q1.columns
+                )
+            )
+            return None
+
+        result = self._new_like(self.rows, self.columns, self.qs_type, filename)
+
+        for rows in self._blocks(self.rows, block):
+            result.a[rows] = ufunc(self.a[rows], q1.a[rows])
+
+        return result
+
+    def product(self, q1, kind="", reverse=False, block=None, filename=None):
+        """Quaternion product of two arrays. Same shaped bras or kets and scalars multiply
+           state by state, the rest is a matrix product done block by block."""
+
+        same_bra_or_ket = (self.rows, self.columns) == (q1.rows, q1.columns) and (
+            1 in [self.rows, self.columns]
+        )
+
+        if self.representation or q1.representation:
+            QH.check_representations(self, q1)
+
+            if self.representation == "polar" and kind == "" and not reverse:
+                if (self.dim == 1) or (q1.dim == 1) or same_bra_or_ket:
+                    result = QHArray(
+                        self.polar_product(self.a, q1.a),
+                        qs_type=self.qs_type if self.dim > 1 else q1.qs_type,
+                        dtype=self.a.dtype,
+                    )
+                    result.representation = "polar"
+                    return result
+
+            # Sums need txyz, so matrix products convert there and back.
+            return (
+                self.representation_2_txyz()
+                .product(q1.representation_2_txyz(), kind, reverse, block)
+                .txyz_2_representation(self.representation)
+            )
+
+        if (self.dim == 1) or (q1.dim == 1) or same_bra_or_ket:
+            return QHArray(
+                self._products(np.asarray(self.a), np.asarray(q1.a), kind, reverse),
+                qs_type=self.qs_type if self.dim > 1 else q1.qs_type,
+                dtype=self.a.dtype,
+            )
+
+        if self.columns != q1.rows:
+            print(
+                "Oops, cannot multiply series with row/column dimensions of {}/{} to {}/{}".format(
+                    self.rows, self.columns, q1.rows, q1.columns
+                )
+            )
+            return None
+
+        result = self._new_like(self.rows, q1.columns, filename=filename)
+
+        for rows in self._blocks(self.rows, block):
+            for columns in self._blocks(q1.columns, block):
+                tile = np.zeros(
+                    (rows.stop - rows.start, columns.stop - columns.start, 4),
+                    dtype=np.float64,
+                )
+
+                for inner in self._blocks(self.columns, block):
+                    tile += self._matmul(
+                        np.asarray(self.a[rows, inner], dtype=np.float64),
+                        np.asarray(q1.a[inner, columns], dtype=np.float64),
+                        kind,
+                        reverse,
+                    )
+
+                result.a[rows, columns] = tile
+
+        return result
+
+    @staticmethod
+    def _power_key(a):
+        """A hash of the terms of an operator, so changed operators miss the cache."""
+
+        a = np.ascontiguousarray(a, dtype=np.float64)
+        digest = hashlib.blake2b(a.tobytes(), digest_size=16)
+        digest.update(str(a.shape).encode())
+
+        return digest.hexdigest()
+
+    @staticmethod
+    def _cache_power(key, n, value):
+        """Store power n of the operator with this key in the LRU cache."""
+
+        QHArray._powers[(key, n)] = np.array(value)
+        QHArray._powers.move_to_end((key, n))
+
+        while len(QHArray._powers) > QHArray.POWER_CACHE_SIZE:
+            QHArray._powers.popitem(last=False)
+
+    def power(self, n, cache=False):
+        """Raise a square operator to a whole number power by repeated squaring.
+           With cache=True, powers are kept in an LRU cache keyed by a hash of the
+           terms of the operator, and a new power starts from the largest one
+           cached below it."""
+
+        if (self.rows != self.columns) or (n < 0) or (int(n) != n):
+            print("Oops, need a square operator and a power of 0 or more.")
+            return None
+
+        n = int(n)
+        a = np.asarray(self.a, dtype=np.float64)
+
+        start, result = 0, None
+
+        if cache:
+            key = self._power_key(a)
+            cached = [m for k, m in QHArray._powers if k == key and m <= n]
+
+            if cached:
+                start = max(cached)
+                result = QHArray._powers[(key, start)]
+                QHArray._powers.move_to_end((key, start))
+
+                if start == n:
+                    return QHArray(result.copy(), qs_type=self.qs_type)
+
+        remaining = n - start
+        square = a
+        squares = 1
+
+        while remaining:
+            if remaining & 1:
+                result = square if result is None else self._matmul(result, square)
+
+            remaining >>= 1
+
+            if remaining:
+                square = self._matmul(square, square)
+                squares *= 2
+
+                if cache and squares <= n:
+                    self._cache_power(key, squares, square)
+
+        if result is None:
+            result = np.zeros_like(a)
+            result[np.arange(self.rows), np.arange(self.rows), 0] = 1
+
+        if cache:
+            self._cache_power(key, n, result)
+
+        return QHArray(result.copy(), qs_type=self.qs_type)
+
+    @staticmethod
+    def clear_power_cache():
+        """Empty the cache of operator powers."""
+
+        QHArray._powers.clear()
+
+    @staticmethod
+    def _pairwise_sum(a):
+        """Sum the rows of an (n, 4) array by adding neighbours in pairs, so rounding
+           errors grow with log(n) rather than n."""
+
+        a = np.asarray(a, dtype=np.float64)
+
+        if len(a) == 0:
+            return np.zeros(a.shape[1:])
+
+        while len(a) > 1:
+            pairs = a[0:-1:2] + a[1::2]
+            a = np.concatenate([pairs, a[-1:]]) if len(a) % 2 else pairs
+
+        return a[0]
+
+    @staticmethod
+    def _kahan_sum(a, steps=1024):
+        """Neumaier's compensated sum of the rows of an (n, 4) array. The rows are
+           dealt into lanes which get summed side by side, steps rows deep, then the
+           sums of the lanes get summed the same way."""
+
+        a = np.asarray(a, dtype=np.float64)
+        lanes = max(1, -(-len(a) // steps))
+        padded = np.zeros((steps * lanes,) + a.shape[1:])
+        padded[: len(a)] = a
+
+        total = np.zeros((lanes,) + a.shape[1:])
+        compensation = np.zeros_like(total)
+
+        for row in padded.reshape((steps, lanes) + a.shape[1:]):
+            new_total = total + row
+            compensation += np.where(
+                np.abs(total) >= np.abs(row),
+                (total - new_total) + row,
+                (row - new_total) + total,
+            )
+            total = new_total
+
+        if lanes == 1:
+            return (total + compensation)[0]
+
+        return QHArray._kahan_sum(total + compensation, steps)
+
+    @staticmethod
+    def sum_terms(a, method="pairwise", block=None, workers=None):
+        """Sum the rows of an (n, 4) array with pairwise or kahan summation. Long
+           arrays are summed in chunks of block squared rows, on threads if workers
+           is more than 1 (numpy lets go of the GIL), and the chunk sums combined
+           the same way."""
+
+        sums = {"pairwise": QHArray._pairwise_sum, "kahan": QHArray._kahan_sum}
+
+        if method not in sums:
+            print("Oops, only know of these methods: {}".format(list(sums)))
+            return None
+
+        chunk = (block or QHArray.BLOCK) ** 2
+        chunks = [a[start : start + chunk] for start in range(0, len(a), chunk)]
+
+        if len(chunks) <= 1:
+            return sums[method](a)
+
+        if workers and workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                partials = list(executor.map(sums[method], chunks))
+        else:
+            partials = [sums[method](c) for c in chunks]
+
+        return sums[method](np.array(partials))
+
+    def summation(self, method="pairwise", block=None, workers=None):
+        """Add up all the states, returned as a scalar array."""
+
+        a = np.asarray(self.a).reshape(-1, 4)
+        total = self.sum_terms(a, method, block, workers)
+
+        return QHArray(total.reshape(1, 1, 4)) if total is not None else None
+
+    @staticmethod
+    def _unit(a):
+        """Normalize (..., 4) arrays to unit length, like QH.normalize()."""
+
+        norm = np.sqrt(np.sum(a ** 2, axis=-1))[..., np.newaxis]
+
+        return np.divide(a, norm, out=np.zeros_like(a), where=norm != 0)
+
+    @staticmethod
+    def _scan_lanes(lanes, keep=True, workers=None):
+        """Running products along the second axis of (lanes, depth, 4), all lanes
+           side by side, with workers taking groups of lanes on threads. Returns
+           the running products (or None) and the totals."""
+
+        if workers and workers > 1:
+            groups = np.array_split(np.arange(len(lanes)), workers)
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                scans = list(
+                    executor.map(
+                        lambda lanes_in: QHArray._scan_lanes(lanes[lanes_in], keep),
+                        groups,
+                    )
+                )
+
+            local = np.concatenate([s[0] for s in scans]) if keep else None
+
+            return local, np.concatenate([s[1] for s in scans])
+
+        running = lanes[:, 0].copy()
+        local = np.empty_like(lanes) if keep else None
+
+        if keep:
+            local[:, 0] = running
+
+        for k in range(1, lanes.shape[1]):
+            running = QHArray._products(running, lanes[:, k])
+
+            if keep:
+                local[:, k] = running
+
+        return local, running
+
+    @staticmethod
+    def _scan(a, final_only=False, workers=None):
+        """Prefix products q1, q1 q2, q1 q2 q3, ... of an (n, 4) array. The series
+           is cut into about sqrt(n) contiguous blocks scanned side by side, then
+           the block totals get scanned the same way and multiplied in from the
+           left, which works since the product is associative."""
+
+        n = len(a)
+
+        if n <= 1:
+            a = np.array(a, dtype=np.float64).reshape(-1, 4)
+            return a[-1] if final_only else a
+
+        width = max(math.isqrt(n), workers or 1)
+        depth = -(-n // width)
+
+        # Pad with 1's, which change no product.
+        padded = np.zeros((width * depth, 4))
+        padded[:n] = a
+        padded[n:, 0] = 1
+        lanes = padded.reshape(width, depth, 4)
+        local, totals = QHArray._scan_lanes(lanes, not final_only, workers)
+
+        if final_only:
+            return QHArray._scan(totals, True)
+
+        carries = QHArray._scan(totals)[:-1]
+        local[1:] = QHArray._products(carries[:, np.newaxis, :], local[1:])
+
+        return local.reshape(-1, 4)[:n]
+
+    @staticmethod
+    def _scan_renormalized(a, hook, every=1, final_only=False, workers=None):
+        """Prefix products with hook applied to the running product at steps 0,
+           every, 2 every, ... just as a serial loop would. Between hooks the
+           product is associative, so the segments of every steps are scanned
+           side by side (or one after the other with _scan when they are long),
+           then a short serial pass carries the hooked products from segment to
+           segment. The hook sees the same products for any number of workers."""
+
+        a = np.array(a, dtype=np.float64).reshape(-1, 4)
+        n = len(a)
+
+        if n <= 1:
+            a = hook(a)
+            return a[-1] if final_only else a
+
+        segments = -(-(n - 1) // every)
+
+        # Segment s holds steps s every + 1 to (s + 1) every, padded with 1's.
+        padded = np.zeros((segments * every, 4))
+        padded[: n - 1] = a[1:]
+        padded[n - 1 :, 0] = 1
+        lanes = padded.reshape(segments, every, 4)
+
+        if every <= segments:
+            local, totals = QHArray._scan_lanes(lanes, not final_only, workers)
+        else:
+            scans = [QHArray._scan(lane, final_only, workers) for lane in lanes]
+            local = None if final_only else np.stack(scans)
+            totals = np.stack(scans) if final_only else local[:, -1]
+
+        carries = np.empty((segments + 1, 4))
+        carries[0] = hook(a[0])
+
+        for s in range(segments):
+            carries[s + 1] = QHArray._products(carries[s], totals[s])
+
+            # A short last segment ends before the next hook.
+            if (s + 1) * every <= n - 1:
+                carries[s + 1] = hook(carries[s + 1])
+
+        if final_only:
+            return carries[-1]
+
+        prefixes = QHArray._products(carries[:-1, np.newaxis, :], local)
+        prefixes[:, -1] = carries[1:]
+
+        return np.concatenate([carries[:1], prefixes.reshape(-1, 4)[: n - 1]])
+
+    def cumulative_product(
+        self, renormalize=None, every=1, final_only=False, workers=None
+    ):
+        """All the prefix products q1, q1 q2, q1 q2 q3, ... of the states, in the
+           order of QHStates, as a ket, or with final_only just the whole product.
+           renormalize can be a function of (..., 4) arrays, or True to normalize
+           to unit length as QH.normalize() does. It is applied to the running
+           product at steps 0, every, 2 every, ... to control drift, the same
+           steps for any number of workers, which split the blocks over threads."""
+
+        a = np.asarray(self.a, dtype=np.float64).transpose(1, 0, 2).reshape(-1, 4)
+        hook = self._unit if renormalize is True else renormalize
+
+        if not hook:
+            prefixes = self._scan(a, final_only, workers)
+        else:
+            prefixes = self._scan_renormalized(a, hook, every, final_only, workers)
+
+        if final_only:
+            return QHArray(prefixes.reshape(1, 1, 4))
+
+        return QHArray(prefixes, qs_type="ket")
+
+    def trace(self, block=None):
+        """Return the trace as a scalar array, reading only the diagonal."""
+
+        if self.rows != self.columns:
+            print("Oops, not a square quaternion series.")
+            return None
+
+        partials = []
+
+        for diagonal in self._blocks(self.rows, block):
+            index = np.arange(diagonal.start, diagonal.stop)
+            partials.append(self._pairwise_sum(self.a[index, index]))
+
+        return QHArray(self._pairwise_sum(partials).reshape(1, 1, 4))
+
+    def astype(self, dtype, filename=None):
+        """A copy stored as another dtype, like np.float32 to halve the memory."""
+
+        result = QHArray(
+            rows=self.rows,
+            columns=self.columns,
+            qs_type=self.qs_type,
+            filename=filename,
+            dtype=dtype,
+        )
+
+        for rows in self._blocks(self.rows):
+            result.a[rows] = self.a[rows]
+
+        result.representation = self.representation
+
+        return result
+
+    def norm_squared(self, block=None):
+        """The sum of the squares of all the terms as a scalar array, accumulated
+           in float64 whatever the storage."""
+
+        norm = 0.0
+
+        for rows in self._blocks(self.rows, block):
+            norm += np.sum(np.asarray(self.a[rows], dtype=np.float64) ** 2)
+
+        return QHArray(np.array([[[norm, 0, 0, 0]]]))
+
+    @staticmethod
+    def _boost(q, h):
+        """QH.rotation_and_or_boost on arrays."""
+
+        h_conj = h * np.array([1, -1, -1, -1])
+        conj_signs = np.array([1, -1, -1, -1])
+
+        triple_1 = QHArray._products(QHArray._products(h, q), h_conj)
+        triple_2 = QHArray._products(QHArray._products(h, h), q) * conj_signs
+        triple_3 = QHArray._products(QHArray._products(h_conj, h_conj), q) * conj_signs
+
+        return triple_1 + 0.5 * (triple_2 - triple_3)
+
+    def rotation_and_or_boost(self, h, block=None, filename=None):
+        """A boost or rotation or both of every state by h, a QH or array that
+           broadcasts against the states. Works in float64, stores in the dtype."""
+
+        if isinstance(h, QH):
+            h = [h.t, h.x, h.y, h.z]
+
+        h = np.asarray(h, dtype=np.float64)
+        result = self._new_like(self.rows, self.columns, self.qs_type, filename)
+
+        for rows in self._blocks(self.rows, block):
+            h_rows = h[rows] if h.ndim == 3 else h
+            result.a[rows] = self._boost(
+                np.asarray(self.a[rows], dtype=np.float64), h_rows
+            )
+
+        return result
+
+    @staticmethod
+    def _g_factors(dimensionless_g, g_form="exp"):
+        """The g_shift factors for an array of g values, numpy unless symbolic."""
+
+        gs = np.asarray(dimensionless_g)
+
+        if g_form == "exp":
+            if gs.dtype == object:
+                return np.array([sp.exp(g) for g in gs.ravel()], dtype=object).reshape(
+                    gs.shape
+                )
+            return np.exp(gs.astype(np.float64))
+
+        elif g_form == "minimal":
+            return 1 + 2 * gs + 2 * gs ** 2
+
+        print("g_form not defined, should be 'exp' or 'minimal': {}".format(g_form))
+        return None
+
+    @staticmethod
+    def g_shifts(events, dimensionless_g, g_form="exp", block=None):
+        """QH.g_shift for every pair of an (N, 4) batch of events and (M,) g values.
+           Yields the slice of events done and its (n, M, 4) chunk of shifts, so
+           the (N, M, 4) total need not fit in memory. Object arrays of sympy
+           terms stay symbolic."""
+
+        events = np.asarray(events)
+        factors = QHArray._g_factors(dimensionless_g, g_form)
+
+        if factors is None:
+            return
+
+        factors = factors.reshape(-1)
+        dtype = object if object in [events.dtype, factors.dtype] else np.float64
+        block = block or QHArray.BLOCK
+
+        for start in range(0, len(events), block):
+            rows = slice(start, min(start + block, len(events)))
+            chunk = np.empty((rows.stop - start, len(factors), 4), dtype=dtype)
+            chunk[..., 0] = events[rows, np.newaxis, 0] / factors
+            chunk[..., 1:] = (
+                events[rows, np.newaxis, 1:] * factors[np.newaxis, :, np.newaxis]
+            )
+
+            yield rows, chunk
+
+    @staticmethod
+    def g_shift_grid(events, dimensionless_g, g_form="exp", block=None, filename=None):
+        """All of g_shifts in one (N, M, 4) array, memory-mapped if given a filename."""
+
+        events = np.asarray(events)
+        dimensionless_g = np.asarray(dimensionless_g).reshape(-1)
+        shape = (len(events), len(dimensionless_g), 4)
+        symbolic = object in [events.dtype, dimensionless_g.dtype]
+
+        if filename is not None and not symbolic:
+            grid = np.lib.format.open_memmap(
+                filename, mode="w+", dtype=np.float64, shape=shape
+            )
+        else:
+            grid = np.empty(shape, dtype=object if symbolic else np.float64)
+
+        for rows, chunk in QHArray.g_shifts(events, dimensionless_g, g_form, block):
+            grid[rows] = chunk
+
+        return grid
+
+    def Lorentz_by_rescaling(self, unscaled, block=None, filename=None):
+        """QH.Lorentz_by_rescaling for every state, given the unscaled results
+           of an operation. Each is rescaled to the interval of the state it came
+           from, with the same house rules for light-like intervals."""
+
+        result = self._new_like(self.rows, self.columns, self.qs_type, filename)
+
+        for rows in self._blocks(self.rows, block):
+            q = np.asarray(self.a[rows], dtype=np.float64)
+            u = np.asarray(unscaled.a[rows], dtype=np.float64)
+
+            q_interval = q[..., 0] ** 2 - np.sum(q[..., 1:] ** 2, axis=-1)
+            u_interval = u[..., 0] ** 2 - np.sum(u[..., 1:] ** 2, axis=-1)
+
+            q_light, u_light = q_interval == 0, u_interval == 0
+            rescale = ~q_light & ~u_light
+
+            scaling = np.ones_like(q_interval)
+            scaling[rescale] = np.sqrt(
+                np.abs(q_interval[rescale] / u_interval[rescale])
+            )
+
+            # Light-like to light-like keeps the result, a mix keeps the state.
+            keep = q_light != u_light
+            scaled = u * scaling[..., np.newaxis]
+            scaled[keep] = q[keep]
+            result.a[rows] = scaled
+
+        return result
+
+    def accuracy_report(self, h, dtype=np.float32):
+        """Compare rotation_and_or_boost and Lorentz_by_rescaling run on a copy
+           stored as dtype to the same in float64. Returns the largest absolute
+           and relative errors and the root mean square error of each."""
+
+        low = self.astype(dtype)
+        high = self.astype(np.float64)
+        boost_high = high.rotation_and_or_boost(h)
+        boost_low = low.rotation_and_or_boost(h)
+
+        report = {"dtype": np.dtype(dtype).name}
+
+        for name, high_result, low_result in [
+            ("rotation_and_or_boost", boost_high, boost_low),
+            (
+                "Lorentz_by_rescaling",
+                high.Lorentz_by_rescaling(boost_high),
+                low.Lorentz_by_rescaling(boost_low),
+            ),
+        ]:
+            exact = np.asarray(high_result.a, dtype=np.float64)
+            error = np.abs(np.asarray(low_result.a, dtype=np.float64) - exact)
+            size = np.maximum(np.abs(exact), np.finfo(np.float64).tiny)
+
+            report[name] = {
+                "max_abs": float(error.max()),
+                "max_rel": float((error / size)[np.abs(exact) > 0].max(initial=0)),
+                "rms": float(np.sqrt(np.mean(error ** 2))),
+            }
+
+        return report
+
+    def transpose(self, block=None, filename=None):
+        """Transposes an array, block by block."""
+
+        qs_type = {"bra": "ket", "ket": "bra"}.get(self.qs_type, self.qs_type)
+        result = self._new_like(self.columns, self.rows, qs_type, filename)
+
+        for rows in self._blocks(self.rows, block):
+            for columns in self._blocks(self.columns, block):
+                result.a[columns, rows] = np.asarray(self.a[rows, columns]).transpose(
+                    1, 0, 2
+                )
+
+        return result
+
+    @staticmethod
+    def _inner(u, v):
+        """Inner products <u|v> of the columns of (n, j, 4) and (n, k, 4) arrays."""
+
+        u_conj = u * np.array([1, -1, -1, -1], dtype=u.dtype)
+
+        return QHArray._matmul(u_conj.transpose(1, 0, 2), v)
+
+    def qr(self, householder=False):
+        """Quaternionic QR of the columns. Returns Q with orthonormal columns and upper
+           triangular R with a real, positive diagonal so self = Q R. Uses Gram-Schmidt
+           with each projection done twice, or Householder reflections which hold up
+           better for nearly dependent columns."""
+
+        a = np.array(self.a, dtype=np.float64)
+
+        if householder:
+            q, r = self._householder_qr(a)
+        else:
+            q, r = self._gram_schmidt_qr(a)
+
+        return QHArray(q), QHArray(r)
+
+    @staticmethod
+    def _gram_schmidt_qr(a):
+        """Project out the earlier columns all at once, twice over to stay orthogonal."""
+
+        n, k = a.shape[0], a.shape[1]
+        q = np.zeros((n, k, 4))
+        r = np.zeros((k, k, 4))
+
+        for j in range(k):
+            v = a[:, j : j + 1]
+
+            for _ in range(2):
+                r_j = QHArray._inner(q[:, :j], v)
+                v = v - QHArray._matmul(q[:, :j], r_j)
+                r[:j, j : j + 1] += r_j
+
+            norm = np.sqrt(np.sum(v ** 2))
+
+            if norm == 0:
+                print("Oops, column {} is dependent on the ones before.".format(j))
+                return q, r
+
+            q[:, j : j + 1] = v / norm
+            r[j, j, 0] = norm
+
+        return q, r
+
+    @staticmethod
+    def _householder_qr(a):
+        """Reflect each column onto the axis with I - 2 w w*, then build Q."""
+
+        n, k = a.shape[0], a.shape[1]
+        r = a.copy()
+        ws, phases = [], []
+        conj_signs = np.array([1, -1, -1, -1])
+
+        for j in range(k):
+            x = r[j:, j : j + 1]
+            norm = np.sqrt(np.sum(x ** 2))
+            lead = np.sqrt(np.sum(x[0, 0] ** 2))
+
+            # alpha = -(x_0 / |x_0|) |x| keeps w* x real, so the reflection works.
+            phase = x[0, 0] / lead if lead else np.array([1.0, 0, 0, 0])
+            w = x.copy()
+            w[0, 0] += phase * norm
+            w_norm = np.sqrt(np.sum(w ** 2))
+
+            if w_norm:
+                w /= w_norm
+                r[j:, j:] -= 2 * QHArray._matmul(w, QHArray._inner(w, r[j:, j:]))
+
+            ws.append(w)
+            phases.append(-phase)
+
+        q = np.zeros((n, k, 4))
+        q[np.arange(k), np.arange(k), 0] = 1
+
+        for j in reversed(range(k)):
+            q[j:] -= 2 * QHArray._matmul(ws[j], QHArray._inner(ws[j], q[j:]))
+
+        # Move the phase of each diagonal term of R over to Q.
+        for j in range(k):
+            q[:, j] = QHArray._products(q[:, j], phases[j])
+            r[j] = QHArray._products(phases[j] * conj_signs, r[j])
+
+        return q, np.triu(np.ones((k, k)))[:, :, np.newaxis] * r[:k]
+
+    def orthonormalize(self, householder=False):
+        """The orthonormal columns Q from a QR of the columns."""
+
+        return self.qr(householder)[0]
+
+    @staticmethod
+    def _complex_adjoint(a):
+        """The 2n x 2n complex matrix [[A, B], [-B*, A*]] of A + B j."""
+
+        A = a[..., 0] + 1j * a[..., 1]
+        B = a[..., 2] + 1j * a[..., 3]
+
+        return np.block([[A, B], [-B.conj(), A.conj()]])
+
+    def eigh(self):
+        """Eigenvalues and eigenkets of a Hermitian operator, from numpy.linalg.eigh of
+           the complex adjoint. Each eigenvalue shows up there twice, so the pairs get
+           folded back. Returns the ascending eigenvalues and an array whose columns
+           are the eigenkets."""
+
+        n = self.rows
+        chi = self._complex_adjoint(np.asarray(self.a, dtype=np.float64))
+
+        if (self.rows != self.columns) or not np.allclose(chi, chi.conj().T):
+            print("Oops, eigh needs a square Hermitian operator.")
+            return None
+
+        values, vectors = np.linalg.eigh(chi)
+
+        # [u, v] of the complex adjoint is the quaternion ket u - v* j.
+        kets = np.stack(
+            [vectors[:n].real, vectors[:n].imag, -vectors[n:].real, vectors[n:].imag],
+            axis=-1,
+        )
+
+        picked, basis = self._quaternion_basis(kets, n)
+
+        return values[picked], QHArray(basis)
+
+    @staticmethod
+    def _quaternion_basis(kets, n):
+        """Pick n of the 2 n kets of the complex adjoint that are independent over
+           the quaternions. The spectrum comes in pairs, u and its partner u j, so
+           tolerances on eigenvalues can split a pair. Instead, the ket that is
+           least like those already picked is taken each time, projected onto
+           what is left, as in a pivoted modified Gram-Schmidt: the kets left
+           over lose only the part along each new pick, so n picks take
+           O(n^3). Returns the indices, in ascending order, and the
+           orthonormal kets as columns."""
+
+        rows = len(kets)
+        picked, basis = [], np.zeros((rows, n, 4))
+
+        # Kets as real columns of length 4 rows, so each step is two matmuls.
+        rest = np.array(kets, dtype=np.float64).transpose(0, 2, 1).reshape(4 * rows, -1)
+
+        for j in range(n):
+            norms = np.sqrt(np.sum(rest ** 2, axis=0))
+            norms[picked] = 0
+            best = int(np.argmax(norms))
+
+            if norms[best] < 1e-6:
+                raise Exception(
+                    "Oops, only {} of {} independent eigenkets found.".format(
+                        len(picked), n
+                    )
+                )
+
+            picked.append(best)
+            e = (rest[:, best] / norms[best]).reshape(rows, 4)
+            basis[:, j] = e
+
+            # e, e i, e j and e k are orthonormal in R^4n and span e times H.
+            span = QHArray._products(e[:, np.newaxis], np.eye(4))
+            span = span.transpose(0, 2, 1).reshape(4 * rows, 4)
+            rest -= span @ (span.T @ rest)
+
+        order = np.argsort(picked)
+
+        return np.array(picked)[order], basis[:, order]
+
+    @staticmethod
+    def _triple_tensor():
+        """T[a, b, c, k] so that (p q r)_k = sum of T p_a q_b r_c, made once."""
+
+        if "triple" not in QHArray._tensors:
+            e = np.eye(4)
+            c = QHArray._products(e[:, np.newaxis], e[np.newaxis, :])
+            QHArray._tensors["triple"] = np.einsum("abm,mck->abck", c, c)
+
+        return QHArray._tensors["triple"]
+
+    @staticmethod
+    def _series(states):
+        """The (n, 4) array of a bra or ket, or an (M, n, 4) ensemble as is."""
+
+        if isinstance(states, QHStates):
+            states = QHArray(states)
+
+        if isinstance(states, QHArray):
+            return np.asarray(states.a, dtype=np.float64).reshape(-1, 4)
+
+        return np.asarray(states, dtype=np.float64)
+
+    @staticmethod
+    def brackets(bras, op, kets, block=None):
+        """<bra|op|ket> for many kets at once, returned as an (M, 4) array. The kets
+           come as an (M, n, 4) array, the bras as one (n, 4) bra or one per ket.
+           The operator hits a block of kets in one matrix product, then bras and
+           quaternion products get contracted in one pass, without any QHStates."""
+
+        op = np.asarray(op.a if isinstance(op, QHArray) else QHArray(op).a)
+        bras, kets = QHArray._series(bras), QHArray._series(kets)
+        triple = QHArray._triple_tensor()
+        n = op.shape[0]
+
+        # op[i, j, b] as an (n 4, n) matrix, so one matmul covers the whole block.
+        op_matrix = op.transpose(0, 2, 1).reshape(n * 4, op.shape[1])
+        result = np.zeros((len(kets), 4))
+        block = block or QHArray.BLOCK
+
+        for start in range(0, len(kets), block):
+            ms = slice(start, min(start + block, len(kets)))
+            m = ms.stop - ms.start
+            op_kets = op_matrix @ kets[ms].transpose(1, 0, 2).reshape(-1, m * 4)
+            op_kets = op_kets.reshape(n, 4, m, 4)
+
+            if bras.ndim == 2:
+                result[ms] = np.einsum(
+                    "ia,ibmc,abck->mk", bras, op_kets, triple, optimize=True
+                )
+            else:
+                result[ms] = np.einsum(
+                    "mia,ibmc,abck->mk", bras[ms], op_kets, triple, optimize=True
+                )
+
+        return result
+
+    @staticmethod
+    def bracket(bra, op, ket):
+        """Forms <bra|op|ket> as a scalar array, with no intermediate series."""
+
+        ket = QHArray._series(ket)[np.newaxis]
+
+        return QHArray(QHArray.brackets(bra, op, ket).reshape(1, 1, 4))
+
+    @staticmethod
+    def _ket_blocks(kets, block=None):
+        """Blocks of an (M, n, 4) array, memory-mapped or not, or the chunks of any
+           iterable of (m, n, 4) arrays, such as a generator of samples."""
+
+        if isinstance(kets, np.ndarray):
+            block = block or QHArray.BLOCK
+
+            for start in range(0, len(kets), block):
+                yield np.asarray(kets[start : start + block], dtype=np.float64)
+
+        else:
+            for chunk in kets:
+                chunk = np.asarray(chunk, dtype=np.float64)
+                yield chunk[np.newaxis] if chunk.ndim == 2 else chunk
+
+    @staticmethod
+    def _op_list(ops):
+        """One operator or a list of them as a list of QHArrays, converted once."""
+
+        op_list = ops if isinstance(ops, (list, tuple)) else [ops]
+
+        return [op if isinstance(op, QHArray) else QHArray(op) for op in op_list]
+
+    @staticmethod
+    def expectation_values(kets, ops, block=None):
+        """<ket|op|ket> for an ensemble of kets. Gives an (M, 4) array for one operator,
+           or (number of operators, M, 4) for a list of them."""
+
+        op_list = QHArray._op_list(ops)
+        values = [[] for op in op_list]
+
+        for chunk in QHArray._ket_blocks(kets, block):
+            bras = chunk * np.array([1, -1, -1, -1])
+
+            for op_values, op in zip(values, op_list):
+                op_values.append(QHArray.brackets(bras, op, chunk, block))
+
+        values = np.array([np.concatenate(op_values) for op_values in values])
+
+        return values if isinstance(ops, (list, tuple)) else values[0]
+
+    @staticmethod
+    def expectation_stats(kets, ops, block=None, ddof=0):
+        """Mean and variance of the expectation values of each t, x, y, z, keeping
+           only one block of kets in memory at a time. Blocks are merged with the
+           pairwise update of Chan, Golub and LeVeque. Returns a dict of count, mean
+           and variance, with a leading axis if given a list of operators."""
+
+        op_list = QHArray._op_list(ops)
+        count = 0
+        mean = np.zeros((len(op_list), 4))
+        m2 = np.zeros((len(op_list), 4))
+
+        for chunk in QHArray._ket_blocks(kets, block):
+            values = QHArray.expectation_values(chunk, op_list, block)
+            chunk_count = values.shape[1]
+            chunk_mean = values.mean(axis=1)
+            chunk_m2 = ((values - chunk_mean[:, np.newaxis]) ** 2).sum(axis=1)
+
+            total = count + chunk_count
+            delta = chunk_mean - mean
+            mean = mean + delta * chunk_count / total
+            m2 = m2 + chunk_m2 + delta ** 2 * count * chunk_count / total
+            count = total
+
+        variance = m2 / (count - ddof) if count > ddof else np.full_like(m2, np.nan)
+
+        if not isinstance(ops, (list, tuple)):
+            mean, variance = mean[0], variance[0]
+
+        return {"count": count, "mean": mean, "variance": variance}
+
+    # Pade coefficients and the norm each degree is good up to, from Higham (2005).
+    PADE = {
+        3: (1.495585217958292e-2, [120, 60, 12, 1]),
+        5: (2.539398330063230e-1, [30240, 15120, 3360, 420, 30, 1]),
+        7: (
+            9.504178996162932e-1,
+            [17297280, 8648640, 1995840, 277200, 25200, 1512, 56, 1],
+        ),
+        9: (
+            2.097847961257068,
+            [
+                17643225600,
+                8821612800,
+                2075673600,
+                302702400,
+                30270240,
+                2162160,
+                110880,
+                3960,
+                90,
+                1,
+            ],
+        ),
+        13: (
+            5.371920351148152,
+            [
+                64764752532480000,
+                32382376266240000,
+                7771770303897600,
+                1187353796428800,
+                129060195264000,
+                10559470521600,
+                670442572800,
+                33522128640,
+                1323241920,
+                40840800,
+                960960,
+                16380,
+                182,
+                1,
+            ],
+        ),
+    }
+
+    @staticmethod
+    def _from_complex_adjoint(chi):
+        """Reads A + B j back out of the top half of a complex adjoint."""
+
+        n = len(chi) // 2
+        A, B = chi[:n, :n], chi[:n, n:]
+
+        return np.stack([A.real, A.imag, B.real, B.imag], axis=-1)
+
+    @staticmethod
+    def _pade(a, m):
+        """The degree m Pade approximant of exp(a)."""
+
+        b = QHArray.PADE[m][1]
+        ident = np.eye(len(a))
+        a2 = a @ a
+
+        if m < 13:
+            powers = [ident, a2]
+
+            while len(powers) < m // 2 + 1:
+                powers.append(powers[-1] @ a2)
+
+            u = a @ sum(b[2 * k + 1] * power for k, power in enumerate(powers))
+            v = sum(b[2 * k] * power for k, power in enumerate(powers))
+
+        else:
+            a4 = a2 @ a2
+            a6 = a4 @ a2
+            u = a @ (
+                a6 @ (b[13] * a6 + b[11] * a4 + b[9] * a2)
+                + b[7] * a6
+                + b[5] * a4
+                + b[3] * a2
+                + b[1] * ident
+            )
+            v = (
+                a6 @ (b[12] * a6 + b[10] * a4 + b[8] * a2)
+                + b[6] * a6
+                + b[4] * a4
+                + b[2] * a2
+                + b[0] * ident
+            )
+
+        return np.linalg.solve(v - u, v + u)
+
+    def expm(self, t=1.0):
+        """The operator exponential exp(t op), by scaling and squaring with Pade
+           approximants on the complex adjoint, which exp maps to itself."""
+
+        if self.rows != self.columns:
+            print("Oops, can only take the exponential of a square operator.")
+            return None
+
+        chi = t * self._complex_adjoint(np.asarray(self.a, dtype=np.float64))
+        norm = np.abs(chi).sum(axis=0).max()
+
+        for m in [3, 5, 7, 9]:
+            if norm <= self.PADE[m][0]:
+                return QHArray(
+                    self._from_complex_adjoint(self._pade(chi, m)), qs_type=self.qs_type
+                )
+
+        squarings = max(0, int(np.ceil(np.log2(norm / self.PADE[13][0]))))
+        exp_chi = self._pade(chi / 2 ** squarings, 13)
+
+        for _ in range(squarings):
+            exp_chi = exp_chi @ exp_chi
+
+        return QHArray(self._from_complex_adjoint(exp_chi), qs_type=self.qs_type)
+
+    @staticmethod
+    def expm_multiply(op, ket, t=1.0, tolerance=2.0 ** -53):
+        """exp(t op)|ket> without ever forming exp(t op). The time gets cut into
+           steps no bigger than 1 / |op|, and each step sums the Taylor series one
+           product of op with the ket at a time. The op can be a QHArray, QHStates
+           or QHSparse, the ket a QHArray or an (n, k, 4) array of columns."""
+
+        if isinstance(op, QHStates):
+            op = QHArray(op)
+
+        if isinstance(op, QHArray):
+            a = np.asarray(op.a, dtype=np.float64)
+            norm = np.sqrt(np.sum(a ** 2, axis=2)).sum(axis=0).max()
+            hit = lambda v: QHArray._matmul(a, v)
+        else:
+            norm = np.bincount(
+                op.indices, np.sqrt(np.sum(op.data ** 2, axis=1)), op.columns
+            ).max()
+            hit = lambda v: op._dense_product(QHArray(v)).a
+
+        is_array = isinstance(ket, QHArray)
+        f = np.array(ket.a if is_array else ket, dtype=np.float64)
+        steps = max(1, int(np.ceil(abs(t) * norm)))
+
+        for _ in range(steps):
+            term = f
+
+            for k in range(1, 100):
+                term = hit(term) * (t / (steps * k))
+                f = f + term
+
+                if np.sqrt(np.sum(term ** 2)) <= tolerance * np.sqrt(np.sum(f ** 2)):
+                    break
+
+        return QHArray(f, qs_type=ket.qs_type) if is_array else f
+
+    # The binary format is the magic bytes, the length of the header, a json header
+    # with qs_type, rows, columns, representation and dtype, then the raw array
+    # (rows, columns, 4) in C order. The array starts on a 64 byte boundary.
+    MAGIC = b"QHARRAY1"
+    ALIGN = 64
+
+    def save(self, filename, dtype=None, symbolic=0):
+        """Save to the binary format, streaming rows of a memory-mapped array."""
+
+        dtype = np.dtype(dtype or self.a.dtype)
+
+        header = json.dumps(
+            {
+                "qs_type": self.qs_type,
+                "rows": self.rows,
+                "columns": self.columns,
+                "representation": self.representation,
+                "dtype": dtype.name,
+                "symbolic": symbolic,
+            }
+        ).encode()
+
+        offset = len(self.MAGIC) + 4 + len(header)
+        offset += -offset % self.ALIGN
+
+        with open(filename, "wb") as f:
+            f.write(self.MAGIC)
+            f.write(struct.pack("<I", offset))
+            f.write(header.ljust(offset - len(self.MAGIC) - 4))
+
+            for rows in self._blocks(self.rows):
+                f.write(np.ascontiguousarray(self.a[rows], dtype=dtype).tobytes())
+
+    @staticmethod
+    def read_header(filename):
+        """Read the header of a binary file, adding the offset of the array."""
+
+        with open(filename, "rb") as f:
+            if f.read(len(QHArray.MAGIC)) != QHArray.MAGIC:
+                raise Exception("Oops, not a QHArray file: {}".format(filename))
+
+            offset = struct.unpack("<I", f.read(4))[0]
+            header = json.loads(f.read(offset - len(QHArray.MAGIC) - 4))
+
+        header["offset"] = offset
+
+        return header
+
+    @staticmethod
+    def load(filename, mmap=True, mode="r"):
+        """Load a binary file without copying the array, either memory-mapped
+           or with np.frombuffer over the bytes read."""
+
+        header = QHArray.read_header(filename)
+        dtype = np.dtype(header["dtype"])
+        shape = (header["rows"], header["columns"], 4)
+
+        if mmap:
+            a = np.memmap(
+                filename, dtype=dtype, mode=mode, offset=header["offset"], shape=shape
+            )
+
+        else:
+            with open(filename, "rb") as f:
+                buffer = f.read()
+
+            a = np.frombuffer(
+                buffer, dtype=dtype, count=int(np.prod(shape)), offset=header["offset"]
+            ).reshape(shape)
+
+        qharray = QHArray(a, qs_type=header["qs_type"], dtype=dtype)
+        qharray.filename = filename if mmap else None
+        qharray.representation = header["representation"]
+
+        return qharray
+
+
+
+
+
+if __name__ == "__main__":
+
+    class TestQHArray(unittest.TestCase):
+        """Test arrays."""
+
+        A = QHStates([QH([4, 0, 0, 0]), QH([0, 1, 0, 0])], "bra")
+        B = QHStates([QH([0, 0, 1, 0]), QH([0, 0, 0, 2]), QH([0, 3, 0, 0])])
+        Op = QHStates(
+            [
+                QH([3, 0, 0, 0]),
+                QH([0, 1, 0, 0]),
+                QH([0, 0, 2, 0]),
+                QH([0, 0, 0, 3]),
+                QH([2, 0, 0, 0]),
+                QH([0, 4, 0, 0]),
+            ],
+            "op",
+            rows=2,
+            columns=3,
+        )
+        q_1234 = QHStates(
+            [QH([1, 1, 0, 0]), QH([2, 1, 0, 0]), QH([3, 1, 0, 0]), QH([4, 1, 0, 0])]
+        )
+        q1234 = QH([1, 2, 3, 4])
+        q4321 = QH([4, 3, 2, 1])
+        rng = np.random.default_rng(2019)
+        big = rng.normal(size=(7, 5, 4))
+        big_2 = rng.normal(size=(5, 6, 4))
+
+        def test_1000_init(self):
+            a = QHArray(self.Op)
+            print("Op array: ", a.a.shape)
+            self.assertEqual((a.rows, a.columns, a.dim), (2, 3, 6))
+            self.assertEqual(a.qs_type, "op")
+            self.assertEqual(a.a[1, 0, 1], 1)
+            self.assertEqual(a.a[0, 1, 2], 2)
+            self.assertEqual(QHArray([self.q1234, self.q4321]).qs_type, "ket")
+            self.assertEqual(QHArray(self.A).qs_type, "bra")
+
+        def test_1010_states(self):
+            self.assertTrue(QHArray(self.Op).states().equals(self.Op))
+            self.assertTrue(QHArray(self.B).states().equals(self.B))
+
+        def test_1020_products(self):
+            q12 = QHArray._products(np.array([1.0, 2, 3, 4]), np.array([4.0, 3, 2, 1]))
+            self.assertTrue(QH(list(q12)).equals(self.q1234.product(self.q4321)))
+
+            for kind in ["even", "odd", "even_minus_odd"]:
+                for reverse in [False, True]:
+                    q12 = QHArray._products(
+                        np.array([1.0, 2, 3, 4]),
+                        np.array([4.0, 3, 2, 1]),
+                        kind=kind,
+                        reverse=reverse,
+                    )
+                    q12_QH = self.q1234.product(self.q4321, kind, reverse)
+                    self.assertTrue(QH(list(q12)).equals(q12_QH))
+
+        def test_1030_product(self):
+            AOp = QHArray(self.A).product(QHArray(self.Op))
+            print("A Op: ", AOp)
+            self.assertTrue(AOp.states().equals(self.A.product(self.Op)))
+            OpB = QHArray(self.Op).product(QHArray(self.B))
+            self.assertTrue(OpB.states().equals(self.Op.product(self.B)))
+            BB = QHArray(self.B).product(QHArray(self.B))
+            self.assertTrue(BB.states().equals(self.B.product(self.B)))
+
+        def test_1040_product_blocks(self):
+            big, big_2 = QHArray(self.big), QHArray(self.big_2)
+            whole = big.product(big_2)
+            blocks = big.product(big_2, block=2)
+            self.assertTrue(whole.equals(blocks))
+            n = 1
+            row_col = QH().q_0()
+
+            for k in range(5):
+                row_col = row_col.add(
+                    QH(list(self.big[n, k])).product(QH(list(self.big_2[k, n])))
+                )
+
+            self.assertTrue(QH(list(whole.a[n, n])).equals(row_col))
+
+        def test_1050_memory_map(self):
+            with tempfile.TemporaryDirectory() as tmp:
+                file_1 = os.path.join(tmp, "big.npy")
+                big = QHArray(self.big, filename=file_1)
+                big.flush()
+                on_disk = QHArray(filename=file_1)
+                print("memory mapped: ", type(on_disk.a))
+                self.assertTrue(isinstance(on_disk.a, np.memmap))
+                self.assertTrue(on_disk.equals(QHArray(self.big)))
+                squares = on_disk[:, 0:3].product(
+                    on_disk[0:3, :], block=2, filename=os.path.join(tmp, "sq.npy")
+                )
+                self.assertTrue(isinstance(squares.a, np.memmap))
+                self.assertTrue(
+                    squares.equals(
+                        QHArray(self.big[:, 0:3]).product(QHArray(self.big[0:3, :]))
+                    )
+                )
+                del big, on_disk, squares
+
+        def test_1060_slice(self):
+            a = QHArray(self.Op)
+            self.assertEqual(a[1].qs_type, "bra")
+            self.assertEqual(a[:, 2].qs_type, "ket")
+            self.assertTrue(a[0, 1].states().equals(QHStates([QH([0, 0, 2, 0])])))
+            self.assertEqual(a[-1].qs_type, "bra")
+            self.assertTrue(a[-1].equals(a[1]))
+            self.assertEqual(a[:, -1].qs_type, "ket")
+            self.assertTrue(a[:, -1].equals(a[:, 2]))
+            self.assertEqual(a[np.int64(0)].qs_type, "bra")
+            self.assertTrue(a[np.int64(0)].equals(a[0]))
+            self.assertTrue(a[-2, np.int64(-3)].equals(a[0, 0]))
+            with self.assertRaises(IndexError):
+                a[2]
+            with self.assertRaises(IndexError):
+                a[0, -4]
+
+        def test_1070_add_dif(self):
+            big = QHArray(self.big)
+            self.assertTrue(big.add(big, block=3).equals(QHArray(2 * self.big)))
+            self.assertTrue(big.dif(big, block=3).equals(QHArray(0 * self.big)))
+
+        def test_1080_trace(self):
+            trace = QHArray(self.q_1234.op(2, 2)).trace(block=1)
+            print("trace: ", trace)
+            self.assertTrue(trace.states().equals(self.q_1234.op(2, 2).trace()))
+
+        def test_1090_transpose(self):
+            big = QHArray(self.big)
+            big_t = big.transpose(block=3)
+            self.assertEqual((big_t.rows, big_t.columns), (5, 7))
+            self.assertTrue(big_t.transpose(block=2).equals(big))
+            self.assertTrue(
+                QHArray(self.q_1234)
+                .transpose()
+                .states()
+                .equals(self.q_1234.transpose(4, 1))
+            )
+
+        def test_1088_cumulative_product(self):
+            steps = [QH(list(q)) for q in self.big.reshape(-1, 4)[:30]]
+            prefixes = [steps[0]]
+            for q in steps[1:]:
+                prefixes.append(prefixes[-1].product(q))
+            prefixes = QHArray(prefixes)
+
+            states = QHArray(steps)
+            scan = states.cumulative_product()
+            print("cumulative product: ", scan.a[-1, 0])
+            self.assertEqual((scan.rows, scan.columns), (30, 1))
+            self.assertTrue(scan.equals(prefixes))
+            self.assertTrue(states.cumulative_product(workers=3).equals(prefixes))
+            final = states.cumulative_product(final_only=True)
+            self.assertTrue(final.equals(prefixes[29]))
+
+            unit = states.cumulative_product(renormalize=True)
+            self.assertTrue(np.allclose(unit.a, QHArray._unit(prefixes.a)))
+
+            # Boosts are not unit quaternions, and halving is not scale-invariant.
+            rapidities = np.linspace(0.1, 0.8, 40)
+            boosts = np.zeros((40, 4))
+            boosts[:, 0], boosts[:, 1] = np.cosh(rapidities), np.sinh(rapidities)
+            boosts[::3, 2] = 0.2
+            halve = lambda a: a / 2
+            chain = QHArray(boosts)
+            for every in [1, 3, 7, 50]:
+                running = [halve(boosts[0])]
+                for k in range(1, 40):
+                    running.append(QHArray._products(running[-1], boosts[k]))
+                    if k % every == 0:
+                        running[-1] = halve(running[-1])
+                for workers in [None, 1, 2, 3, 4, 7]:
+                    hooked = chain.cumulative_product(halve, every, False, workers)
+                    self.assertTrue(np.allclose(hooked.a[:, 0], running))
+                    last = chain.cumulative_product(halve, every, True, workers)
+                    self.assertTrue(np.allclose(last.a[0, 0], running[-1]))
+            for workers in [1, 2, 3, 4, 7]:
+                self.assertTrue(states.cumulative_product(workers=workers).equals(scan))
+            one = QHArray([self.q1234]).cumulative_product(final_only=True)
+            self.assertTrue(np.allclose(one.a, [[[1, 2, 3, 4]]]))
+
+        def test_1089_summation(self):
+            rng = np.random.default_rng(46)
+            scales = 10.0 ** rng.integers(-8, 8, (100003, 1))
+            values = rng.normal(size=(100003, 4)) * scales
+            exact = [math.fsum(column) for column in values.T]
+            for method in ["pairwise", "kahan"]:
+                total = QHArray.sum_terms(values, method, block=100)
+                print("{} sum: ".format(method), total)
+                self.assertTrue(np.allclose(total, exact, rtol=1e-13, atol=0))
+                threaded = QHArray.sum_terms(values, method, 100, workers=3)
+                self.assertTrue(np.allclose(threaded, total))
+            self.assertTrue(QHArray.sum_terms(values, "naive") is None)
+
+            big = QHArray(self.big)
+            big_sum = big.summation("kahan").a[0, 0]
+            self.assertTrue(np.allclose(big_sum, self.big.sum(axis=(0, 1))))
+            qs = QHStates([QH([0.1, 0.2, 0.3, 0.4])] * 10)
+            self.assertTrue(np.isclose(qs.summation("kahan").t, 1.0, rtol=1e-15))
+            op = QHStates([QH([0.5, 0, 0, 0.25])] * 9, "op", rows=3, columns=3)
+            self.assertTrue(op.trace().qs[0].equals(QH([1.5, 0, 0, 0.75])))
+
+        def test_1091_representations(self):
+            qs = [QH(list(q)) for q in self.big[:, 0]] + [QH([2, 0, 0, 0])]
+            states = QHArray(qs)
+            for representation in ["polar", "spherical"]:
+                rep = states.txyz_2_representation(representation)
+                print("{}: ".format(representation), rep.a[0, 0])
+                self.assertEqual(rep.representation, representation)
+                for n, q in enumerate(qs):
+                    q_rep = q.txyz_2_representation(representation)
+                    q_rep = [float(v) for v in q_rep]
+                    self.assertTrue(np.allclose(rep.a[n, 0], q_rep))
+                    q_back = QH(q_rep).representation_2_txyz(representation)
+                    q_back = [float(v) for v in q_back]
+                    txyz = rep.representation_2_txyz()
+                    self.assertTrue(np.allclose(q_back, txyz.a[n, 0]))
+                self.assertTrue(rep.representation_2_txyz().equals(states))
+                self.assertTrue(
+                    rep.txyz_2_representation("polar").equals(
+                        states.txyz_2_representation("polar")
+                    )
+                )
+            self.assertTrue(states.txyz_2_representation("hyperbolic") is None)
+
+        def test_1101_polar_product(self):
+            kets = QHArray(self.big[:, :1])
+            kets_2 = QHArray(self.big[:, 1:2] * 0.3)
+            polar = kets.txyz_2_representation("polar")
+            polar_2 = kets_2.txyz_2_representation("polar")
+            product = polar.product(polar_2)
+            print("polar product: ", product.a[0, 0])
+            self.assertEqual(product.representation, "polar")
+            self.assertTrue(
+                product.representation_2_txyz().equals(kets.product(kets_2))
+            )
+            parallel = QHArray.polar_product([2, 0.5, 0, 0], [3, 1.5, 0, 0])
+            self.assertTrue(np.allclose(parallel, [6, 2, 0, 0]))
+            unwrapped = QHArray.polar_product([1, 2, 0, 0], [1, 2.5, 0, 0])
+            self.assertTrue(np.allclose(unwrapped, [1, 4.5, 0, 0]))
+            squared = QHArray.polar_product([1, 2, 0, 0], [1, 2, 0, 0])
+            self.assertTrue(np.allclose(squared, [1, 4, 0, 0]))
+            anti = QHArray.polar_product([1, 2, 0, 0], [2, -0.5, 0, 0])
+            self.assertTrue(np.allclose(anti, [2, 1.5, 0, 0]))
+            turned = QHArray.polar_product([2, 2, 0, 0], [1, 0, 2.5, 0])
+            self.assertTrue(np.linalg.norm(turned[1:]) <= math.pi)
+            self.assertTrue(
+                np.allclose(
+                    QHArray.polar_2_txyz(turned),
+                    QHArray._products(
+                        QHArray.polar_2_txyz([2, 2, 0, 0]),
+                        QHArray.polar_2_txyz([1, 0, 2.5, 0]),
+                    ),
+                )
+            )
+            self.assertTrue(polar.conj().representation_2_txyz().equals(kets.conj()))
+            self.assertTrue(polar.conj(1).representation_2_txyz().equals(kets.conj(1)))
+            op = QHArray(self.big[:5, :5])
+            op_polar = op.txyz_2_representation("polar").product(polar[:5])
+            self.assertEqual(op_polar.representation, "polar")
+            op_txyz = op_polar.representation_2_txyz()
+            self.assertTrue(op_txyz.equals(op.product(kets[:5])))
+
+        def test_1092_g_shifts(self):
+            events = self.big[:, 0]
+            gs = np.array([-0.01, 0, 0.003, 0.5])
+            for g_form in ["exp", "minimal"]:
+                grid = QHArray.g_shift_grid(events, gs, g_form, block=3)
+                print("g_shift grid {}: ".format(g_form), grid.shape)
+                self.assertEqual(grid.shape, (7, 4, 4))
+                for n, m in [(0, 0), (6, 3), (4, 2)]:
+                    q = QH(list(events[n])).g_shift(gs[m], g_form)
+                    self.assertTrue(np.allclose(grid[n, m], [q.t, q.x, q.y, q.z]))
+            chunks = list(QHArray.g_shifts(events, gs, block=4))
+            shapes = [chunk.shape for rows, chunk in chunks]
+            self.assertEqual(shapes, [(4, 4, 4), (3, 4, 4)])
+            self.assertTrue(QHArray._g_factors(gs, "gravity") is None)
+
+            with tempfile.TemporaryDirectory() as tmp:
+                filename = os.path.join(tmp, "g_shifts.npy")
+                grid = QHArray.g_shift_grid(events, gs, filename=filename)
+                grid.flush()
+                self.assertTrue(np.allclose(np.load(filename), grid))
+                del grid
+
+            t, g = sp.symbols("t g")
+            symbolic = QHArray.g_shift_grid(
+                np.array([[t, 1, 2, 3]], dtype=object), np.array([g, 0.1], dtype=object)
+            )
+            print("symbolic g_shift: ", symbolic[0, 0])
+            self.assertEqual(symbolic[0, 0, 0], t / sp.exp(g))
+            self.assertEqual(symbolic[0, 0, 3], 3 * sp.exp(g))
+
+        def test_1093_mixed_precision(self):
+            qs = [QH(list(q)) for q in self.big[:, 0]]
+            h = QH([1.2, 0.3, -0.4, 0.5])
+            states = QHArray(qs)
+            boosts = states.rotation_and_or_boost(h, block=3)
+            rescaled = states.Lorentz_by_rescaling(boosts, block=3)
+            for n, q in enumerate(qs):
+                boost = q.rotation_and_or_boost(h)
+                self.assertTrue(
+                    np.allclose(boosts.a[n, 0], [boost.t, boost.x, boost.y, boost.z])
+                )
+                r = q.Lorentz_by_rescaling(q.rotation_and_or_boost, h)
+                self.assertTrue(np.allclose(rescaled.a[n, 0], [r.t, r.x, r.y, r.z]))
+
+            light = QHArray([QH([1, 1, 0, 0])] * 2 + [QH([2, 0, 0, 0])])
+            unscaled = QHArray([QH([2, 0, 2, 0]), QH([3, 0, 0, 0]), QH([0, 0, 0, 1])])
+            light_rescaled = light.Lorentz_by_rescaling(unscaled)
+            self.assertTrue(
+                np.allclose(light_rescaled.a[:2, 0], [[2, 0, 2, 0], [1, 1, 0, 0]])
+            )
+            self.assertTrue(np.allclose(light_rescaled.a[2, 0], [0, 0, 0, 2]))
+
+            low = QHArray(self.big, dtype=np.float32)
+            self.assertEqual(low.a.dtype, np.float32)
+            self.assertEqual(low.rotation_and_or_boost(h).a.dtype, np.float32)
+            self.assertTrue(
+                np.isclose(
+                    low.norm_squared().a[0, 0, 0], np.sum(self.big ** 2), rtol=1e-6
+                )
+            )
+            low_product = low.product(low.transpose())
+            self.assertEqual(low_product.a.dtype, np.float32)
+            for kept in [
+                low[0:2],
+                low[1],
+                low.conj(),
+                low[:, 0].product(low[:, 1]),
+                QHArray(self.big.astype(np.float32)),
+            ]:
+                self.assertEqual(kept.a.dtype, np.float32)
+            with tempfile.TemporaryDirectory() as tmp:
+                filename = os.path.join(tmp, "low.npy")
+                mapped = QHArray(self.big, filename=filename, dtype=np.float32)
+                sliced = mapped[1:3, -1]
+                self.assertEqual(sliced.a.dtype, np.float32)
+                self.assertTrue(isinstance(sliced.a, np.memmap))
+                del mapped, sliced
+            big = QHArray(self.big)
+            self.assertTrue(
+                np.allclose(low_product.a, big.product(big.transpose()).a, atol=1e-4)
+            )
+
+            report = states.accuracy_report(h)
+            print("float32 accuracy report: ", report)
+            self.assertEqual(report["dtype"], "float32")
+            self.assertTrue(report["rotation_and_or_boost"]["max_rel"] < 1e-5)
+            self.assertTrue(report["Lorentz_by_rescaling"]["rms"] < 1e-5)
+            exact = states.accuracy_report(h, np.float64)
+            self.assertEqual(exact["rotation_and_or_boost"]["max_abs"], 0)
+
+        def test_1094_power(self):
+            op = QHArray(self.big[:5])
+            op_3 = op.product(op).product(op)
+            self.assertTrue(op.power(3).equals(op_3))
+            self.assertTrue(op.power(1).equals(op))
+            self.assertTrue(np.allclose(op.power(0).a[..., 0], np.eye(5)))
+            self.assertTrue(op.power(-1) is None)
+
+            QHArray.clear_power_cache()
+            op_13 = op.power(13, cache=True)
+            print("cached powers: ", sorted(m for key, m in QHArray._powers))
+            self.assertEqual(sorted(m for key, m in QHArray._powers), [2, 4, 8, 13])
+            self.assertTrue(op_13.equals(op_3.product(op.power(10))))
+            self.assertTrue(op.power(14, cache=True).equals(op_13.product(op)))
+            op_13.a[...] = 0
+            self.assertTrue(op.power(13, cache=True).equals(op.power(13)))
+            op.a[0, 0] += 1
+            self.assertTrue(op.power(13, cache=True).equals(op.power(13)))
+            self.assertFalse(op.power(13).equals(op_3.product(op.power(10))))
+            cache_size, QHArray.POWER_CACHE_SIZE = QHArray.POWER_CACHE_SIZE, 2
+            try:
+                op.power(3, cache=True)
+                self.assertEqual(len(QHArray._powers), 2)
+            finally:
+                QHArray.POWER_CACHE_SIZE = cache_size
+
+            Op = self.q_1234.op(2, 2)
+            Op_3 = QHArray(Op).power(3).states()
+            print("Op^3: ", Op_3)
+            self.assertTrue(Op.power(3, cache=True).equals(Op_3))
+            key = QHArray._power_key(QHArray(Op).a)
+            self.assertTrue((key, 3) in QHArray._powers)
+            self.assertTrue(Op.power(3, cache=True).equals(Op_3))
+            Op.qs[0] = QH([5, 0, 0, 0])
+            changed_3 = QHArray(Op).power(3).states()
+            self.assertTrue(Op.power(3, cache=True).equals(changed_3))
+            self.assertFalse(changed_3.equals(Op_3))
+            QHArray.clear_power_cache()
+
+        def test_1095_qr(self):
+            big = QHArray(self.big)
+            for householder in [False, True]:
+                q, r = big.qr(householder)
+                print("QR, householder {}: ".format(householder), r.a[0, 0])
+                self.assertTrue(QHArray(QHArray._matmul(q.a, r.a)).equals(big))
+                q_q = QHArray._inner(q.a, q.a)
+                self.assertTrue(np.allclose(q_q[..., 0], np.eye(5)))
+                self.assertTrue(np.allclose(q_q[..., 1:], 0))
+                self.assertTrue(np.allclose(np.tril(r.a[..., 0], -1), 0))
+            self.assertTrue(big.orthonormalize().equals(big.orthonormalize(True)))
+            ortho = self.q_1234.op(2, 2).orthonormalize()
+            self.assertEqual(self.q_1234.dim, 4)
+            self.assertTrue(
+                ortho.equals(QHArray(self.q_1234.op(2, 2)).qr()[0].states())
+            )
+
+        def test_1097_eigh(self):
+            h = self.big[:5] + self.big[:5].transpose(1, 0, 2) * [1, -1, -1, -1]
+            values, kets = QHArray(h).eigh()
+            print("eigenvalues: ", values)
+            self.assertEqual(len(values), 5)
+            self.assertTrue(np.all(np.diff(values) >= 0))
+            h_kets = QHArray._matmul(h, kets.a)
+            self.assertTrue(np.allclose(h_kets, kets.a * values[:, np.newaxis]))
+            self.assertTrue(
+                np.allclose(QHArray._inner(kets.a, kets.a)[..., 0], np.eye(5))
+            )
+            self.assertTrue(QHArray(self.big).eigh() is None)
+
+            # A degenerate spectrum, hidden by a random quaternionic unitary.
+            u = QHArray(self.big[:4, :4]).qr()[0].a
+            u_dagger = u.transpose(1, 0, 2) * [1, -1, -1, -1]
+            d = np.zeros((4, 4, 4))
+            d[range(4), range(4), 0] = [1, 1, 1 + 1e-7, 3]
+            h = QHArray._matmul(QHArray._matmul(u, d), u_dagger)
+            values, kets = QHArray(h).eigh()
+            self.assertTrue(np.allclose(values, [1, 1, 1 + 1e-7, 3]))
+            h_kets = QHArray._matmul(h, kets.a)
+            self.assertTrue(np.allclose(h_kets, kets.a * values[:, np.newaxis]))
+            self.assertTrue(
+                np.allclose(QHArray._inner(kets.a, kets.a)[..., 0], np.eye(4))
+            )
+
+            Op = QHStates(
+                [
+                    QH([2, 0, 0, 0]),
+                    QH([0, -1, -1, 0]),
+                    QH([0, 1, 1, 0]),
+                    QH([2, 0, 0, 0]),
+                ],
+                "op",
+                rows=2,
+                columns=2,
+            )
+            values, kets = Op.eigh()
+            print("Op eigenvalues: ", values)
+            self.assertTrue(np.allclose(values, [2 - math.sqrt(2), 2 + math.sqrt(2)]))
+            for value, ket in zip(values, kets):
+                self.assertEqual(ket.qs_type, "ket")
+                value_ket = QHStates([QH([value, 0, 0, 0])]).product(ket)
+                self.assertTrue(QHArray(Op.product(ket)).equals(QHArray(value_ket)))
+
+        def test_1098_brackets(self):
+            op = self.big[:5]
+            kets = self.rng.normal(size=(9, 5, 4))
+            bra = self.big_2[:, 0]
+            brackets = QHArray.brackets(bra, QHArray(op), kets, block=4)
+            print("brackets: ", brackets[0])
+            self.assertEqual(brackets.shape, (9, 4))
+            for m in [0, 8]:
+                slow = (
+                    QHArray(bra[np.newaxis])
+                    .product(QHArray(op))
+                    .product(QHArray(kets[m, :, np.newaxis]))
+                )
+                self.assertTrue(np.allclose(brackets[m], slow.a[0, 0]))
+            bras = kets * [1, -1, -1, -1]
+            self.assertTrue(
+                np.allclose(
+                    QHArray.brackets(bras, op, kets)[3],
+                    QHArray.brackets(bras[3], op, kets[3:4])[0],
+                )
+            )
+            ket = QHStates([self.q1234, self.q4321])
+            Op = self.q_1234.op(2, 2)
+            fused = QHStates.bracket(ket.bra(), Op, ket, fused=True)
+            slow = QHStates.bracket(ket.bra(), Op, ket)
+            self.assertTrue(fused.equals(slow))
+
+        def test_1099_expectation_values(self):
+            op, op_2 = self.big[:5], self.big_2[:, :5]
+            kets = self.rng.normal(size=(11, 5, 4))
+            values = QHArray.expectation_values(kets, op, block=4)
+            print("expectation values: ", values[0])
+            self.assertEqual(values.shape, (11, 4))
+            bra = kets[2] * [1, -1, -1, -1]
+            self.assertTrue(
+                np.allclose(values[2], QHArray.brackets(bra, op, kets[2:3])[0])
+            )
+            both = QHArray.expectation_values(kets, [op, op_2])
+            self.assertEqual(both.shape, (2, 11, 4))
+            self.assertTrue(np.allclose(both[0], values))
+
+            stats = QHArray.expectation_stats(iter(kets[i] for i in range(11)), op)
+            print("expectation stats: ", stats)
+            self.assertEqual(stats["count"], 11)
+            self.assertTrue(np.allclose(stats["mean"], values.mean(axis=0)))
+            self.assertTrue(np.allclose(stats["variance"], values.var(axis=0)))
+            stats = QHArray.expectation_stats(kets, [op, op_2], block=3, ddof=1)
+            self.assertTrue(np.allclose(stats["variance"], both.var(axis=1, ddof=1)))
+
+        def test_1096_expm(self):
+            h = self.big[:5]
+            skew = QHArray(h - h.transpose(1, 0, 2) * [1, -1, -1, -1])
+            for t in [0.01, 1, 3]:
+                u = skew.expm(t)
+                u_u = QHArray._inner(u.a, u.a)
+                print("expm unitary, t={}: ".format(t), np.abs(u_u[..., 0]).max())
+                self.assertTrue(np.allclose(u_u[..., 0], np.eye(5)))
+                self.assertTrue(np.allclose(u_u[..., 1:], 0))
+            u_half = skew.expm(0.5)
+            self.assertTrue(u_half.product(u_half).equals(skew.expm(1)))
+
+            ket = QHArray(self.big_2[:, :2])
+            u_ket = QHArray.expm_multiply(skew, ket, 3)
+            self.assertTrue(u_ket.equals(skew.expm(3).product(ket)))
+
+            Op = QHStates(
+                [
+                    QH([0, 0, 0, 0]),
+                    QH([1, 0, 0, 0]),
+                    QH([-1, 0, 0, 0]),
+                    QH([0, 0, 0, 0]),
+                ],
+                "op",
+                rows=2,
+                columns=2,
+            )
+            rotation = Op.expm(math.pi / 2)
+            print("exp(pi/2 Op): ", rotation)
+            self.assertTrue(
+                np.allclose(QHArray(rotation).a[..., 0], [[0, -1], [1, 0]])
+            )
+            ket = QHStates([self.q1234, self.q4321])
+            self.assertTrue(
+                QHArray(Op.expm_multiply(ket, 0.3)).equals(
+                    QHArray(Op.expm(0.3).product(ket))
+                )
+            )
+
+        def test_1100_save_load(self):
+            with tempfile.TemporaryDirectory() as tmp:
+                filename = os.path.join(tmp, "big.qh")
+                QHArray(self.big).save(filename)
+                header = QHArray.read_header(filename)
+                print("header: ", header)
+                self.assertEqual(header["offset"] % QHArray.ALIGN, 0)
+                size = os.path.getsize(filename)
+                self.assertEqual(size, header["offset"] + 7 * 5 * 32)
+                mapped = QHArray.load(filename)
+                self.assertTrue(isinstance(mapped.a, np.memmap))
+                self.assertTrue(mapped.equals(QHArray(self.big)))
+                in_memory = QHArray.load(filename, mmap=False)
+                self.assertFalse(in_memory.a.flags.owndata)
+                self.assertTrue(in_memory.equals(QHArray(self.big)))
+
+                QHArray(self.big).save(filename, dtype="float32")
+                small = QHArray.load(filename)
+                self.assertEqual(small.a.dtype, np.float32)
+                size = os.path.getsize(filename)
+                self.assertEqual(size, header["offset"] + 7 * 5 * 16)
+                self.assertTrue(np.allclose(small.a, self.big, atol=1e-6))
+                del mapped, small
+
+        def test_1110_save_load_QH(self):
+            with tempfile.TemporaryDirectory() as tmp:
+                filename = os.path.join(tmp, "q1234.qh")
+                self.q1234.save(filename)
+                q_z = QH.load(filename)
+                print("saved and loaded: ", q_z)
+                self.assertTrue(q_z.equals(self.q1234))
+
+        def test_1120_save_load_QHStates(self):
+            with tempfile.TemporaryDirectory() as tmp:
+                filename = os.path.join(tmp, "Op.qh")
+                self.Op.save(filename)
+                Op = QHStates.load(filename)
+                print("Op saved and loaded: ", Op)
+                self.assertTrue(Op.equals(self.Op))
+                self.assertEqual((Op.rows, Op.columns), (2, 3))
+                self.assertFalse(os.path.exists(filename + ".srepr"))
+
+                t, x, y, z = sp.symbols("t x y z")
+                q_sym = QHStates([self.q1234, QH([t, x, y, x * y * z])], "bra")
+                q_sym.save(filename)
+                q_sym_loaded = QHStates.load(filename)
+                print("symbolic saved and loaded: ", q_sym_loaded)
+                self.assertEqual(q_sym_loaded.qs_type, "bra")
+                self.assertTrue(q_sym_loaded.qs[0].equals(self.q1234))
+                self.assertEqual(q_sym_loaded.qs[1].z, x * y * z)
+
+    suite = unittest.TestLoader().loadTestsFromModule(TestQHArray())
+    _results = unittest.TextTestRunner().run(suite)
+
+
+# ## QHSparse - sparse quaternion operators
+
+# Sigma combinations, banded Hamiltonians and the like are mostly zero. QHSparse stores only the non-zero quaternions in compressed sparse row (CSR) form: the column indices, the pointers where each row starts in them, and the (nnz, 4) data. Products then cost on the order of the number of non-zero terms instead of dim².
+
+
+
+
+class QHSparse(object):
+    """A quaternion operator in compressed sparse row form."""
+
+    def __init__(self, data, indices, indptr, rows, columns, qs_type="op"):
+
+        self.data = np.asarray(data, dtype=np.float64).reshape(-1, 4)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.rows, self.columns = rows, columns
+        self.d, self.dim, self.dimensions = (rows * columns,) * 3
+        self.nnz = len(self.data)
+        self.qs_type = qs_type
+
+        if len(self.indptr) != rows + 1:
+            print(
+                "Oops, indptr needs rows + 1 = {} entries, not {}.".format(
+                    rows + 1, len(self.indptr)
+                )
+            )
+
+    @staticmethod
+    def from_coo(row_indices, column_indices, data, rows, columns, qs_type="op"):
+        """Build from coordinates and data. Duplicates are summed, zeros dropped."""
+
+        row_indices = np.asarray(row_indices, dtype=np.int64)
+        column_indices = np.asarray(column_indices, dtype=np.int64)
+        data = np.asarray(data, dtype=np.float64).reshape(-1, 4)
+
+        keys = row_indices * columns + column_indices
+        order = np.argsort(keys, kind="stable")
+        keys, data = keys[order], data[order]
+
+        if len(keys):
+            keys, starts = np.unique(keys, return_index=True)
+            data = np.add.reduceat(data, starts, axis=0)
+
+        non_zero = np.any(data != 0, axis=1)
+        keys, data = keys[non_zero], data[non_zero]
+
+        row_indices = keys // columns
+        indptr = np.zeros(rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(row_indices, minlength=rows), out=indptr[1:])
+
+        return QHSparse(data, keys % columns, indptr, rows, columns, qs_type)
+
+    @staticmethod
+    def from_dense(a, qs_type="op"):
+        """Build from a dense (rows, columns, 4) array."""
+
+        a = np.asarray(a)
+        row_indices, column_indices = np.nonzero(np.any(a != 0, axis=2))
+
+        return QHSparse.from_coo(
+            row_indices,
+            column_indices,
+            a[row_indices, column_indices],
+            a.shape[0],
+            a.shape[1],
+            qs_type,
+        )
+
+    @staticmethod
+    def from_states(states):
+        """Build from a QHStates or QHArray operator."""
+
+        if isinstance(states, QHStates):
+            states = QHArray(states)
+
+        qs_type = "op" if states.qs_type == "scalar" else states.qs_type
+
+        return QHSparse.from_dense(states.a, qs_type)
+
+    def _row_indices(self):
+        """The row of each stored quaternion."""
+
+        return np.repeat(np.arange(self.rows), np.diff(self.indptr))
+
+    def dense(self):
+        """The full (rows, columns, 4) array."""
+
+        a = np.zeros((self.rows, self.columns, 4), dtype=np.float64)
+        a[self._row_indices(), self.indices] = self.data
+
+        return a
+
+    def qharray(self):
+        """Returns a QHArray, zeros and all."""
+
+        return QHArray(self.dense(), qs_type=self.qs_type)
+
+    def states(self):
+        """Returns a QHStates, zeros and all."""
+
+        return self.qharray().states()
+
+    def __str__(self, quiet=False):
+        """Print out all the states."""
+
+        return self.states().__str__(quiet)
+
+    def print_state(self, label, spacer=True, quiet=True):
+        """Utility for printing states as a quaternion series."""
+
+        self.states().print_state(label, spacer, quiet)
+
+    def equals(self, q1):
+        """Test if two sparse operators are equal, explicit zeros or not."""
+
+        if (self.rows, self.columns) != (q1.rows, q1.columns):
+            return False
+
+        return np.allclose(self.dense(), q1.dense())
+
+    def add(self, q1):
+        """Add two sparse operators."""
+
+        if (self.rows, self.columns) != (q1.rows, q1.columns):
+            print("Oops, can only add if rows and columns are the same.")
+            return None
+
+        return QHSparse.from_coo(
+            np.concatenate([self._row_indices(), q1._row_indices()]),
+            np.concatenate([self.indices, q1.indices]),
+            np.concatenate([self.data, q1.data]),
+            self.rows,
+            self.columns,
+            self.qs_type,
+        )
+
+    def transpose(self):
+        """Transposes the operator."""
+
+        qs_type = {"bra": "ket", "ket": "bra"}.get(self.qs_type, self.qs_type)
+
+        return QHSparse.from_coo(
+            self.indices,
+            self._row_indices(),
+            self.data,
+            self.columns,
+            self.rows,
+            qs_type,
+        )
+
+    def product(self, q1, kind="", reverse=False):
+        """Matrix product with a dense ket or operator (QHStates or QHArray) which
+        returns the same dense type, or with another QHSparse which stays sparse."""
+
+        if self.columns != q1.rows:
+            print(
+                "Oops, cannot multiply series with row/column dimensions of {}/{} to {}/{}".format(
+                    self.rows, self.columns, q1.rows, q1.columns
+                )
+            )
+            return None
+
+        if isinstance(q1, QHSparse):
+            return self._sparse_product(q1, kind, reverse)
+
+        if isinstance(q1, QHStates):
+            return self._dense_product(QHArray(q1), kind, reverse).states()
+
+        return self._dense_product(q1, kind, reverse)
+
+    def _dense_product(self, q1, kind="", reverse=False):
+        """Each stored quaternion hits one row of q1, then the rows get summed."""
+
+        result = np.zeros((self.rows, q1.columns, 4), dtype=np.float64)
+        row_lengths = np.diff(self.indptr)
+
+        if self.nnz:
+            terms = QHArray._products(
+                self.data[:, np.newaxis, :],
+                np.asarray(q1.a)[self.indices],
+                kind,
+                reverse,
+            )
+            # CSR keeps each row together, so whole rows sum in one reduceat.
+            result[row_lengths > 0] = np.add.reduceat(
+                terms, self.indptr[:-1][row_lengths > 0], axis=0
+            )
+
+        qs_type = "ket" if q1.columns == 1 else "op"
+
+        return QHArray(result, qs_type=qs_type)
+
+    def _sparse_product(self, q1, kind="", reverse=False):
+        """Pair every stored (i, k) with every stored (k, j) of q1, then sum over k."""
+
+        q1_row_lengths = np.diff(q1.indptr)
+        counts = q1_row_lengths[self.indices]
+        total = counts.sum()
+
+        left = np.repeat(np.arange(self.nnz), counts)
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        right = np.repeat(q1.indptr[self.indices], counts) + offsets
+
+        return QHSparse.from_coo(
+            self._row_indices()[left],
+            q1.indices[right],
+            QHArray._products(self.data[left], q1.data[right], kind, reverse),
+            self.rows,
+            q1.columns,
+            "ket" if q1.columns == 1 else "op",
+        )
+
+
+
+
+
+if __name__ == "__main__":
+
+    class TestQHSparse(unittest.TestCase):
+        """Test sparse operators."""
+
+        q_0, q_1, q_i, q_j = QH().q_0(), QH().q_1(), QH().q_i(), QH().q_j()
+        Op = QHStates([q_1, q_0, q_0, q_0, q_i, q_0, q_0, q_j, q_1], "op")
+        ket = QHStates([QH([1, 2, 3, 4]), QH([4, 3, 2, 1]), QH([0, 1, 0, 1])])
+        rng = np.random.default_rng(2019)
+        band = (
+            rng.normal(size=(40, 40, 4))
+            * (abs(np.subtract.outer(np.arange(40), np.arange(40))) <= 1)[
+                :, :, np.newaxis
+            ]
+        )
+        wide = rng.normal(size=(40, 3, 4))
+
+        def test_1200_from_states(self):
+            s = QHSparse.from_states(self.Op)
+            print("Op sparse nnz: ", s.nnz)
+            self.assertEqual(s.nnz, 4)
+            self.assertEqual(list(s.indptr), [0, 1, 3, 4])
+            self.assertEqual(list(s.indices), [0, 1, 2, 2])
+            self.assertTrue(s.states().equals(self.Op))
+
+        def test_1210_from_coo(self):
+            s = QHSparse.from_coo(
+                [1, 0, 1, 1], [0, 1, 0, 1], [[1, 0, 0, 0]] * 3 + [[0] * 4], 2, 2
+            )
+            print("from coo: ", s.dense())
+            self.assertEqual(s.nnz, 2)
+            self.assertTrue(np.allclose(s.dense()[1, 0], [2, 0, 0, 0]))
+
+        def test_1220_dense_product(self):
+            s = QHSparse.from_states(self.Op)
+            s_ket = s.product(self.ket)
+            print("Op|ket>: ", s_ket)
+            self.assertTrue(s_ket.equals(self.Op.product(self.ket)))
+
+            band = QHSparse.from_dense(self.band)
+            self.assertEqual(band.nnz, 40 + 2 * 39)
+            for kind in ["", "even", "odd", "even_minus_odd"]:
+                for reverse in [False, True]:
+                    dense = QHArray(self.band).product(
+                        QHArray(self.wide), kind, reverse
+                    )
+                    self.assertTrue(
+                        band.product(QHArray(self.wide), kind, reverse).equals(dense)
+                    )
+
+        def test_1230_sparse_product(self):
+            band = QHSparse.from_dense(self.band)
+            band_2 = band.product(band)
+            print("band² nnz: ", band_2.nnz)
+            self.assertTrue(band_2.nnz <= 40 + 2 * 39 + 2 * 38)
+            dense = QHArray(self.band).product(QHArray(self.band), reverse=True)
+            self.assertTrue(
+                np.allclose(band.product(band, reverse=True).dense(), dense.a)
+            )
+
+        def test_1240_add_transpose(self):
+            s = QHSparse.from_states(self.Op)
+            s_t = s.transpose()
+            self.assertTrue(s_t.states().equals(self.Op.transpose()))
+            self.assertTrue(
+                s.add(s_t).equals(
+                    QHSparse.from_states(self.Op.add(self.Op.transpose()))
+                )
+            )
+            zero = s.add(QHSparse(-s.data, s.indices, s.indptr, 3, 3))
+            print("Op - Op nnz: ", zero.nnz)
+            self.assertEqual(zero.nnz, 0)
+
+        def test_1250_expm_multiply(self):
+            band = QHSparse.from_dense(self.band)
+            ket = QHArray(self.wide)
+            band_ket = QHArray.expm_multiply(band, ket, -0.1)
+            print("exp(-0.1 band)|wide>: ", band_ket.a[0, 0])
+            self.assertTrue(band_ket.equals(band.qharray().expm(-0.1).product(ket)))
+
+    suite = unittest.TestLoader().loadTestsFromModule(TestQHSparse())
+    _results = unittest.TextTestRunner().run(suite)
+
+
+# ## QHRandom - random quaternions for Monte Carlo work
+
+# QH.q_random draws four numbers at a time from Python's global random number generator. QHRandom draws whole batches from a seeded numpy.random.Generator. Independent streams get spawned for each chunk of a parallel draw, so results only depend on the seed, not on the number of workers.
+
+
+
+
+class QHRandom(object):
+    """Batches of random quaternions from a numpy.random.Generator."""
+
+    KINDS = ["uniform", "unit", "boost", "gaussian"]
+
+    # Parallel draws are split into chunks this big, each with its own stream.
+    CHUNK = 1000000
+
+    def __init__(self, seed=None):
+
+        if isinstance(seed, np.random.SeedSequence):
+            self.seed_sequence = seed
+        else:
+            self.seed_sequence = np.random.SeedSequence(seed)
+
+        self.rng = np.random.default_rng(self.seed_sequence)
+
+    def spawn(self, n):
+        """n generators with independent streams, one per worker say."""
+
+        return [QHRandom(child) for child in self.seed_sequence.spawn(n)]
+
+    @staticmethod
+    def _output(a, qs_type="ket", states=False):
+        """Wrap an (n, 4) array as a QHArray, or a QHStates if states is True."""
+
+        qharray = QHArray(a, qs_type=qs_type)
+
+        return qharray.states() if states else qharray
+
+    def uniform(self, n, low=0.0, high=1.0, qs_type="ket", states=False):
+        """Each term uniform in [low, high), like q_random for the defaults."""
+
+        return self._output(self.rng.uniform(low, high, (n, 4)), qs_type, states)
+
+    def unit(self, n, qs_type="ket", states=False):
+        """Uniform on the unit sphere S³, so random rotations."""
+
+        a = self.rng.standard_normal((n, 4))
+        a /= np.sqrt(np.sum(a ** 2, axis=1))[:, np.newaxis]
+
+        return self._output(a, qs_type, states)
+
+    def boost(self, n, max_rapidity=1.0, qs_type="ket", states=False):
+        """(cosh(r), sinh(r) u) with a rapidity r uniform in [0, max_rapidity) and
+           the direction u uniform on the sphere, the form of Lorentz_next_boost."""
+
+        rapidity = self.rng.uniform(0, max_rapidity, n)
+        u = self.rng.standard_normal((n, 3))
+        u /= np.sqrt(np.sum(u ** 2, axis=1))[:, np.newaxis]
+
+        a = np.empty((n, 4))
+        a[:, 0] = np.cosh(rapidity)
+        a[:, 1:] = np.sinh(rapidity)[:, np.newaxis] * u
+
+        return self._output(a, qs_type, states)
+
+    def gaussian(self, n, mean=0.0, sigma=1.0, qs_type="ket", states=False):
+        """Each term normal, mean and sigma can be numbers or 4 values."""
+
+        a = self.rng.normal(mean, sigma, (n, 4))
+
+        return self._output(a, qs_type, states)
+
+    @staticmethod
+    def _draw_chunk(seed_sequence, kind, n, kwargs):
+        """One chunk of a parallel draw, as a plain array."""
+
+        return np.asarray(getattr(QHRandom(seed_sequence), kind)(n, **kwargs).a)
+
+    def draw(self, kind, n, workers=None, qs_type="ket", states=False, **kwargs):
+        """n quaternions of a kind, uniform, unit, boost or gaussian, drawn in
+           chunks of CHUNK. Each chunk has its own spawned stream, so the result
+           is the same whatever the number of workers, workers=True uses all the
+           cores."""
+
+        if kind not in self.KINDS:
+            print("Oops, only know of these kinds: {}".format(self.KINDS))
+            return None
+
+        sizes = [min(self.CHUNK, n - start) for start in range(0, n, self.CHUNK)]
+        seeds = self.seed_sequence.spawn(len(sizes))
+        args = [(seed, kind, size, kwargs) for seed, size in zip(seeds, sizes)]
+
+        if workers is True:
+            workers = os.cpu_count()
+
+        if workers and workers > 1 and len(sizes) > 1:
+            chunks = QHStates._parallel_map(
+                QHRandom._draw_chunk, *zip(*args), workers=workers
+            )
+        else:
+            chunks = [QHRandom._draw_chunk(*arg) for arg in args]
+
+        a = np.concatenate(list(chunks)) if sizes else np.zeros((0, 4))
+
+        return self._output(a, qs_type, states)
+
+
+
+
+
+if __name__ == "__main__":
+
+    class TestQHRandom(unittest.TestCase):
+        """Test random quaternions."""
+
+        def test_1000_uniform(self):
+            qs = QHRandom(2019).uniform(1000)
+            print("uniform: ", qs.a[0, 0])
+            self.assertEqual((qs.rows, qs.columns), (1000, 1))
+            self.assertTrue(np.all((qs.a >= 0) & (qs.a < 1)))
+            self.assertTrue(np.allclose(QHRandom(2019).uniform(1000).a, qs.a))
+            bra = QHRandom(2019).uniform(3, -2, 2, qs_type="bra", states=True)
+            self.assertEqual(bra.qs_type, "bra")
+            self.assertEqual(len(bra.qs), 3)
+
+        def test_1010_unit(self):
+            qs = QHRandom(1).unit(20000)
+            norms = np.sum(qs.a ** 2, axis=2)
+            print("unit mean: ", qs.a.mean(axis=(0, 1)))
+            self.assertTrue(np.allclose(norms, 1))
+            self.assertTrue(np.all(np.abs(qs.a.mean(axis=(0, 1))) < 0.02))
+
+        def test_1020_boost(self):
+            qs = QHRandom(2).boost(500, max_rapidity=2)
+            intervals = qs.a[..., 0] ** 2 - np.sum(qs.a[..., 1:] ** 2, axis=2)
+            print("boost: ", qs.a[0, 0])
+            self.assertTrue(np.allclose(intervals, 1))
+            self.assertTrue(np.all(qs.a[..., 0] < math.cosh(2)))
+
+        def test_1030_gaussian(self):
+            qs = QHRandom(3).gaussian(20000, mean=[1, 0, 0, -1], sigma=0.5)
+            print("gaussian mean: ", qs.a.mean(axis=(0, 1)))
+            mean = qs.a.mean(axis=(0, 1))
+            self.assertTrue(np.allclose(mean, [1, 0, 0, -1], atol=0.02))
+            self.assertTrue(np.allclose(qs.a.std(axis=(0, 1)), 0.5, atol=0.02))
+
+        def test_1040_draw(self):
+            chunk, QHRandom.CHUNK = QHRandom.CHUNK, 300
+            try:
+                serial = QHRandom(4).draw("unit", 1000)
+                parallel = QHRandom(4).draw("unit", 1000, workers=2)
+                all_cores = QHRandom(4).draw("unit", 1000, workers=True)
+            finally:
+                QHRandom.CHUNK = chunk
+            self.assertEqual(serial.rows, 1000)
+            self.assertTrue(np.allclose(serial.a, parallel.a))
+            self.assertTrue(np.allclose(serial.a, all_cores.a))
+            streams = QHRandom(5).spawn(2)
+            self.assertFalse(
+                np.allclose(streams[0].uniform(10).a, streams[1].uniform(10).a)
+            )
+            self.assertTrue(QHRandom(6).draw("cauchy", 10) is None)
+
+    suite = unittest.TestLoader().loadTestsFromModule(TestQHRandom())
+    _results = unittest.TextTestRunner().run(suite)
+
+
+# ## QHDual - quaternions that carry their derivatives
+
+# Fitting h or asking how sensitive a boost is to it needs derivatives. Finite differences cost 8 more evaluations for a central difference in 4 directions, and sympy diff is slow. QHDual does forward-mode automatic differentiation: each quaternion carries its tangents, the derivatives of its 4 terms with respect to k inputs, and every operation applies the chain rule as it goes. Values are (..., 4) arrays and tangents (..., k, 4), so a batch goes through in one vectorized pass, with products done by qh_kernels. Quaternions that are not variables join with zero tangents.
+
+
+
+
+class QHDual(object):
+    """Quaternions with their derivatives, forward-mode automatic differentiation."""
+
+    # Signs of the terms in the interval t² - x² - y² - z².
+    INTERVAL_SIGNS = np.array([1.0, -1.0, -1.0, -1.0])
+
+    def __init__(self, values, tangents=None, qtype="Q"):
+
+        self.a = self._array(values)
+
+        if tangents is None:
+            tangents = np.zeros(self.a.shape[:-1] + (1, 4))
+
+        self.d = np.asarray(tangents, dtype=np.float64)
+        self.qtype = qtype
+        self.representation = ""
+
+    def __str__(self, quiet=False):
+        """The values, with the number of derivatives carried."""
+
+        qtype = "" if quiet else self.qtype
+
+        return "{} d/d{} {}".format(self.a.tolist(), self.d.shape[-2], qtype)
+
+    def print_state(self, label, spacer=True, quiet=True):
+        """Utility for printing a dual quaternion."""
+
+        print(label)
+
+        print(self.__str__(quiet))
+
+        if spacer:
+            print("")
+
+    @staticmethod
+    def _array(q1):
+        """A QH, QHArray or array like as a float64 (..., 4) array."""
+
+        if isinstance(q1, QH):
+            return np.array([q1.t, q1.x, q1.y, q1.z], dtype=np.float64)
+
+        if isinstance(q1, QHArray):
+            return np.asarray(q1.a, dtype=np.float64)
+
+        return np.asarray(q1, dtype=np.float64)
+
+    @staticmethod
+    def _wrap(q1):
+        """Anything else joins as a constant."""
+
+        return q1 if isinstance(q1, QHDual) else QHDual(q1)
+
+    @staticmethod
+    def variable(q1):
+        """Seed q1 as the variable, so derivatives are with respect to its 4 terms.
+           For a batch, each quaternion is its own variable."""
+
+        a = QHDual._array(q1)
+        tangents = np.broadcast_to(np.eye(4), a.shape[:-1] + (4, 4)).copy()
+
+        return QHDual(a, tangents)
+
+    @staticmethod
+    def variables(*qs):
+        """Seed several quaternions at once, derivatives with respect to all of
+           their 4 n terms, in order."""
+
+        duals = []
+
+        for n, q1 in enumerate(qs):
+            a = QHDual._array(q1)
+            tangents = np.zeros(a.shape[:-1] + (4 * len(qs), 4))
+            tangents[..., 4 * n : 4 * n + 4, :] = np.eye(4)
+            duals.append(QHDual(a, tangents))
+
+        return duals
+
+    @property
+    def jacobian(self):
+        """Derivatives of the 4 terms with respect to the k inputs, (..., 4, k)."""
+
+        shape = np.broadcast_shapes(self.a.shape[:-1], self.d.shape[:-2])
+
+        return np.swapaxes(np.broadcast_to(self.d, shape + self.d.shape[-2:]), -1, -2)
+
+    def qh(self, qtype=None):
+        """The value of a single quaternion as a QH."""
+
+        t, x, y, z = self.a.tolist()
+
+        return QH([t, x, y, z], qtype=qtype or self.qtype)
+
+    def qharray(self, qs_type="ket"):
+        """The values as a QHArray."""
+
+        return QHArray(self.a.reshape(-1, 4), qs_type=qs_type)
+
+    def check_representations(self, q1):
+        """Same as for QH."""
+
+        return QH.check_representations(self, q1)
+
+    def _real(self, values, tangents, qtype):
+        """(value, 0, 0, 0) from a value array and its tangents."""
+
+        a = np.zeros(values.shape + (4,))
+        a[..., 0] = values
+        d = np.zeros(tangents.shape + (4,))
+        d[..., 0] = tangents
+
+        return QHDual(a, d, qtype)
+
+    def _scaled(self, s, ds, qtype):
+        """Times real numbers s with tangents ds, the product rule."""
+
+        values = self.a * s[..., np.newaxis]
+        tangents = (
+            self.d * s[..., np.newaxis, np.newaxis]
+            + self.a[..., np.newaxis, :] * ds[..., np.newaxis]
+        )
+
+        return QHDual(values, tangents, qtype)
+
+    def _bilinear(self, q1, f):
+        """f(self, q1) for a function linear in each argument, like products."""
+
+        values = f(self.a, q1.a)
+        tangents = f(self.d, q1.a[..., np.newaxis, :]) + f(
+            self.a[..., np.newaxis, :], q1.d
+        )
+
+        return values, tangents
+
+    def _norm_squared(self, signs=1):
+        """Sum of squared terms, with signs for the interval, and its tangents."""
+
+        n = np.sum(signs * self.a ** 2, axis=-1)
+        dn = 2 * np.sum(signs * self.a[..., np.newaxis, :] * self.d, axis=-1)
+
+        return n, dn
+
+    def add(self, q1, qtype=""):
+        """Form a add given 2 quaternions."""
+
+        q1 = self._wrap(q1)
+        end_qtype = "{f}+{s}".format(f=self.qtype, s=q1.qtype)
+
+        return QHDual(self.a + q1.a, self.d + q1.d, qtype or end_qtype)
+
+    def dif(self, q1, qtype=""):
+        """Form a dif given 2 quaternions."""
+
+        q1 = self._wrap(q1)
+        end_qtype = "{f}-{s}".format(f=self.qtype, s=q1.qtype)
+
+        return QHDual(self.a - q1.a, self.d - q1.d, qtype or end_qtype)
+
+    def flip_signs(self, qtype="-"):
+        """Flip the signs of all terms."""
+
+        return QHDual(-self.a, -self.d, "-{}".format(self.qtype))
+
+    def conj(self, conj_type=0, qtype="*"):
+        """Three types of conjugates."""
+
+        if conj_type != 0:
+            qtype += str(conj_type)
+
+        values = qh_kernels.conj(self.a, conj_type)
+        tangents = qh_kernels.conj(self.d, conj_type)
+
+        return QHDual(values, tangents, self.qtype + qtype)
+
+    def product(self, q1, kind="", reverse=False, qtype=""):
+        """Form a product given 2 quaternions, of the same kinds as QH.product."""
+
+        q1 = self._wrap(q1)
+        self.check_representations(q1)
+
+        if kind.lower() not in ["", "even", "odd", "even_minus_odd"]:
+            raise Exception(
+                "Four 'kind' values are known: '', 'even', 'odd', and 'even_minus_odd'."
+            )
+
+        def products(a, b):
+            pq = qh_kernels.product(a, b)
+
+            if kind == "" and not reverse:
+                return pq
+
+            qp = qh_kernels.product(b, a)
+
+            if kind == "":
+                return qp
+
+            even, odd = (pq + qp) / 2, (pq - qp) / 2 * (-1 if reverse else 1)
+
+            return {"even": even, "odd": odd, "even_minus_odd": even - odd}[
+                kind.lower()
+            ]
+
+        values, tangents = self._bilinear(q1, products)
+
+        times_symbol = "xR" if reverse else "x"
+        end_qtype = "{f}{ts}{s}".format(f=self.qtype, ts=times_symbol, s=q1.qtype)
+
+        return QHDual(values, tangents, qtype or end_qtype)
+
+    triple_product = QH.triple_product
+
+    def rotation_and_or_boost(self, h, qtype="boost"):
+        """A boost or rotation or both, by QH.rotation_and_or_boost. Seed h as
+           the variable for the derivatives with respect to h."""
+
+        return QH.rotation_and_or_boost(self, self._wrap(h), qtype=qtype)
+
+    def scalar(self, qtype="scalar"):
+        """Returns the scalar part of a quaternion."""
+
+        mask = np.array([1.0, 0, 0, 0])
+
+        return QHDual(self.a * mask, self.d * mask, "scalar({})".format(self.qtype))
+
+    def vector(self, qtype="v"):
+        """Returns the vector part of a quaternion."""
+
+        mask = np.array([0, 1.0, 1.0, 1.0])
+
+        return QHDual(self.a * mask, self.d * mask, "vector({})".format(self.qtype))
+
+    def square(self, qtype="^2"):
+        """Square a quaternion."""
+
+        return self.product(self, qtype="{}{}".format(self.qtype, qtype))
+
+    def norm_squared(self, qtype="|| ||^2"):
+        """The norm_squared of a quaternion."""
+
+        n, dn = self._norm_squared()
+
+        return self._real(n, dn, "||{}||^2".format(self.qtype))
+
+    def norm_squared_of_vector(self, qtype="|V( )|^2"):
+        """The norm_squared of the vector of a quaternion."""
+
+        n, dn = self.vector()._norm_squared()
+
+        return self._real(n, dn, "|V({})|^2".format(self.qtype))
+
+    @staticmethod
+    def _sqrt(n, dn):
+        """Square root and its tangents, taking the tangents at 0 as 0."""
+
+        root = np.sqrt(n)
+        safe = np.where(root == 0, 1, root)
+
+        return root, dn / (2 * safe[..., np.newaxis])
+
+    def abs_of_q(self, qtype="||"):
+        """The absolute value, the square root of the norm_squared."""
+
+        root, d_root = self._sqrt(*self._norm_squared())
+
+        return self._real(root, d_root, "|{}|".format(self.qtype))
+
+    def abs_of_vector(self, qtype="|V( )|"):
+        """The absolute value of the vector."""
+
+        root, d_root = self._sqrt(*self.vector()._norm_squared())
+
+        return self._real(root, d_root, "|V({})|".format(self.qtype))
+
+    def normalize(self, n=1, qtype="U"):
+        """Normalize a quaternion, zero stays zero."""
+
+        root, d_root = self._sqrt(*self._norm_squared())
+        safe = np.where(root == 0, 1, root)
+        s = np.where(root == 0, 0, n / safe)
+        ds = -s[..., np.newaxis] * d_root / safe[..., np.newaxis]
+
+        return self._scaled(s, ds, "{}{}".format(self.qtype, qtype))
+
+    def inverse(self, qtype="^-1", additive=False):
+        """The additive or multiplicative inverse of a quaternion, 0 for 0."""
+
+        if additive:
+            q_inv = self.flip_signs()
+            q_inv.qtype = "-{}".format(self.qtype)
+
+            return q_inv
+
+        n, dn = self._norm_squared()
+        safe = np.where(n == 0, 1, n)
+        s = np.where(n == 0, 0, 1 / safe)
+        ds = -dn * (s / safe)[..., np.newaxis]
+
+        return self.conj()._scaled(s, ds, "{}{}".format(self.qtype, qtype))
+
+    def divide_by(self, q1, qtype=""):
+        """Divide one quaternion by another, on the right."""
+
+        q1 = self._wrap(q1)
+        end_qtype = "{f}/{s}".format(f=self.qtype, s=q1.qtype)
+
+        return self.product(q1.inverse(), qtype=qtype or end_qtype)
+
+    @staticmethod
+    def _sinc(R, hyperbolic=False):
+        """sin(R)/R or sinh(R)/R and its derivative, by series near R = 0."""
+
+        small = R < 1e-3
+        safe = np.where(small, 1, R)
+        sign = 1 if hyperbolic else -1
+
+        if hyperbolic:
+            f = np.sinh(safe) / safe
+            df = (np.cosh(safe) - f) / safe
+        else:
+            f = np.sin(safe) / safe
+            df = (np.cos(safe) - f) / safe
+
+        f = np.where(small, 1 + sign * R ** 2 / 6, f)
+        df = np.where(small, sign * R / 3 + R ** 3 / 30, df)
+
+        return f, df
+
+    def _radial(self, parts, qtype):
+        """A function (A, B V) where A and B depend on t and R = |V|, the form of
+           exp, ln and the trig functions. parts(t, R) gives A and B and their
+           derivatives by t and R, which the chain rule needs."""
+
+        t, v = self.a[..., 0], self.a[..., 1:]
+        dt, dv = self.d[..., 0], self.d[..., 1:]
+
+        R, dR = self._sqrt(*self.vector()._norm_squared())
+        A, A_t, A_R, B, B_t, B_R = parts(t, R)
+
+        values = np.concatenate([A[..., np.newaxis], B[..., np.newaxis] * v], axis=-1)
+        dA = A_t[..., np.newaxis] * dt + A_R[..., np.newaxis] * dR
+        dB = B_t[..., np.newaxis] * dt + B_R[..., np.newaxis] * dR
+        tangents = np.concatenate(
+            [
+                dA[..., np.newaxis],
+                dB[..., np.newaxis] * v[..., np.newaxis, :]
+                + B[..., np.newaxis, np.newaxis] * dv,
+            ],
+            axis=-1,
+        )
+
+        return QHDual(values, tangents, "{}({})".format(qtype, self.qtype))
+
+    def exp(self, qtype="exp"):
+        """Take the exponential of a quaternion."""
+
+        def parts(t, R):
+            et = np.exp(t)
+            sinc, d_sinc = self._sinc(R)
+            A = et * np.cos(R)
+
+            return A, A, -et * np.sin(R), et * sinc, et * sinc, et * d_sinc
+
+        return self._radial(parts, qtype)
+
+    def ln(self, qtype="ln"):
+        """Take the natural log of a quaternion. On the negative real axis it is
+           (ln(-t), pi, 0, 0) as in QH.ln, with a constant vector part, and the
+           log of 0 is an Oops."""
+
+        t = self.a[..., 0]
+        real = np.all(self.a[..., 1:] == 0, axis=-1)
+
+        if np.any(real & (t == 0)):
+            print("Oops, the log of zero is not defined.")
+            return None
+
+        def parts(t, R):
+            n = t ** 2 + R ** 2
+            safe = np.where(R == 0, 1, R)
+            B = np.where(R == 0, 1 / np.where(t == 0, 1, t), np.arctan2(R, t) / safe)
+            B_R = np.where(R == 0, 0, (t / n - B) / safe)
+
+            return 0.5 * np.log(n), t / n, R / n, B, -1 / n, B_R
+
+        result = self._radial(parts, qtype)
+        negative = real & (t < 0)
+
+        if np.any(negative):
+            result.a[negative, 1:] = [math.pi, 0, 0]
+            result.d[negative, :, 1:] = 0
+
+        return result
+
+    def sin(self, qtype="sin"):
+        """Take the sine of a quaternion."""
+
+        def parts(t, R):
+            sinhc, d_sinhc = self._sinc(R, hyperbolic=True)
+            sin_t, cos_t = np.sin(t), np.cos(t)
+
+            return (
+                sin_t * np.cosh(R),
+                cos_t * np.cosh(R),
+                sin_t * np.sinh(R),
+                cos_t * sinhc,
+                -sin_t * sinhc,
+                cos_t * d_sinhc,
+            )
+
+        return self._radial(parts, qtype)
+
+    def cos(self, qtype="cos"):
+        """Take the cosine of a quaternion."""
+
+        def parts(t, R):
+            sinhc, d_sinhc = self._sinc(R, hyperbolic=True)
+            sin_t, cos_t = np.sin(t), np.cos(t)
+
+            return (
+                cos_t * np.cosh(R),
+                -sin_t * np.cosh(R),
+                cos_t * np.sinh(R),
+                -sin_t * sinhc,
+                -cos_t * sinhc,
+                -sin_t * d_sinhc,
+            )
+
+        return self._radial(parts, qtype)
+
+    def tan(self, qtype="tan"):
+        """Take the tan of a quaternion, sin/cos"""
+
+        q_out = self.sin().divide_by(self.cos())
+        q_out.qtype = "{}({})".format(qtype, self.qtype)
+
+        return q_out
+
+    def sinh(self, qtype="sinh"):
+        """Take the sinh of a quaternion."""
+
+        def parts(t, R):
+            sinc, d_sinc = self._sinc(R)
+            sinh_t, cosh_t = np.sinh(t), np.cosh(t)
+
+            return (
+                sinh_t * np.cos(R),
+                cosh_t * np.cos(R),
+                -sinh_t * np.sin(R),
+                cosh_t * sinc,
+                sinh_t * sinc,
+                cosh_t * d_sinc,
+            )
+
+        return self._radial(parts, qtype)
+
+    def cosh(self, qtype="cosh"):
+        """Take the cosh of a quaternion."""
+
+        def parts(t, R):
+            sinc, d_sinc = self._sinc(R)
+            sinh_t, cosh_t = np.sinh(t), np.cosh(t)
+
+            return (
+                cosh_t * np.cos(R),
+                sinh_t * np.cos(R),
+                -cosh_t * np.sin(R),
+                sinh_t * sinc,
+                cosh_t * sinc,
+                sinh_t * d_sinc,
+            )
+
+        return self._radial(parts, qtype)
+
+    def tanh(self, qtype="tanh"):
+        """Take the tanh of a quaternion, sinh/cosh"""
+
+        q_out = self.sinh().divide_by(self.cosh())
+        q_out.qtype = "{}({})".format(qtype, self.qtype)
+
+        return q_out
+
+    def Lorentz_by_rescaling(self, op, h=None, qtype="Lorentz by rescaling"):
+        """QH.Lorentz_by_rescaling with derivatives. op(h) is rescaled to the
+           interval of self, with the same house rules for light-like intervals,
+           and the scaling factor is differentiated too."""
+
+        unscaled = self._wrap(op(h) if h is not None else op())
+
+        q_interval, dq_interval = self._norm_squared(self.INTERVAL_SIGNS)
+        u_interval, du_interval = unscaled._norm_squared(self.INTERVAL_SIGNS)
+
+        q_light, u_light = q_interval == 0, u_interval == 0
+        rescale = ~q_light & ~u_light
+
+        safe_u = np.where(rescale, u_interval, 1)
+        ratio = np.where(rescale, q_interval / safe_u, 1)
+        scaling = np.sqrt(np.abs(ratio))
+        d_ratio = (
+            dq_interval * safe_u[..., np.newaxis]
+            - q_interval[..., np.newaxis] * du_interval
+        ) / (safe_u ** 2)[..., np.newaxis]
+        d_scaling = np.where(
+            rescale[..., np.newaxis],
+            np.sign(ratio)[..., np.newaxis] * d_ratio / (2 * scaling[..., np.newaxis]),
+            0,
+        )
+
+        scaled = unscaled._scaled(scaling, d_scaling, "{}{}".format(self.qtype, qtype))
+
+        # Light-like to light-like keeps the result, a mix keeps the state.
+        keep = q_light != u_light
+        scaled.a = np.where(keep[..., np.newaxis], self.a, scaled.a)
+        scaled.d = np.where(keep[..., np.newaxis, np.newaxis], self.d, scaled.d)
+
+        return scaled
+
+
+if __name__ == "__main__":
+
+    class TestQHDual(unittest.TestCase):
+        q = QH([0.5, 0.3, -0.2, 0.1])
+        b = QH([1, 2, 3, 4])
+        h = QH([1.2, 0.3, -0.4, 0.2])
+
+        @staticmethod
+        def numerical_jacobian(f, q, eps=1e-6):
+            """Central differences of a QH function, the old way."""
+
+            columns = []
+
+            for n in range(4):
+                step = np.zeros(4)
+                step[n] = eps
+                up = f(QH(list(QHDual._array(q) + step)))
+                down = f(QH(list(QHDual._array(q) - step)))
+                columns.append((QHDual._array(up) - QHDual._array(down)) / (2 * eps))
+
+            return np.array(columns).T
+
+        def test_functions(self):
+            for name in ["exp", "ln", "sin", "cos", "tan", "sinh", "cosh", "tanh"]:
+                dual = getattr(QHDual.variable(self.q), name)()
+                eager = getattr(self.q, name)()
+                numerical = self.numerical_jacobian(
+                    lambda q: getattr(q, name)(), self.q
+                )
+                self.assertTrue(np.allclose(dual.a, QHDual._array(eager)), name)
+                self.assertTrue(np.allclose(dual.jacobian, numerical, atol=1e-7), name)
+
+            print("d exp(q)/dq: ", QHDual.variable(self.q).exp().jacobian)
+
+            real = QH([0.5, 0, 0, 0])
+            for name in ["exp", "ln", "sin", "cosh"]:
+                dual = getattr(QHDual.variable(real), name)()
+                numerical = self.numerical_jacobian(lambda q: getattr(q, name)(), real)
+                self.assertTrue(np.allclose(dual.jacobian, numerical, atol=1e-7), name)
+
+            negative = QH([-2, 0, 0, 0])
+            ln_negative = QHDual.variable(negative).ln()
+            print("ln(-2): ", ln_negative)
+            self.assertTrue(np.allclose(ln_negative.a, QHDual._array(negative.ln())))
+            self.assertTrue(np.allclose(ln_negative.a, [math.log(2), math.pi, 0, 0]))
+            self.assertTrue(np.allclose(ln_negative.jacobian[0], [-0.5, 0, 0, 0]))
+            self.assertTrue(np.all(ln_negative.jacobian[1:] == 0))
+            batch = QHDual(np.array([[-2.0, 0, 0, 0], [1, 2, 3, 4]])).ln()
+            ln_1234 = QHDual._array(QH([1, 2, 3, 4]).ln())
+            self.assertTrue(np.allclose(batch.a[1], ln_1234))
+            self.assertTrue(QHDual.variable(QH([0, 0, 0, 0])).ln() is None)
+
+        def test_products(self):
+            for kind in ["", "even", "odd", "even_minus_odd"]:
+                for reverse in [False, True]:
+                    dual = QHDual(self.b).product(
+                        QHDual.variable(self.h), kind, reverse
+                    )
+                    eager = self.b.product(self.h, kind, reverse)
+                    numerical = self.numerical_jacobian(
+                        lambda h: self.b.product(h, kind, reverse), self.h
+                    )
+                    self.assertTrue(np.allclose(dual.a, QHDual._array(eager)))
+                    self.assertTrue(np.allclose(dual.jacobian, numerical))
+
+            inverse = QHDual.variable(self.h).inverse()
+            numerical = self.numerical_jacobian(lambda h: h.inverse(), self.h)
+            self.assertTrue(np.allclose(inverse.jacobian, numerical))
+            unit = QHDual.variable(self.h).normalize()
+            numerical = self.numerical_jacobian(lambda h: h.normalize(), self.h)
+            self.assertTrue(np.allclose(unit.jacobian, numerical))
+
+        def test_rotation_and_or_boost(self):
+            boost = QHDual(self.b).rotation_and_or_boost(QHDual.variable(self.h))
+            numerical = self.numerical_jacobian(
+                lambda h: self.b.rotation_and_or_boost(h), self.h
+            )
+            print("d boost/dh: ", boost.jacobian)
+            self.assertTrue(boost.qh().equals(self.b.rotation_and_or_boost(self.h)))
+            self.assertTrue(np.allclose(boost.jacobian, numerical))
+
+            events = np.random.default_rng(49).normal(size=(6, 4))
+            batch = QHDual(events).rotation_and_or_boost(QHDual.variable(self.h))
+            self.assertEqual(batch.jacobian.shape, (6, 4, 4))
+            numerical = self.numerical_jacobian(
+                lambda h: QH(list(events[3])).rotation_and_or_boost(h), self.h
+            )
+            self.assertTrue(np.allclose(batch.jacobian[3], numerical))
+            self.assertTrue(
+                batch.qharray().equals(
+                    QHArray(events, qs_type="ket").rotation_and_or_boost(self.h)
+                )
+            )
+
+            b_dual, h_dual = QHDual.variables(self.b, self.h)
+            both = b_dual.rotation_and_or_boost(h_dual)
+            self.assertEqual(both.jacobian.shape, (4, 8))
+            self.assertTrue(np.allclose(both.jacobian[:, 4:], boost.jacobian))
+
+        def test_Lorentz_by_rescaling(self):
+            b = QH([3, 1, 1, 1])
+            dual = QHDual(b).Lorentz_by_rescaling(
+                lambda h: QHDual(b).rotation_and_or_boost(h), QHDual.variable(self.h)
+            )
+            eager = b.Lorentz_by_rescaling(lambda h: b.rotation_and_or_boost(h), self.h)
+            numerical = self.numerical_jacobian(
+                lambda h: b.Lorentz_by_rescaling(
+                    lambda g: b.rotation_and_or_boost(g), h
+                ),
+                self.h,
+            )
+            self.assertTrue(np.allclose(dual.a, QHDual._array(eager)))
+            self.assertTrue(np.allclose(dual.jacobian, numerical, atol=1e-6))
+            self.assertTrue(np.isclose(dual.square().a[0], b.square().t))
+
+            light = QH([1, 1, 0, 0])
+            kept = QHDual(light).Lorentz_by_rescaling(
+                lambda h: QHDual(b).rotation_and_or_boost(h), QHDual.variable(self.h)
+            )
+            self.assertTrue(kept.qh().equals(light))
+            self.assertTrue(np.allclose(kept.jacobian, 0))
+
+    suite = unittest.TestLoader().loadTestsFromModule(TestQHDual())
+    _results = unittest.TextTestRunner().run(suite)
+
+
+# ## QHInterval - boxes of quaternions, and a certified search for h
+
+# Does some h make rotation_and_or_boost send (t, x, y, z) to (t, -y, x, z)? sp.solve answers that only for simple forms, and random search can never show that no h works. Interval arithmetic can: every term is a range [lo, hi] that is sure to hold the exact value, rounding outward. Run rotation_and_or_boost on a box of h values, and if the box that comes out misses the target, no h in the box is a solution. search_h splits h-space into boxes that way, dropping those ruled out, and either ends with small boxes that may hold solutions or a proof that there are none.
+
+
+
+
+class QHInterval(object):
+    """Quaternions as boxes [lo, hi] in each term, with outward rounding."""
+
+    # Rounding error of a term is less than this times the sizes of what went in.
+    ROUNDING = 4 * np.finfo(np.float64).eps
+
+    # The Hamilton product term by term: for each output, the term of the left
+    # quaternion, the term of the right one, and the sign.
+    LEFT = np.array([[0, 1, 2, 3], [0, 1, 2, 3], [0, 2, 3, 1], [0, 3, 1, 2]])
+    RIGHT = np.array([[0, 1, 2, 3], [1, 0, 3, 2], [2, 0, 1, 3], [3, 0, 2, 1]])
+    SIGNS = np.array([[1, -1, -1, -1], [1, 1, 1, -1], [1, 1, 1, -1], [1, 1, 1, -1]])
+
+    # search_h hands out work in chunks of this many boxes.
+    CHUNK = 4096
+
+    def __init__(self, lo, hi=None, qtype="Q"):
+
+        self.lo = QHDual._array(lo)
+        self.hi = self.lo.copy() if hi is None else QHDual._array(hi)
+        self.qtype = qtype
+        self.representation = ""
+
+    def __str__(self, quiet=False):
+        """Each term as [lo, hi]."""
+
+        qtype = "" if quiet else self.qtype
+        terms = np.stack([self.lo, self.hi], axis=-1).tolist()
+
+        return "{} {}".format(terms, qtype)
+
+    def print_state(self, label, spacer=True, quiet=True):
+        """Utility for printing an interval quaternion."""
+
+        print(label)
+
+        print(self.__str__(quiet))
+
+        if spacer:
+            print("")
+
+    @staticmethod
+    def _wrap(q1):
+        """Anything else joins as a point, lo = hi."""
+
+        return q1 if isinstance(q1, QHInterval) else QHInterval(q1)
+
+    @staticmethod
+    def _round_out(lo, hi, size):
+        """Widen [lo, hi] by the worst rounding error of terms of this size."""
+
+        error = QHInterval.ROUNDING * size + np.finfo(np.float64).tiny
+
+        return lo - error, hi + error
+
+    def _size(self):
+        return np.maximum(np.abs(self.lo), np.abs(self.hi))
+
+    def check_representations(self, q1):
+        """Same as for QH."""
+
+        return QH.check_representations(self, q1)
+
+    def midpoint(self):
+        """The centers of the boxes."""
+
+        return (self.lo + self.hi) / 2
+
+    def width(self):
+        """The widths of the boxes, term by term."""
+
+        return self.hi - self.lo
+
+    def contains(self, q1):
+        """True where a quaternion, or array of them, is in the box."""
+
+        q = QHDual._array(q1)
+
+        return np.all((self.lo <= q) & (q <= self.hi), axis=-1)
+
+    def add(self, q1, qtype=""):
+        """Form a add given 2 quaternions."""
+
+        q1 = self._wrap(q1)
+        end_qtype = "{f}+{s}".format(f=self.qtype, s=q1.qtype)
+        lo, hi = self._round_out(
+            self.lo + q1.lo, self.hi + q1.hi, self._size() + q1._size()
+        )
+
+        return QHInterval(lo, hi, qtype=qtype or end_qtype)
+
+    def dif(self, q1, qtype=""):
+        """Form a dif given 2 quaternions."""
+
+        q1 = self._wrap(q1)
+        end_qtype = "{f}-{s}".format(f=self.qtype, s=q1.qtype)
+        lo, hi = self._round_out(
+            self.lo - q1.hi, self.hi - q1.lo, self._size() + q1._size()
+        )
+
+        return QHInterval(lo, hi, qtype=qtype or end_qtype)
+
+    def flip_signs(self, qtype="-"):
+        """Flip the signs of all terms."""
+
+        return QHInterval(-self.hi, -self.lo, qtype="-{}".format(self.qtype))
+
+    def conj(self, conj_type=0, qtype="*"):
+        """Three types of conjugates."""
+
+        if conj_type != 0:
+            qtype += str(conj_type)
+
+        signs = QHKernels.CONJ_SIGNS[conj_type]
+        lo = np.where(signs > 0, self.lo, -self.hi)
+        hi = np.where(signs > 0, self.hi, -self.lo)
+
+        return QHInterval(lo, hi, qtype=self.qtype + qtype)
+
+    def product(self, q1, kind="", reverse=False, qtype=""):
+        """Form a product given 2 quaternions. Only the standard kind is done,
+           reverse=True swaps the order."""
+
+        q1 = self._wrap(q1)
+        self.check_representations(q1)
+
+        if kind != "":
+            raise Exception("Oops, interval products are only of the standard kind.")
+
+        left, right = (q1, self) if reverse else (self, q1)
+
+        # All 16 products of terms, each the hull of its 4 corner products.
+        corners = [
+            left_end[..., :, np.newaxis] * right_end[..., np.newaxis, :]
+            for left_end in [left.lo, left.hi]
+            for right_end in [right.lo, right.hi]
+        ]
+        term_lo, term_hi = np.minimum.reduce(corners), np.maximum.reduce(corners)
+
+        term_lo = term_lo[..., self.LEFT, self.RIGHT]
+        term_hi = term_hi[..., self.LEFT, self.RIGHT]
+        size = np.maximum(np.abs(term_lo), np.abs(term_hi)).sum(axis=-1)
+
+        lo = np.where(self.SIGNS > 0, term_lo, -term_hi).sum(axis=-1)
+        hi = np.where(self.SIGNS > 0, term_hi, -term_lo).sum(axis=-1)
+        lo, hi = self._round_out(lo, hi, size)
+
+        times_symbol = "xR" if reverse else "x"
+        end_qtype = "{f}{ts}{s}".format(f=self.qtype, ts=times_symbol, s=q1.qtype)
+
+        return QHInterval(lo, hi, qtype=qtype or end_qtype)
+
+    triple_product = QH.triple_product
+
+    def rotation_and_or_boost(self, h, qtype="boost"):
+        """A boost or rotation or both, by QH.rotation_and_or_boost, for a box
+           of h values."""
+
+        return QH.rotation_and_or_boost(self, self._wrap(h), qtype=qtype)
+
+    @staticmethod
+    def _excluded(events, targets, lo, hi, tolerance):
+        """True for the boxes of h where some event surely misses its target."""
+
+        h = QHInterval(lo[:, np.newaxis, :], hi[:, np.newaxis, :])
+        boosted = QHInterval(events[np.newaxis]).rotation_and_or_boost(h)
+
+        misses = (boosted.lo > targets + tolerance) | (boosted.hi < targets - tolerance)
+
+        return np.any(misses, axis=(1, 2))
+
+    @staticmethod
+    def _bisect(lo, hi):
+        """Split each box in two across its widest side."""
+
+        side = np.argmax(hi - lo, axis=1)
+        rows = np.arange(len(lo))
+        middle = (lo[rows, side] + hi[rows, side]) / 2
+
+        lo_2, hi_1 = lo.copy(), hi.copy()
+        hi_1[rows, side] = middle
+        lo_2[rows, side] = middle
+
+        return np.concatenate([lo, lo_2]), np.concatenate([hi_1, hi])
+
+    @staticmethod
+    def _save_checkpoint(filename, state):
+        """Write the search state, replacing the old checkpoint only when done."""
+
+        with open(filename + ".tmp", "wb") as f:
+            np.savez(f, **state)
+
+        os.replace(filename + ".tmp", filename)
+
+    @staticmethod
+    def search_h(
+        events,
+        targets,
+        lower,
+        upper,
+        tolerance=1e-9,
+        min_width=1e-3,
+        max_rounds=100,
+        workers=None,
+        filename=None,
+        checkpoint_every=5,
+        quiet=True,
+    ):
+        """Branch and bound over the box of h values from lower to upper for h
+           with rotation_and_or_boost(event, h) within tolerance of the target,
+           for every event. Boxes are dropped once the interval result misses a
+           target and split in half otherwise, until narrower than min_width.
+           Each round of boxes is cut into chunks shared by the workers, all the
+           cores with workers=True. With a filename, the state is checkpointed
+           every so many rounds, and the same search picks up from an unfinished
+           checkpoint. A finished one starts the search over, and one for a
+           different search is an Oops.
+
+           Returns a dict: boxes that could not be ruled out, an (n, 2, 4)
+           array of lo and hi; none, True if it is proven that no h in the
+           search box works; complete, False if max_rounds ran out first; and
+           the counts of rounds and boxes checked."""
+
+        events = QHDual._array(events).reshape(-1, 4)
+        targets = QHDual._array(targets).reshape(-1, 4)
+        search = {
+            "events": events,
+            "targets": targets,
+            "lower": QHDual._array(lower).reshape(1, 4),
+            "upper": QHDual._array(upper).reshape(1, 4),
+            "limits": np.array([tolerance, min_width], dtype=np.float64),
+        }
+        state = None
+
+        if filename is not None and os.path.exists(filename):
+            with np.load(filename) as checkpoint:
+                state = {key: checkpoint[key] for key in checkpoint.files}
+
+            if not all(
+                key in state and np.array_equal(state[key], value)
+                for key, value in search.items()
+            ):
+                print("Oops, the checkpoint is for a different search: ", filename)
+                return None
+
+            if len(state["lo"]) == 0:
+                state = None
+
+        if state is None:
+            state = {
+                **search,
+                "lo": search["lower"],
+                "hi": search["upper"],
+                "found_lo": np.empty((0, 4)),
+                "found_hi": np.empty((0, 4)),
+                "counts": np.zeros(2, dtype=np.int64),
+            }
+
+        if workers is True:
+            workers = os.cpu_count()
+
+        while len(state["lo"]) and state["counts"][0] < max_rounds:
+            lo, hi = state["lo"], state["hi"]
+            chunks = range(0, len(lo), QHInterval.CHUNK)
+            jobs = [
+                (
+                    events,
+                    targets,
+                    lo[start : start + QHInterval.CHUNK],
+                    hi[start : start + QHInterval.CHUNK],
+                    tolerance,
+                )
+                for start in chunks
+            ]
+
+            if workers and workers > 1:
+                excluded = QHStates._parallel_map(
+                    QHInterval._excluded, *zip(*jobs), workers=workers
+                )
+            else:
+                excluded = [QHInterval._excluded(*job) for job in jobs]
+
+            kept = ~np.concatenate(excluded)
+            lo, hi = lo[kept], hi[kept]
+            small = np.max(hi - lo, axis=1) <= min_width
+
+            state["found_lo"] = np.concatenate([state["found_lo"], lo[small]])
+            state["found_hi"] = np.concatenate([state["found_hi"], hi[small]])
+            state["lo"], state["hi"] = QHInterval._bisect(lo[~small], hi[~small])
+            state["counts"] = state["counts"] + [1, len(kept)]
+
+            if not quiet:
+                print(
+                    "round {}: {} boxes kept of {}, {} small enough".format(
+                        state["counts"][0], kept.sum(), len(kept), small.sum()
+                    )
+                )
+
+            if filename is not None and state["counts"][0] % checkpoint_every == 0:
+                QHInterval._save_checkpoint(filename, state)
+
+        if filename is not None:
+            QHInterval._save_checkpoint(filename, state)
+
+        complete = len(state["lo"]) == 0
+
+        return {
+            "boxes": np.stack([state["found_lo"], state["found_hi"]], axis=1),
+            "none": complete and len(state["found_lo"]) == 0,
+            "complete": complete,
+            "rounds": int(state["counts"][0]),
+            "checked": int(state["counts"][1]),
+        }
+
+
+
+
+if __name__ == "__main__":
+
+    class TestQHInterval(unittest.TestCase):
+        events = np.array([[1, 2, 3, 4], [0, 1, 0, 0], [2, 0, 1, 0], [1, 0, 0, 1]])
+        h = np.array([0.6, 0.3, -0.4, 0.2])
+
+        def test_product(self):
+            rng = np.random.default_rng(50)
+            p, q = rng.normal(size=(2, 100, 4))
+            p_box = QHInterval(p - 0.01, p + 0.01)
+            q_box = QHInterval(q - 0.01, q + 0.01)
+            shifts = rng.uniform(-0.01, 0.01, (2, 100, 4))
+            inside = qh_kernels.product(p + shifts[0], q + shifts[1])
+            self.assertTrue(np.all(p_box.product(q_box).contains(inside)))
+            reverse = qh_kernels.product(q + shifts[1], p + shifts[0])
+            self.assertTrue(
+                np.all(p_box.product(q_box, reverse=True).contains(reverse))
+            )
+
+            point = QHInterval([1, 2, 3, 4]).product(QH([2, -1, 0, 5]))
+            print("point product: ", point)
+            self.assertTrue(point.contains(QH([1, 2, 3, 4]).product(QH([2, -1, 0, 5]))))
+            self.assertTrue(np.all(point.width() < 1e-13))
+
+        def test_rotation_and_or_boost(self):
+            h_box = QHInterval(self.h - 1e-3, self.h + 1e-3)
+            boosted = QHInterval(self.events).rotation_and_or_boost(h_box)
+            exact = QHArray(self.events, qs_type="ket").rotation_and_or_boost(
+                QH(list(self.h))
+            )
+            self.assertTrue(np.all(boosted.contains(exact.a.reshape(-1, 4))))
+            print("boost of a box: ", boosted.width().max())
+
+        def test_search_h(self):
+            targets = QHArray(self.events, qs_type="ket").rotation_and_or_boost(
+                QH(list(self.h))
+            )
+            found = QHInterval.search_h(self.events, targets.a, -np.ones(4), np.ones(4))
+            boxes = QHInterval(found["boxes"][:, 0], found["boxes"][:, 1])
+            print("search_h: ", {key: found[key] for key in ["rounds", "checked"]})
+            self.assertTrue(found["complete"])
+            self.assertFalse(found["none"])
+            self.assertTrue(np.any(boxes.contains(self.h)))
+            self.assertTrue(np.any(boxes.contains(-self.h)))
+            self.assertTrue(np.all(boxes.width() <= 1e-3))
+
+        def test_search_h_none(self):
+            # (t, x, y, z) -> (t, -y, x, z) has no h in this box.
+            targets = self.events[:, [0, 2, 1, 3]] * [1, -1, 1, 1]
+            lower, upper = -np.ones(4), np.ones(4)
+            serial = QHInterval.search_h(self.events, targets, lower, upper)
+            self.assertTrue(serial["none"])
+            self.assertEqual(len(serial["boxes"]), 0)
+
+            parallel = QHInterval.search_h(
+                self.events, targets, lower, upper, workers=2
+            )
+            self.assertTrue(parallel["none"])
+            self.assertEqual(parallel["checked"], serial["checked"])
+            all_cores = QHInterval.search_h(
+                self.events, targets, lower, upper, workers=True
+            )
+            self.assertEqual(all_cores["checked"], serial["checked"])
+
+            with tempfile.TemporaryDirectory() as directory:
+                filename = os.path.join(directory, "search.npz")
+                part = QHInterval.search_h(
+                    self.events, targets, lower, upper, max_rounds=5, filename=filename
+                )
+                self.assertFalse(part["complete"])
+                self.assertFalse(part["none"])
+                other = QHInterval.search_h(
+                    self.events, self.events, lower, upper, filename=filename
+                )
+                self.assertTrue(other is None)
+                rest = QHInterval.search_h(
+                    self.events, targets, lower, upper, filename=filename
+                )
+                self.assertTrue(rest["none"])
+                self.assertEqual(rest["checked"], serial["checked"])
+                again = QHInterval.search_h(
+                    self.events, targets, lower, upper, filename=filename
+                )
+                self.assertEqual(again["rounds"], serial["rounds"])
+                looser = QHInterval.search_h(
+                    self.events, targets, lower, upper, 1e-6, filename=filename
+                )
+                self.assertTrue(looser is None)
+
+    suite = unittest.TestLoader().loadTestsFromModule(TestQHInterval())
+    _results = unittest.TextTestRunner().run(suite)
+
+
 
 
 